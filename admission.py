@@ -0,0 +1,145 @@
+import json
+import asyncio
+import hashlib
+import logging
+import contextlib
+from fastapi import HTTPException
+from retry import with_retries
+
+logger = logging.getLogger(__name__)
+
+class Overloaded(Exception):
+    pass
+
+class AdmissionQueue:
+    def __init__(self, max_active=16, max_queued=32, max_wait=5.0):
+        # At most max_active requests run; up to max_queued more wait for a slot, for at most max_wait seconds.
+        # Anything beyond that is turned away at once so queued requests keep a bounded latency
+        self.semaphore = asyncio.Semaphore(max_active)
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.waiting = 0
+
+    @contextlib.asynccontextmanager
+    async def admit(self):
+        if self.semaphore.locked() and self.waiting >= self.max_queued:
+            raise Overloaded("Request queue is full")
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.max_wait)
+        except asyncio.TimeoutError:
+            raise Overloaded("Timed out waiting for a free slot")
+        finally:
+            self.waiting -= 1
+        try:
+            yield
+        finally:
+            self.semaphore.release()
+
+class SingleFlight:
+    def __init__(self):
+        # Identical calls made while one is already running wait for its result instead of calling again
+        self.flights = {}
+
+    async def do(self, key, call):
+        future = self.flights.get(key)
+        if future is None:
+            future = asyncio.ensure_future(call())
+            self.flights[key] = future
+            future.add_done_callback(lambda _: self.flights.pop(key, None))
+        # Shielded so one caller giving up does not cancel the call for everyone else waiting on it
+        return await asyncio.shield(future)
+
+class ProviderGate:
+    def __init__(self, name, concurrency, retries=2, base_delay=0.5, max_delay=8.0):
+        # Bounds concurrent calls to one provider, retries rate limits and transient errors, and coalesces
+        # identical in-flight calls. A slot is released while a retry backs off
+        self.name = name
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.flights = SingleFlight()
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @contextlib.asynccontextmanager
+    async def opened(self, call):
+        # For streams: retries `call` like call() does, each attempt in its own slot, and keeps the slot of the
+        # attempt that succeeds until the block exits
+        async def attempt():
+            await self.semaphore.acquire()
+            try:
+                return await call()
+            except BaseException:
+                self.semaphore.release()
+                raise
+
+        result = await self.retry(attempt)
+        try:
+            yield result
+        finally:
+            self.semaphore.release()
+
+    async def attempt(self, call):
+        async with self.semaphore:
+            return await call()
+
+    async def retry(self, call):
+        return await with_retries(call, self.retries, self.base_delay, self.max_delay)
+
+    async def call(self, call, key=None):
+        run = lambda: self.retry(lambda: self.attempt(call))
+        if key is None:
+            return await run()
+        return await self.flights.do(key, run)
+
+def request_key(*parts):
+    return hashlib.sha256(json.dumps(parts, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+class AdmissionMiddleware:
+    def __init__(self, app, admission, max_upload_bytes, paths):
+        # Applies to the listed HTTP paths: admission before the body is read, and an upload size cap enforced
+        # on the Content-Length header and again on every chunk as it streams in
+        self.app = app
+        self.admission = admission
+        self.max_upload_bytes = max_upload_bytes
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        try:
+            length = int(headers.get(b"content-length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            return await self.reject(send, 400, "Invalid Content-Length")
+        if length > self.max_upload_bytes:
+            return await self.reject(send, 413, "Upload too large")
+        try:
+            async with self.admission.admit():
+                await self.app(scope, self.limited(receive), send)
+        except Overloaded as e:
+            logger.warning(f"Rejected {scope['path']}: {e}")
+            await self.reject(send, 503, str(e), {"retry-after": "1"})
+
+    def limited(self, receive):
+        received = 0
+
+        async def receive_limited():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_upload_bytes:
+                    raise HTTPException(status_code=413, detail="Upload too large")
+            return message
+        return receive_limited
+
+    @staticmethod
+    async def reject(send, status, detail, headers=None):
+        body = json.dumps({"detail": detail}).encode("utf-8")
+        response_headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+        response_headers += [(name.encode(), value.encode()) for name, value in (headers or {}).items()]
+        await send({"type": "http.response.start", "status": status, "headers": response_headers})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,346 @@
+import asyncio
+import contextlib
+import functools
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import speech
+from speech_to_text import recognition_request, to_linear16
+from speech_pipeline import SentenceChunker
+from instrumentation import current_turn, start_turn
+from admission import request_key
+
+logger = logging.getLogger(__name__)
+
+class AsyncSpeechToText:
+    def __init__(self, s2t=None, credentials=None, max_workers=4, gate=None):
+        # s2t provides microphone capture; credentials enable the native grpc.aio client for recognition.
+        # A ProviderGate bounds, retries and coalesces recognition calls
+        self.s2t = s2t
+        self.credentials = credentials
+        self.gate = gate
+        self.client = None
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def async_client(self):
+        # grpc.aio channels bind to the running event loop, so the native client is created on first use
+        if self.client is None and self.credentials is not None:
+            self.client = speech.SpeechAsyncClient(credentials=self.credentials)
+        return self.client
+
+    async def warm(self, timeout=10):
+        # Connects the native client's channel on the loop that will use it, before the first request
+        client = self.async_client()
+        if client is None:
+            return
+        try:
+            await asyncio.wait_for(client.transport.grpc_channel.channel_ready(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Timed out warming the speech client; it will connect on first use")
+
+    async def transcribe_audio(self, audio):
+        with current_turn.get().span("stt"):
+            if self.gate is None:
+                return await self.recognize(audio)
+            content = to_linear16(audio)
+            return await self.gate.call(lambda: self.recognize(content), key=hashlib.sha256(content).hexdigest())
+
+    async def recognize(self, audio):
+        client = self.async_client()
+        if client is None:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, self.s2t.transcribe_audio, audio)
+        try:
+            # Compressing the payload is CPU work, so it stays off the event loop
+            config, request = await asyncio.get_running_loop().run_in_executor(self.executor, recognition_request, audio)
+            response = await client.recognize(config=config, audio=request)
+            return response.results[0].alternatives[0].transcript
+        except Exception as e:
+            logger.error(f"Error in transcribe_audio: {e}")
+            raise
+
+    async def listen(self, **capture_options):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(self.s2t.listen, **capture_options))
+
+    async def utterances(self, queue_size=2, **capture_options):
+        # The capture thread blocks once the queue is full, so a slow consumer applies backpressure to the microphone
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=queue_size)
+        stopped = threading.Event()
+
+        def capture():
+            try:
+                for utterance in self.s2t.utterances(**capture_options):
+                    if stopped.is_set():
+                        return
+                    asyncio.run_coroutine_threadsafe(queue.put(utterance), loop).result()
+            except Exception as e:
+                asyncio.run_coroutine_threadsafe(queue.put(e), loop).result()
+
+        threading.Thread(target=capture, daemon=True).start()
+        try:
+            while True:
+                item = await queue.get()
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stopped.set()
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.transport.close()
+        self.executor.shutdown(wait=False)
+
+class AsyncTextToText:
+    def __init__(self, t2t, gate=None):
+        self.t2t = t2t
+        self.gate = gate
+
+    async def generate_response(self, user_input):
+        try:
+            self.t2t.add_prompt(user_input)
+            engine, messages = self.t2t.engine, self.t2t.messages
+            with current_turn.get().span("llm_total"):
+                if self.gate is None:
+                    response = await engine.acomplete(messages)
+                else:
+                    # Identical conversations asked at the same time share one completion
+                    response = await self.gate.call(lambda: engine.acomplete(messages), key=request_key(self.t2t.model, messages))
+            self.t2t.add_response(response)
+            return response
+        except asyncio.CancelledError:
+            self.t2t.discard_prompt()
+            raise
+        except Exception as e:
+            logger.error(f"Error in TextToText: {e}")
+            raise
+
+    async def stream_response(self, user_input):
+        try:
+            self.t2t.add_prompt(user_input)
+            turn = current_turn.get()
+            started = time.perf_counter()
+            parts = []
+            engine, messages = self.t2t.engine, self.t2t.messages
+
+            async def open_stream():
+                # Retried until the first token arrives; a stream that breaks after that is not restarted
+                stream = engine.astream(messages)
+                return stream, await anext(stream, None)
+
+            # A stream holds its provider slot until the last token, but not while a failed attempt backs off
+            opened = self.gate.opened(open_stream) if self.gate is not None else contextlib.nullcontext(await open_stream())
+            async with opened as (stream, token):
+                while token is not None:
+                    if not parts:
+                        turn.record("llm_first_token", time.perf_counter() - started, started)
+                    parts.append(token)
+                    yield token
+                    token = await anext(stream, None)
+            turn.record("llm_total", time.perf_counter() - started, started)
+            self.t2t.add_response("".join(parts))
+        except (asyncio.CancelledError, GeneratorExit):
+            # Interrupted by a barge-in: what was said so far is the reply, so the history stays user/assistant
+            if parts:
+                self.t2t.add_response("".join(parts))
+            else:
+                self.t2t.discard_prompt()
+            raise
+        except Exception as e:
+            logger.error(f"Error in TextToText: {e}")
+            raise
+
+class AsyncTextToSpeech:
+    def __init__(self, t2s, synthesis_workers=2, playback=None, gate=None):
+        # The engines have no native async API (and must go through their cache), so they run on bounded executors;
+        # a single playback worker keeps clips from overlapping. With a PlaybackEngine, playback is non-blocking
+        # and can be stopped mid-clip. A ProviderGate shared between wrappers of the same provider bounds, retries
+        # and coalesces their synthesis calls
+        self.t2s = t2s
+        self.playback = playback
+        self.gate = gate
+        self.synthesis_executor = ThreadPoolExecutor(max_workers=synthesis_workers)
+        self.playback_executor = ThreadPoolExecutor(max_workers=1)
+
+    async def generate_audio(self, text):
+        # The engines return the whole clip in one response, so its first byte arrives when the request completes
+        loop = asyncio.get_running_loop()
+        synthesize = lambda: loop.run_in_executor(self.synthesis_executor, self.t2s.generate_audio, text)
+        with current_turn.get().span("tts_first_byte"):
+            if self.gate is None:
+                return await synthesize()
+            return await self.gate.call(synthesize, key=(type(self.t2s).__name__, text))
+
+    async def decode(self, audio):
+        with current_turn.get().span("decode"):
+            return await asyncio.get_running_loop().run_in_executor(self.synthesis_executor, self.t2s.decode, audio)
+
+    async def play(self, audio):
+        loop = asyncio.get_running_loop()
+        if self.playback is None:
+            current_turn.get().mark("playback_start")
+            return await loop.run_in_executor(self.playback_executor, self.t2s.play, audio)
+        samples, sample_rate = await self.decode(audio)
+        finished = self.playback.play(samples, sample_rate)
+        current_turn.get().mark("playback_start")
+        return await asyncio.wrap_future(finished)
+
+    def stop(self):
+        if self.playback is not None:
+            self.playback.stop()
+
+    async def synthesize(self, text):
+        await self.play(await self.generate_audio(text))
+
+class VoicePipeline:
+    def __init__(self, stt, llm, tts=None, queue_size=2, stream_stt=False, echo_tail=1.0, barge_in=False,
+                 on_prompt=print, on_token=functools.partial(print, end="", flush=True), on_response=print):
+        # barge_in needs tts with a PlaybackEngine and a capture whose VAD follows its echo_energy
+        self.stt = stt
+        self.llm = llm
+        self.tts = tts
+        self.queue_size = queue_size
+        self.stream_stt = stream_stt
+        self.echo_tail = echo_tail
+        self.on_prompt = on_prompt
+        self.on_token = on_token
+        self.on_response = on_response
+        self.barge_in = barge_in
+        self.speaking_until = 0.0
+        self.turn = None
+        self.speech_queue = None
+        self.in_flight = None  # The (turn, synthesis) speak() has taken off the queue and not yet finished playing
+        self.speech_started = None
+
+    async def run(self):
+        # capture -> transcripts -> respond -> speech -> speak, each stage a task joined by a bounded queue
+        transcripts = asyncio.Queue(maxsize=self.queue_size)
+        self.speech_queue = asyncio.Queue(maxsize=self.queue_size * 4)
+        stages = [self.capture(transcripts), self.respond(transcripts, self.speech_queue)]
+        if self.tts is not None:
+            stages.append(self.speak(self.speech_queue))
+        await asyncio.gather(*stages)
+
+    def hears_echo(self):
+        # Without barge-in, anything captured while Vivy is speaking is taken to be her own voice
+        return not self.barge_in and asyncio.get_running_loop().time() < self.speaking_until + self.echo_tail
+
+    def on_speech_start(self):
+        # Called from the capture thread at speech onset
+        self.speech_started = time.perf_counter()
+        if self.barge_in:
+            self.interrupt()
+
+    def interrupt(self):
+        # Silences playback right away, then drops the rest of the turn (LLM stream and queued synthesis)
+        # on the event loop
+        if self.tts is not None and self.tts.playback.is_playing:
+            self.tts.stop()
+        self.loop.call_soon_threadsafe(self.cancel_turn)
+
+    def cancel_turn(self):
+        if self.turn is not None and not self.turn.done():
+            self.turn.cancel()
+        # The sentence speak() is already waiting on is dropped too, whether or not its synthesis has finished
+        if self.in_flight is not None:
+            self.in_flight[1].cancel()
+            self.in_flight = None
+        while not self.speech_queue.empty():
+            turn, pending = self.speech_queue.get_nowait()
+            if pending is not None:
+                pending.cancel()
+            else:
+                # Interrupted while its last sentences were still queued or playing
+                turn.mark("interrupted")
+                turn.finish()
+        self.tts.stop()
+
+    async def capture(self, transcripts):
+        self.loop = asyncio.get_running_loop()
+        capture_options = {"on_speech_start": self.on_speech_start}
+        if self.stream_stt:
+            # Streaming recognition already overlaps with capture; the transcript is final when listen returns,
+            # so capture also covers recognition here
+            while True:
+                prompt = await self.stt.listen(**capture_options)
+                turn = start_turn(self.speech_started)
+                if not self.hears_echo():
+                    await transcripts.put((turn, prompt))
+        async for utterance in self.stt.utterances(**capture_options):
+            turn = start_turn(self.speech_started)
+            if self.hears_echo():
+                continue
+            # Recognition starts right away and runs while the next utterance is being captured
+            await transcripts.put((turn, asyncio.ensure_future(self.stt.transcribe_audio(utterance))))
+
+    async def respond(self, transcripts, speech_queue):
+        while True:
+            turn, transcript = await transcripts.get()
+            current_turn.set(turn)
+            try:
+                prompt = await transcript if asyncio.isfuture(transcript) else transcript
+                if not prompt:
+                    continue
+                self.on_prompt(prompt)
+                self.turn = asyncio.ensure_future(self.run_turn(prompt, speech_queue))
+                # Waiting through asyncio.wait keeps a barge-in cancellation of the turn from cancelling this stage
+                await asyncio.wait([self.turn])
+                if self.turn.cancelled():
+                    turn.mark("interrupted")
+                    turn.finish()
+                elif self.turn.exception() is not None:
+                    raise self.turn.exception()
+                elif self.tts is None:
+                    turn.finish()
+            except Exception as e:
+                logger.error(f"Error in VoicePipeline: {e}")
+                turn.fail()
+                turn.finish()
+
+    async def run_turn(self, prompt, speech_queue):
+        if self.tts is None:
+            self.on_response(await self.llm.generate_response(prompt))
+            return
+        turn = current_turn.get()
+        chunker = SentenceChunker()
+        try:
+            # Closed here rather than whenever it is collected, so an interrupted reply is recorded before the next prompt
+            async with contextlib.aclosing(self.llm.stream_response(prompt)) as tokens:
+                async for token in tokens:
+                    self.on_token(token)
+                    for chunk in chunker.feed(token):
+                        await speech_queue.put((turn, asyncio.ensure_future(self.tts.generate_audio(chunk))))
+            for chunk in chunker.flush():
+                await speech_queue.put((turn, asyncio.ensure_future(self.tts.generate_audio(chunk))))
+        finally:
+            self.on_token("\n")
+        # The turn is over once its last sentence has been played
+        await speech_queue.put((turn, None))
+
+    async def speak(self, speech_queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            turn, pending = await speech_queue.get()
+            current_turn.set(turn)
+            if pending is None:
+                turn.finish()
+                continue
+            self.in_flight = (turn, pending)
+            try:
+                audio = await pending
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                continue  # Synthesis of an interrupted turn
+            if self.in_flight is None or self.in_flight[1] is not pending:
+                continue  # Synthesized, but interrupted before it could play
+            try:
+                self.speaking_until = float("inf")
+                await self.tts.play(audio)
+            except Exception as e:
+                logger.error(f"Error in VoicePipeline: {e}")
+            finally:
+                self.speaking_until = loop.time()
+                self.in_flight = None
@@ -0,0 +1,177 @@
+import threading
+import logging
+import numpy as np
+from constants import SAMPLE_RATE_HERTZ
+from vad import EnergyVAD
+
+logger = logging.getLogger(__name__)
+
+class RingBuffer:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=np.int16)
+        self.written = 0  # Absolute number of samples written since creation
+        self.condition = threading.Condition()
+
+    def write(self, samples):
+        count = len(samples)
+        if count > self.capacity:
+            samples = samples[-self.capacity:]
+        start = (self.written + count - len(samples)) % self.capacity
+        first = min(len(samples), self.capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:len(samples) - first] = samples[first:]
+        with self.condition:
+            self.written += count
+            self.condition.notify_all()
+
+    def read(self, start, end):
+        # Positions are absolute; anything older than `capacity` samples has been overwritten
+        oldest = self.written - self.capacity
+        if start < oldest:
+            logger.warning(f"Ring buffer overrun, dropped {oldest - start} samples")
+            start = oldest
+        offset = start % self.capacity
+        count = end - start
+        if offset + count <= self.capacity:
+            return self.buffer[offset:offset + count].copy()
+        return np.concatenate((self.buffer[offset:], self.buffer[:offset + count - self.capacity]))
+
+    def wait_for(self, position, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.written >= position, timeout)
+
+class AudioCapture:
+    def __init__(self, sample_rate=SAMPLE_RATE_HERTZ, frame_duration=0.02, buffer_duration=30, device=None, echo_reference=None,
+                 stream_factory=None):
+        self.sample_rate = sample_rate
+        # Builds the input stream; anything with sd.InputStream's signature works, e.g. a virtual microphone.
+        # sounddevice itself is only imported once a real microphone is opened
+        self.stream_factory = stream_factory
+        # Callable returning the energy currently being played, so playback is not mistaken for speech
+        self.echo_reference = echo_reference
+        self.frame_duration = frame_duration
+        self.frame_size = int(sample_rate * frame_duration)
+        self.device = device
+        self.ring = RingBuffer(int(sample_rate * buffer_duration))
+        self.stream = None
+        # One VAD for the life of the capture, so its noise floor carries over from one utterance to the next
+        # instead of being calibrated again (on Vivy's own voice) at the start of every turn
+        self.vad = None
+        self.vad_options = None
+
+    def _callback(self, indata, frames, time_info, status):
+        if status:
+            logger.warning(f"Audio capture status: {status}")
+        self.ring.write(indata[:, 0])
+
+    def start(self):
+        if self.stream is None:
+            stream_factory = self.stream_factory
+            if stream_factory is None:
+                import sounddevice as sd
+                stream_factory = sd.InputStream
+            self.stream = stream_factory(
+                samplerate=self.sample_rate, channels=1, dtype=np.int16,
+                blocksize=self.frame_size, device=self.device, callback=self._callback,
+            )
+            self.stream.start()
+
+    def stop(self):
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def blocks(self, position=None, timeout=1.0):
+        # Yields (absolute position, samples) covering every complete frame available since the previous block
+        self.start()
+        if position is None:
+            position = self.ring.written
+        while True:
+            if not self.ring.wait_for(position + self.frame_size, timeout):
+                if self.stream is None or not self.stream.active:
+                    raise RuntimeError("Audio input stream is not running")
+                continue
+            available = self.ring.written - position
+            end = position + available - available % self.frame_size
+            yield position, self.ring.read(position, end)
+            position = end
+
+    def voice_detector(self, energy_ratio_threshold, silence_duration, pre_roll_duration, initialization_duration):
+        # The VAD is only rebuilt, and recalibrated, if the caller asks for different settings
+        options = (energy_ratio_threshold, silence_duration, pre_roll_duration, initialization_duration)
+        if self.vad is None or options != self.vad_options:
+            self.vad = EnergyVAD(
+                self.sample_rate, self.frame_duration, energy_ratio_threshold,
+                hangover_duration=silence_duration, pre_roll_duration=pre_roll_duration,
+                initialization_duration=initialization_duration,
+            )
+            self.vad_options = options
+        return self.vad
+
+    def _spans(self, max_duration, silence_duration, energy_ratio_threshold, initialization_duration, pre_roll_duration,
+               on_speech_start=None):
+        # Yields (start, end, done) each time the current utterance grows and once more when it ends
+        max_samples = int(max_duration * self.sample_rate)
+        pre_roll = int(pre_roll_duration * self.sample_rate)
+        if max_samples + pre_roll > self.ring.capacity:
+            raise ValueError("max_duration exceeds the capture buffer duration")
+        vad = self.voice_detector(energy_ratio_threshold, silence_duration, pre_roll_duration, initialization_duration)
+
+        speech_start = None
+        floor = None  # Pre-roll never reaches back past the previous utterance
+        for position, samples in self.blocks():
+            if floor is None:
+                floor = position
+            if self.echo_reference is not None:
+                vad.echo_energy = self.echo_reference()
+            for index, active in enumerate(vad.process(samples)):
+                frame_position = position + index * self.frame_size
+                if speech_start is None:
+                    if active:
+                        print("Speech detected, start recording...")
+                        speech_start = max(floor, frame_position - pre_roll)
+                        if on_speech_start is not None:
+                            on_speech_start()
+                    continue
+                if active and frame_position + self.frame_size - speech_start < max_samples:
+                    continue
+                if active:
+                    print("Max duration reached, stop recording...")
+                    frame_position += self.frame_size
+                else:
+                    print("Silence detected, stop recording...")
+                yield speech_start, frame_position, True
+                speech_start = None
+                floor = frame_position
+            if speech_start is not None:
+                yield speech_start, position + len(samples), False
+
+    def utterances(self, max_duration=10, silence_duration=0.8, energy_ratio_threshold=1.5, initialization_duration=1.0,
+                   pre_roll_duration=0.2, on_speech_start=None):
+        for start, end, done in self._spans(max_duration, silence_duration, energy_ratio_threshold, initialization_duration,
+                                            pre_roll_duration, on_speech_start):
+            if done:
+                yield self.ring.read(start, end)
+
+    def stream_utterance(self, max_duration=10, silence_duration=0.8, energy_ratio_threshold=1.5, initialization_duration=1.0,
+                         pre_roll_duration=0.2, on_speech_start=None):
+        # Yields the next utterance block by block while it is being spoken, returning at end of speech
+        sent = None
+        for start, end, done in self._spans(max_duration, silence_duration, energy_ratio_threshold, initialization_duration,
+                                            pre_roll_duration, on_speech_start):
+            if sent is None:
+                sent = start
+            if end > sent:
+                yield self.ring.read(sent, end)
+                sent = end
+            if done:
+                return
@@ -0,0 +1,58 @@
+import io
+import struct
+import numpy as np
+
+def decode_wav(data):
+    # Walks the RIFF chunks and views the 16-bit PCM payload in place; returns ((frames, channels) int16, rate)
+    view = memoryview(data)
+    if bytes(view[:4]) != b"RIFF" or bytes(view[8:12]) != b"WAVE":
+        raise ValueError("Not a WAV file")
+    offset = 12
+    channels = sample_rate = None
+    while offset + 8 <= len(view):
+        chunk_id = bytes(view[offset:offset + 4])
+        size = int.from_bytes(view[offset + 4:offset + 8], "little")
+        body = offset + 8
+        if chunk_id == b"fmt ":
+            format_tag, channels, sample_rate = struct.unpack_from("<HHI", view, body)
+            bits = struct.unpack_from("<H", view, body + 14)[0]
+            if format_tag != 1 or bits != 16:
+                raise ValueError("Only 16-bit PCM WAV is supported")
+        elif chunk_id == b"data":
+            if channels is None:
+                raise ValueError("WAV data chunk precedes its format chunk")
+            # Streamed WAVs may carry a placeholder size, so the payload is bounded by what is actually there
+            end = min(body + size, len(view))
+            end -= (end - body) % (2 * channels)
+            return decode_pcm16(view[body:end], channels), sample_rate
+        offset = body + size + (size & 1)
+    raise ValueError("WAV data chunk not found")
+
+def encode_wav(samples, sample_rate):
+    # 16-bit PCM WAV from int16 samples shaped (frames,) or (frames, channels)
+    samples = np.asarray(samples, dtype="<i2")
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    data = np.ascontiguousarray(samples).tobytes()
+    header = struct.pack(
+        "<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + len(data), b"WAVE", b"fmt ", 16, 1, channels, sample_rate,
+        sample_rate * channels * 2, channels * 2, 16, b"data", len(data),
+    )
+    return header + data
+
+def decode_pcm16(data, channels=1):
+    # Raw little-endian 16-bit PCM as a zero-copy view; a trailing partial frame is ignored
+    view = memoryview(data)
+    return np.frombuffer(view[:len(view) - len(view) % (2 * channels)], dtype="<i2").reshape(-1, channels)
+
+def decode_compressed(data):
+    # OGG/Opus, FLAC and similar containers decode in-process through libsndfile
+    import soundfile as sf
+    samples, sample_rate = sf.read(io.BytesIO(data), dtype="int16", always_2d=True)
+    return samples, sample_rate
+
+def decode_mp3(data):
+    # Fallback only: pydub decodes MP3 by running ffmpeg in a subprocess
+    from pydub import AudioSegment
+    segment = AudioSegment.from_mp3(io.BytesIO(data))
+    samples = np.array(segment.get_array_of_samples(), dtype=np.int16)
+    return samples.reshape(-1, segment.channels), segment.frame_rate
@@ -0,0 +1,213 @@
+import os
+import json
+import asyncio
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from google.oauth2 import service_account
+from constants import KEY_PATH, TTS_CACHE_DIR, SAMPLE_RATE_HERTZ, SYSTEM_MESSAGE
+from audio_format import encode_wav
+from ingest import ingest
+from retry import with_retries
+from text_to_text import TextToText
+from vad import detect_segments
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = (".wav", ".flac", ".ogg", ".opus", ".webm", ".m4a", ".mp3")
+
+def find_sources(path):
+    # A directory is searched recursively for audio files; any other path is a manifest with one entry per
+    # line, either a bare path or a JSON object with "path" and optionally "id". Ids default to the path
+    if os.path.isdir(path):
+        sources = []
+        for root, _, names in os.walk(path):
+            for name in sorted(names):
+                if name.lower().endswith(AUDIO_EXTENSIONS):
+                    full_path = os.path.join(root, name)
+                    sources.append((os.path.relpath(full_path, path), full_path))
+        return sorted(sources)
+    base = os.path.dirname(os.path.abspath(path))
+    sources = []
+    with open(path) as manifest:
+        for line in manifest:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line) if line.startswith("{") else {"path": line}
+            sources.append((entry.get("id", entry["path"]), os.path.join(base, entry["path"])))
+    return sources
+
+def segment_file(path, sample_rate=SAMPLE_RATE_HERTZ):
+    # Runs in a worker process: decode, downmix, resample and VAD-segment one recording. Returns [(start, end, samples)]
+    with open(path, "rb") as file:
+        samples = ingest(file.read(), sample_rate)
+    return [(start, end, samples[start:end].copy()) for start, end in detect_segments(samples, sample_rate=sample_rate)]
+
+def completed_records(output_path):
+    # Segments already answered in a previous run, by id; failed ones are tried again
+    done = {}
+    if os.path.exists(output_path):
+        with open(output_path) as results:
+            for line in results:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # A line cut short when the previous run was killed
+                if "error" not in record:
+                    done[record["id"]] = record
+    return done
+
+class BatchRunner:
+    def __init__(self, s2t, t2s=None, system_message=SYSTEM_MESSAGE, model="gpt-3.5-turbo", stt_concurrency=8,
+                 llm_concurrency=8, tts_concurrency=4, processes=None, files_in_flight=None, conversation=False,
+                 audio_dir=None, retries=4, base_delay=1.0):
+        # Each provider gets its own thread pool, so its pool size is its concurrency limit and a slow provider
+        # cannot starve the others. Decoding and VAD run in a process pool
+        self.s2t = s2t
+        self.t2s = t2s
+        self.system_message = system_message
+        self.model = model
+        self.stt_executor = ThreadPoolExecutor(max_workers=stt_concurrency)
+        self.llm_executor = ThreadPoolExecutor(max_workers=llm_concurrency)
+        self.tts_executor = ThreadPoolExecutor(max_workers=tts_concurrency)
+        self.processes = processes or os.cpu_count()
+        # Bounds how many decoded recordings are held in memory at once
+        self.files_in_flight = files_in_flight or self.processes * 2
+        self.conversation = conversation
+        self.audio_dir = audio_dir
+        self.retries = retries
+        self.base_delay = base_delay
+
+    def run(self, sources, output_path):
+        return asyncio.run(self.arun(sources, output_path))
+
+    async def arun(self, sources, output_path):
+        done = completed_records(output_path)
+        if self.audio_dir:
+            os.makedirs(self.audio_dir, exist_ok=True)
+        file_slots = asyncio.Semaphore(self.files_in_flight)
+        counts = {"segments": 0, "skipped": 0, "failed": 0}
+        with ProcessPoolExecutor(max_workers=self.processes) as process_pool, open(output_path, "a") as output:
+            def write(record):
+                # Records are written and flushed one by one from the event loop, so a killed run loses at most a line
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+                counts["failed" if "error" in record else "segments"] += 1
+
+            async def run_file(source_id, path):
+                async with file_slots:
+                    await self.process_file(process_pool, source_id, path, done, write, counts)
+
+            await asyncio.gather(*(run_file(source_id, path) for source_id, path in sources))
+        logger.info(f"Batch finished: {counts['segments']} answered, {counts['skipped']} already done, {counts['failed']} failed")
+        return counts
+
+    async def call(self, executor, function, *args):
+        loop = asyncio.get_running_loop()
+        return await with_retries(lambda: loop.run_in_executor(executor, function, *args), self.retries, self.base_delay)
+
+    async def process_file(self, process_pool, source_id, path, done, write, counts):
+        loop = asyncio.get_running_loop()
+        try:
+            segments = await loop.run_in_executor(process_pool, segment_file, path)
+        except Exception as e:
+            logger.error(f"Error reading {path}: {e}")
+            write({"id": source_id, "file": source_id, "error": f"{type(e).__name__}: {e}"})
+            return
+        ids = [f"{source_id}#{index}" for index in range(len(segments))]
+        pending = [index for index, segment_id in enumerate(ids) if segment_id not in done]
+        counts["skipped"] += len(segments) - len(pending)
+        if not pending:
+            return
+
+        # Every segment of the file is transcribed concurrently; generation waits only for its own transcript
+        transcripts = {index: asyncio.ensure_future(self.transcribe(segments[index][2])) for index in pending}
+        if self.conversation:
+            t2t = TextToText(messages=[{"role": "system", "content": self.system_message}], model=self.model)
+            for index, segment_id in enumerate(ids):
+                if index in transcripts:
+                    await self.process_segment(segment_id, source_id, index, segments[index], transcripts[index], write, t2t)
+                elif done[segment_id].get("response"):
+                    # Replays turns answered in a previous run so the conversation resumes where it stopped
+                    t2t.add_prompt(done[segment_id]["transcript"])
+                    t2t.add_response(done[segment_id]["response"])
+        else:
+            await asyncio.gather(*(
+                self.process_segment(ids[index], source_id, index, segments[index], transcripts[index], write)
+                for index in pending
+            ))
+
+    async def transcribe(self, samples):
+        try:
+            return await self.call(self.stt_executor, self.s2t.transcribe_audio, samples)
+        except IndexError:
+            return ""  # No speech recognized in the segment
+
+    async def process_segment(self, segment_id, source_id, index, segment, transcript, write, t2t=None):
+        start, end, _ = segment
+        record = {"id": segment_id, "file": source_id, "segment": index, "start": start / SAMPLE_RATE_HERTZ, "end": end / SAMPLE_RATE_HERTZ}
+        try:
+            record["transcript"] = await transcript
+            if record["transcript"]:
+                record["response"] = await self.generate(record["transcript"], t2t)
+                if self.t2s is not None:
+                    record["audio"] = await self.synthesize(segment_id, record["response"])
+        except Exception as e:
+            logger.error(f"Error processing {segment_id}: {e}")
+            record["error"] = f"{type(e).__name__}: {e}"
+        write(record)
+
+    async def generate(self, prompt, t2t=None):
+        # Every attempt works on its own copy of the conversation, so a failed attempt leaves no dangling prompt
+        messages = t2t.messages if t2t is not None else [{"role": "system", "content": self.system_message}]
+
+        def generate_response():
+            return TextToText(messages=messages, model=self.model).generate_response(prompt)
+
+        response = await self.call(self.llm_executor, generate_response)
+        if t2t is not None:
+            t2t.add_prompt(prompt)
+            t2t.add_response(response)
+        return response
+
+    async def synthesize(self, segment_id, text):
+        audio = await self.call(self.tts_executor, self.t2s.generate_audio, text)
+        if not self.audio_dir:
+            return None
+        samples, sample_rate = await asyncio.get_running_loop().run_in_executor(self.tts_executor, self.t2s.decode, audio)
+        source_id, index = segment_id.rsplit("#", 1)
+        path = os.path.join(self.audio_dir, f"{os.path.splitext(source_id)[0].replace(os.sep, '__')}-{index}.wav")
+        with open(path, "wb") as file:
+            file.write(encode_wav(samples, sample_rate))
+        return path
+
+if __name__ == "__main__":
+    from logger import logger
+    parser = argparse.ArgumentParser(description="Transcribe and answer a directory or manifest of recordings.")
+    parser.add_argument("input", help="Directory of audio files, or a manifest with one path or JSON object per line.")
+    parser.add_argument("--output", default="batch_results.jsonl", help="JSONL results; an existing file is resumed.")
+    parser.add_argument("--want_sound", action="store_true", help="Also synthesize every response.")
+    parser.add_argument("--use_eleven_labs", action="store_true", help="Use ElevenLabs for TTS instead of Google Cloud.")
+    parser.add_argument("--audio_dir", help="Write synthesized responses here as WAV files.")
+    parser.add_argument("--conversation", action="store_true", help="Answer the segments of each file as one conversation.")
+    parser.add_argument("--stt_concurrency", type=int, default=8)
+    parser.add_argument("--llm_concurrency", type=int, default=8)
+    parser.add_argument("--tts_concurrency", type=int, default=4)
+    parser.add_argument("--processes", type=int, help="Worker processes for decoding and VAD (default: CPU count).")
+    parser.add_argument("--retries", type=int, default=4)
+    args = parser.parse_args()
+
+    from speech_to_text import SpeechToText
+    from text_to_speech import GoogleCloudTTS, ElevenLabsTTS, TTSCache
+    credentials = service_account.Credentials.from_service_account_file(KEY_PATH)
+    t2s = None
+    if args.want_sound:
+        tts_cache = TTSCache(directory=TTS_CACHE_DIR)
+        t2s = ElevenLabsTTS(cache=tts_cache) if args.use_eleven_labs else GoogleCloudTTS(credentials, cache=tts_cache)
+    runner = BatchRunner(
+        SpeechToText(credentials), t2s, stt_concurrency=args.stt_concurrency, llm_concurrency=args.llm_concurrency,
+        tts_concurrency=args.tts_concurrency, processes=args.processes, conversation=args.conversation,
+        audio_dir=args.audio_dir, retries=args.retries,
+    )
+    runner.run(find_sources(args.input), args.output)
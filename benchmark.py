@@ -0,0 +1,298 @@
+import os
+import sys
+import json
+import time
+import subprocess
+import uuid
+import asyncio
+import argparse
+import itertools
+import resource
+import tracemalloc
+import numpy as np
+import httpx
+from logger import logger
+from fakes import (
+    VirtualMicrophone, VirtualSpeaker, FakeSpeechClient, FakeSpeechAsyncClient, FakeTTSClient, FakeElevenLabs,
+    FakeChatCompletion, patched, synthetic_speech,
+)
+from audio_capture import AudioCapture
+from audio_format import encode_wav
+from ingest import ingest, resample, to_int16, encode_compressed, encode_upstream
+from speech_to_text import SpeechToText
+from text_to_text import TextToText
+from text_to_speech import GoogleCloudTTS, ElevenLabsTTS
+from async_pipeline import AsyncSpeechToText, AsyncTextToText, AsyncTextToSpeech, VoicePipeline
+from instrumentation import metrics
+from vad import detect_segments
+from admission import ProviderGate
+from constants import SAMPLE_RATE_HERTZ, STT_CONCURRENCY, LLM_CONCURRENCY, TTS_CONCURRENCY
+
+# Offline benchmarks of the conversation loop (main.py) and of /process-audio under concurrent load. Every
+# cloud service is replaced by a fake from fakes.py, so results depend only on the code and the fake latencies.
+
+# Cold-start scenarios, each timed in a fresh interpreter. Clients are built with anonymous credentials so no key
+# is needed; building a client does not contact the service
+OFFLINE_REGISTRY = (
+    "from google.auth.credentials import AnonymousCredentials; from engines import registry; "
+    "registry.register('credentials', lambda registry: AnonymousCredentials()); "
+)
+STARTUP_SCRIPTS = {
+    "interpreter": "pass",
+    "import_main": "import main",
+    "import_server": "import server",
+    "build_stt": OFFLINE_REGISTRY + "registry.get('stt')",
+    "build_conversation": OFFLINE_REGISTRY + "registry.get('conversation')",
+    "build_google_tts": OFFLINE_REGISTRY + "registry.get('google_tts')",
+    "build_eleven_labs_tts": OFFLINE_REGISTRY + "registry.get('eleven_labs_tts')",
+}
+
+class TurnRecorder:
+    # Collects the per-stage timings of every finished turn
+    def __init__(self):
+        self.turns = []
+
+    def __call__(self, turn):
+        self.turns.append(dict(turn.timings))
+
+    def stages(self):
+        stages = {}
+        for timings in self.turns:
+            for stage, seconds in timings.items():
+                stages.setdefault(stage, []).append(seconds)
+        return stages
+
+def summarize(values):
+    values = np.asarray(values) * 1000
+    return {"count": len(values), "p50_ms": float(np.percentile(values, 50)), "p95_ms": float(np.percentile(values, 95))}
+
+def memory_usage():
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    usage = {"peak_rss_mb": peak_rss / 2 ** 20}
+    if tracemalloc.is_tracing():
+        usage["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    return usage
+
+def build_fakes(args):
+    chat = FakeChatCompletion(args.llm_first_token, args.llm_tokens_per_second)
+    eleven_labs = FakeElevenLabs(args.tts_latency)
+    return chat, eleven_labs
+
+def build_tts(args, playback):
+    if args.use_eleven_labs:
+        return AsyncTextToSpeech(ElevenLabsTTS(), playback=playback)
+    return AsyncTextToSpeech(GoogleCloudTTS(None, client=FakeTTSClient(args.tts_latency)), playback=playback)
+
+async def bench_pipeline(args, recorder):
+    # main.py's loop: virtual microphone -> VAD -> STT -> streamed LLM -> sentence TTS -> virtual speaker
+    if args.wav:
+        microphone = VirtualMicrophone.from_wav(args.wav, args.speed)
+    else:
+        microphone = VirtualMicrophone(synthetic_speech(args.turns, gap_duration=args.gap), SAMPLE_RATE_HERTZ, args.speed)
+    expected = len(detect_segments(microphone.samples, sample_rate=microphone.sample_rate))
+
+    stt_client = FakeSpeechClient(args.stt_latency)
+    s2t = SpeechToText(None, client=stt_client, capture=AudioCapture(microphone.sample_rate, stream_factory=microphone))
+    stt = AsyncSpeechToText(s2t)
+    stt.client = FakeSpeechAsyncClient(args.stt_latency)
+    t2t = TextToText(messages=[{"role": "system", "content": "You are Vivy."}])
+    tts = build_tts(args, VirtualSpeaker(args.speed)) if args.want_sound else None
+    pipeline = VoicePipeline(
+        stt, AsyncTextToText(t2t), tts, stream_stt=args.stream_stt, barge_in=tts is not None,
+        on_prompt=lambda prompt: None, on_token=lambda token: None, on_response=lambda response: None,
+    )
+
+    started = time.perf_counter()
+    task = asyncio.ensure_future(pipeline.run())
+    deadline = started + microphone.duration / args.speed + args.drain
+    while len(recorder.turns) < expected and time.perf_counter() < deadline and not task.done():
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    s2t.close()
+    if len(recorder.turns) < expected:
+        logger.warning(f"Only {len(recorder.turns)} of {expected} turns completed")
+    return {"turns": len(recorder.turns), "elapsed_s": elapsed, "turns_per_s": len(recorder.turns) / elapsed}
+
+async def bench_server(args, recorder):
+    # /process-audio in-process over ASGI, `concurrency` clients each sending `requests` uploads
+    import server
+    state = server.app.state
+    state.stt = AsyncSpeechToText(SpeechToText(None, client=FakeSpeechClient(args.stt_latency)), gate=ProviderGate("stt", STT_CONCURRENCY))
+    state.stt.client = FakeSpeechAsyncClient(args.stt_latency)
+    state.llm_gate = ProviderGate("llm", LLM_CONCURRENCY)
+    google_gate = ProviderGate("google_tts", TTS_CONCURRENCY)
+    state.google_tts = itertools.cycle([
+        AsyncTextToSpeech(GoogleCloudTTS(None, client=FakeTTSClient(args.tts_latency)), playback=VirtualSpeaker(args.speed), gate=google_gate)
+        for _ in range(args.tts_pool_size)
+    ])
+    state.eleven_labs_tts = AsyncTextToSpeech(
+        ElevenLabsTTS(), synthesis_workers=args.tts_pool_size, playback=VirtualSpeaker(args.speed),
+        gate=ProviderGate("eleven_labs_tts", TTS_CONCURRENCY),
+    )
+    upload = encode_wav(synthetic_speech(1, lead_in=0.3, gap_duration=0.5), SAMPLE_RATE_HERTZ)
+    params = {"want_sound": args.want_sound, "use_eleven_labs": args.use_eleven_labs, "debug": False}
+    latencies = []
+    failures = rejected = 0
+
+    async def client(http):
+        nonlocal failures, rejected
+        headers = {"X-Session-ID": uuid.uuid4().hex}
+        for _ in range(args.requests):
+            request_started = time.perf_counter()
+            response = await http.post("/process-audio", params=params, headers=headers, files={"audio_file": ("audio.wav", upload, "audio/wav")})
+            if response.status_code == 200:
+                latencies.append(time.perf_counter() - request_started)
+            elif response.status_code == 503:
+                rejected += 1
+            else:
+                failures += 1
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as http:
+        started = time.perf_counter()
+        await asyncio.gather(*(client(http) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+    return {
+        "requests": len(latencies), "failures": failures, "rejected": rejected, "concurrency": args.concurrency, "elapsed_s": elapsed,
+        "requests_per_s": len(latencies) / elapsed, "end_to_end": summarize(latencies) if latencies else None,
+    }
+
+def bench_startup(args):
+    # Wall time of a fresh interpreter running each scenario, including interpreter start-up itself
+    directory = os.path.dirname(os.path.abspath(__file__))
+    stages = {}
+    for name, script in STARTUP_SCRIPTS.items():
+        durations = []
+        for _ in range(args.startup_runs):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, "-c", script], cwd=directory, check=True, capture_output=True)
+            durations.append(time.perf_counter() - started)
+        stages[name] = summarize(durations)
+    return {"runs": args.startup_runs, "stages": stages}
+
+def bench_ingest(args):
+    # Upload ingest per source format, and upstream encoding per codec, on the same seconds of synthetic speech.
+    # x_realtime is seconds of audio handled per second of CPU at the median
+    speech = synthetic_speech(max(1, int(args.ingest_seconds / 4.5)), lead_in=0.5)
+    audio_seconds = len(speech) / SAMPLE_RATE_HERTZ
+    stereo_48k = np.repeat(to_int16(resample(speech, SAMPLE_RATE_HERTZ, 48000))[:, None], 2, axis=1)
+    stereo_44k = np.repeat(to_int16(resample(speech, SAMPLE_RATE_HERTZ, 44100))[:, None], 2, axis=1)
+    sources = {
+        "wav_16k_mono": encode_wav(speech, SAMPLE_RATE_HERTZ),
+        "wav_44k_stereo": encode_wav(stereo_44k, 44100),
+        "wav_48k_stereo": encode_wav(stereo_48k, 48000),
+    }
+    for name, encoding in (("flac_48k_stereo", "FLAC"), ("ogg_opus_48k_stereo", "OGG_OPUS")):
+        try:
+            sources[name] = encode_compressed(stereo_48k, 48000, encoding)
+        except Exception as e:
+            logger.warning(f"Skipping {name}: {e}")
+    jobs = {f"ingest_{name}": (lambda data=data: ingest(data)) for name, data in sources.items()}
+    for encoding in ("FLAC", "OGG_OPUS"):
+        jobs[f"upstream_{encoding.lower()}"] = lambda encoding=encoding: encode_upstream(speech, encodings=(encoding,))
+    result = {"audio_s": audio_seconds, "linear16_bytes": len(speech.tobytes())}
+    stages = {}
+    for name, job in jobs.items():
+        durations = []
+        for _ in range(args.ingest_runs):
+            started = time.perf_counter()
+            output = job()
+            durations.append(time.perf_counter() - started)
+        stages[name] = summarize(durations)
+        result[f"{name}_x_realtime"] = audio_seconds / float(np.percentile(durations, 50))
+        if name.startswith("upstream_"):
+            result[f"{name}_bytes"] = len(output[1])
+    result["stages"] = stages
+    return result
+
+def print_report(name, result):
+    print(f"\n{name}")
+    for key, value in result.items():
+        if key not in ("stages", "end_to_end"):
+            print(f"  {key}: {value:.2f}" if isinstance(value, float) else f"  {key}: {value}")
+    rows = dict(result.get("stages", {}))
+    if result.get("end_to_end"):
+        rows = {"end_to_end": result["end_to_end"], **rows}
+    print(f"  {'stage':<28}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}")
+    for stage, summary in rows.items():
+        print(f"  {stage:<28}{summary['count']:>7}{summary['p50_ms']:>10.1f}{summary['p95_ms']:>10.1f}")
+
+def regressions(results, baseline, tolerance):
+    # Every p95 that is more than `tolerance` slower than the saved baseline
+    found = []
+    for name, result in results.items():
+        previous_result = baseline.get(name, {})
+        rows = [("end_to_end", result.get("end_to_end"), previous_result.get("end_to_end"))]
+        rows += [(stage, summary, previous_result.get("stages", {}).get(stage)) for stage, summary in result["stages"].items()]
+        for stage, summary, previous in rows:
+            if summary and previous and summary["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+                found.append(f"{name} {stage}: p95 {summary['p95_ms']:.1f}ms vs {previous['p95_ms']:.1f}ms")
+    return found
+
+async def run(args):
+    results = {}
+    if args.target in ("startup", "all"):
+        results["startup"] = bench_startup(args)
+    if args.target in ("ingest", "all"):
+        results["ingest"] = bench_ingest(args)
+    benchmarks = {"pipeline": bench_pipeline, "server": bench_server}
+    for name in (["pipeline", "server"] if args.target == "all" else [args.target] if args.target in benchmarks else []):
+        recorder = TurnRecorder()
+        metrics.listeners.append(recorder)
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        try:
+            result = await benchmarks[name](args, recorder)
+        finally:
+            metrics.listeners.remove(recorder)
+        result["stages"] = {stage: summarize(values) for stage, values in recorder.stages().items()}
+        result.update(memory_usage())
+        results[name] = result
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the voice pipeline and the server against local fakes.")
+    parser.add_argument("target", nargs="?", choices=["pipeline", "server", "startup", "ingest", "all"], default="all")
+    parser.add_argument("--wav", help="Recording (WAV, FLAC, OGG, any rate) to use as the microphone instead of synthetic speech.")
+    parser.add_argument("--turns", type=int, default=4, help="Utterances in the synthetic microphone input.")
+    parser.add_argument("--gap", type=float, default=15.0, help="Seconds of silence between synthetic utterances; shorter gaps barge in on replies.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Microphone and speaker speed relative to real time.")
+    parser.add_argument("--drain", type=float, default=15.0, help="Seconds to wait for the last turns after the input ends.")
+    parser.add_argument("--want_sound", action="store_true", help="Synthesize and play replies.")
+    parser.add_argument("--use_eleven_labs", action="store_true", help="Use the ElevenLabs engine instead of Google Cloud.")
+    parser.add_argument("--stream_stt", action="store_true", help="Stream audio to recognition while recording.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent /process-audio clients.")
+    parser.add_argument("--requests", type=int, default=5, help="Requests per client.")
+    parser.add_argument("--tts_pool_size", type=int, default=4, help="Google TTS clients behind the server.")
+    parser.add_argument("--stt_latency", type=float, default=0.15)
+    parser.add_argument("--llm_first_token", type=float, default=0.35)
+    parser.add_argument("--llm_tokens_per_second", type=float, default=40.0)
+    parser.add_argument("--tts_latency", type=float, default=0.2)
+    parser.add_argument("--startup_runs", type=int, default=5, help="Fresh interpreters per start-up scenario.")
+    parser.add_argument("--ingest_seconds", type=float, default=10.0, help="Seconds of audio per ingest run.")
+    parser.add_argument("--ingest_runs", type=int, default=20)
+    parser.add_argument("--trace_memory", action="store_true", help="Track Python allocations (slows the run down).")
+    parser.add_argument("--save", help="Write the results as JSON to this path.")
+    parser.add_argument("--baseline", help="Fail if any p95 is slower than in this saved result.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p95 slowdown against the baseline.")
+    args = parser.parse_args()
+
+    metrics.enabled = True
+    if args.trace_memory:
+        tracemalloc.start()
+    with patched(*build_fakes(args)):
+        results = asyncio.run(run(args))
+    for name, result in results.items():
+        print_report(name, result)
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            found = regressions(results, json.load(file), args.tolerance)
+        for regression in found:
+            print(f"Regression: {regression}")
+        sys.exit(1 if found else 0)
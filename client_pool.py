@@ -0,0 +1,57 @@
+import queue
+import logging
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import grpc
+from google.oauth2 import service_account
+from speech_to_text import SpeechToText
+from text_to_speech import GoogleCloudTTS, ElevenLabsTTS
+
+logger = logging.getLogger(__name__)
+
+class ClientPool:
+    def __init__(self, factory, size):
+        # Each pooled client owns its own gRPC channel; clients are handed out to one request at a time
+        self.clients = [factory() for _ in range(size)]
+        self.available = queue.Queue()
+        for client in self.clients:
+            self.available.put(client)
+
+    @contextlib.contextmanager
+    def borrow(self, timeout=None):
+        client = self.available.get(timeout=timeout)
+        try:
+            yield client
+        finally:
+            self.available.put(client)
+
+class ServiceClients:
+    def __init__(self, key_path, stt_pool_size=4, tts_pool_size=4, tts_cache=None):
+        # Credentials are read once per process instead of once per request
+        credentials = service_account.Credentials.from_service_account_file(key_path)
+        self.credentials = credentials
+        self.stt = ClientPool(lambda: SpeechToText(credentials), stt_pool_size)
+        self.google_tts = ClientPool(lambda: GoogleCloudTTS(credentials, cache=tts_cache), tts_pool_size)
+        # ElevenLabs is plain HTTPS with no per-client state, one instance is shared
+        self.eleven_labs_tts = ElevenLabsTTS(cache=tts_cache)
+
+    def channels(self):
+        return [s2t.client.transport.grpc_channel for s2t in self.stt.clients] + [
+            t2s.client.transport.grpc_channel for t2s in self.google_tts.clients
+        ]
+
+    def warm(self, timeout=10):
+        # Connects every channel (DNS, TCP and TLS) up front so the first requests do not pay for it
+        def connect(channel):
+            try:
+                grpc.channel_ready_future(channel).result(timeout=timeout)
+            except grpc.FutureTimeoutError:
+                logger.warning("Timed out warming a gRPC channel; it will connect on first use")
+
+        channels = self.channels()
+        with ThreadPoolExecutor(max_workers=len(channels) or 1) as executor:
+            list(executor.map(connect, channels))
+
+    def close(self):
+        for channel in self.channels():
+            channel.close()
@@ -8,3 +8,37 @@ ELEVEN_LABS_API_KEY = os.getenv("ELEVEN_LABS_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 SAMPLE_RATE_HERTZ = 16000
 LANGUAGE_CODE = "en-US"
+SYSTEM_MESSAGE = "You are Vivy, the AI songstress from the anime 'Vivy: Fluorite Eye's Song.' You have been transported into the real world and are now here to interact with me as my anime waifu. Let's have a delightful and heartwarming conversation just like in the anime. Be concise in your conversations."
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR")
+STT_POOL_SIZE = int(os.getenv("STT_POOL_SIZE", "4"))
+TTS_POOL_SIZE = int(os.getenv("TTS_POOL_SIZE", "4"))
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.db")
+SESSION_TTL = float(os.getenv("SESSION_TTL", "3600"))
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", "10000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+OTEL_ENABLED = os.getenv("OTEL_ENABLED", "0") == "1"
+STT_CONCURRENCY = int(os.getenv("STT_CONCURRENCY", "8"))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "4"))
+PROVIDER_RETRIES = int(os.getenv("PROVIDER_RETRIES", "2"))
+MAX_ACTIVE_REQUESTS = int(os.getenv("MAX_ACTIVE_REQUESTS", "16"))
+MAX_QUEUED_REQUESTS = int(os.getenv("MAX_QUEUED_REQUESTS", "32"))
+MAX_QUEUE_WAIT = float(os.getenv("MAX_QUEUE_WAIT", "5"))
+MAX_UPLOAD_SECONDS = float(os.getenv("MAX_UPLOAD_SECONDS", "30"))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(2 * 1024 * 1024)))
+ENGINE_MODE = os.getenv("ENGINE_MODE", "cloud")  # cloud, local, or failover (cloud first, local when it is slow or down)
+VOSK_MODEL_PATH = os.getenv("VOSK_MODEL_PATH", "models/vosk-model-small-en-us-0.15")
+PIPER_MODEL_PATH = os.getenv("PIPER_MODEL_PATH")
+ESPEAK_VOICE = os.getenv("ESPEAK_VOICE", "en-us+f3")
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY", "0")) or None  # Seconds before a backup engine is tried; 0 adapts to latency
+FAILOVER_COOLDOWN = float(os.getenv("FAILOVER_COOLDOWN", "30"))
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL")  # Tried when the main chat model is slow or failing
+CONVERSATION_LOG_PATH = os.getenv("CONVERSATION_LOG_PATH")  # Unset keeps the conversation in memory only
+CONVERSATION_ID = os.getenv("CONVERSATION_ID", "default")
+CONVERSATION_RESUME_MESSAGES = int(os.getenv("CONVERSATION_RESUME_MESSAGES", "20"))
+SUMMARIZE_DROPPED = os.getenv("SUMMARIZE_DROPPED", "0") == "1"
+# Compressed encodings recognition requests may use when smaller than LINEAR16. OGG_OPUS is much smaller than FLAC
+# but costs about 50 ms of CPU per second of audio to encode, so it is only worth adding on slow uplinks
+UPSTREAM_ENCODINGS = [encoding for encoding in os.getenv("UPSTREAM_ENCODINGS", "FLAC").split(",") if encoding]
@@ -0,0 +1,66 @@
+import time
+import sqlite3
+import threading
+from text_to_text import TextToText, OpenAIChat, Summarizer
+
+class ConversationLog:
+    def __init__(self, path, conversation="default"):
+        # Append-only: messages are inserted once and never rewritten, so a turn costs one small WAL append.
+        # Summaries are separate records that name the last message they replace. One file can hold many
+        # conversations
+        self.conversation = conversation
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS messages (seq INTEGER PRIMARY KEY, conversation TEXT NOT NULL, role TEXT NOT NULL, "
+            "content TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS summaries (seq INTEGER PRIMARY KEY, conversation TEXT NOT NULL, content TEXT NOT NULL, "
+            "through INTEGER, created REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS messages_conversation ON messages (conversation, seq)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS summaries_conversation ON summaries (conversation, seq)")
+        self.lock = threading.Lock()
+
+    def append(self, role, content):
+        with self.lock:
+            return self.connection.execute(
+                "INSERT INTO messages (conversation, role, content, created) VALUES (?, ?, ?, ?)",
+                (self.conversation, role, content, time.time()),
+            ).lastrowid
+
+    def append_summary(self, summary, through):
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO summaries (conversation, content, through, created) VALUES (?, ?, ?, ?)",
+                (self.conversation, summary, through, time.time()),
+            )
+
+    def recent(self, max_messages=20):
+        # The latest summary and up to max_messages messages after it (all of them if None), read newest first
+        # off the indexes, so resuming costs the same however long the log has grown. Returns (summary, [(seq, message)])
+        with self.lock:
+            summary = self.connection.execute(
+                "SELECT content, through FROM summaries WHERE conversation = ? ORDER BY seq DESC LIMIT 1", (self.conversation,),
+            ).fetchone()
+            through = summary[1] if summary and summary[1] is not None else 0
+            rows = self.connection.execute(
+                "SELECT seq, role, content FROM messages WHERE conversation = ? AND seq > ? ORDER BY seq DESC LIMIT ?",
+                (self.conversation, through, -1 if max_messages is None else max_messages),
+            ).fetchall()
+        return (summary[0] if summary else None), [(seq, {"role": role, "content": content}) for seq, role, content in reversed(rows)]
+
+    def close(self):
+        self.connection.close()
+
+def resume_conversation(log, system_message, max_messages=20, summarize=False, **options):
+    # Rebuilds a TextToText from the tail of the log; new messages go on being appended to it. With summarize,
+    # every message the latest summary does not cover is read back, and whatever does not fit the prompt is
+    # summarized; without it only the last max_messages are kept
+    summary, entries = log.recent(None if summarize else max_messages)
+    engine = options.pop("engine", None) or OpenAIChat(options.get("model", "gpt-3.5-turbo"))
+    return TextToText(messages=[{"role": "system", "content": system_message}] + [message for _, message in entries],
+                      seqs=[seq for seq, _ in entries], summary=summary, log=log, engine=engine,
+                      summarizer=Summarizer(engine, summary=summary) if summarize else None, **options)
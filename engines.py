@@ -0,0 +1,160 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from constants import (
+    KEY_PATH, TTS_CACHE_DIR, SYSTEM_MESSAGE, ENGINE_MODE, PIPER_MODEL_PATH, LLM_FALLBACK_MODEL,
+    CONVERSATION_LOG_PATH, CONVERSATION_ID, CONVERSATION_RESUME_MESSAGES, SUMMARIZE_DROPPED,
+)
+
+logger = logging.getLogger(__name__)
+
+class EngineRegistry:
+    def __init__(self):
+        # Factories take the registry, import their provider inside and build the engine the first time it is
+        # asked for; nothing heavy is imported or connected before then
+        self.factories = {}
+        self.instances = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.build_times = {}
+
+    def register(self, name, factory):
+        with self.lock:
+            self.factories[name] = factory
+            self.instances.pop(name, None)
+            self.locks.setdefault(name, threading.Lock())
+
+    def get(self, name):
+        instance = self.instances.get(name)
+        if instance is not None:
+            return instance
+        # One lock per engine: a caller waits only for the engine it needs, e.g. on a prewarm still building it
+        with self.locks[name]:
+            if name not in self.instances:
+                started = time.perf_counter()
+                self.instances[name] = self.factories[name](self)
+                self.build_times[name] = time.perf_counter() - started
+                logger.debug(f"Built {name} in {self.build_times[name] * 1000:.0f}ms")
+            return self.instances[name]
+
+    def built(self, name):
+        return name in self.instances
+
+    def prewarm(self, *names):
+        # Builds the engines and connects their gRPC channels in the background; returns one future per engine
+        executor = ThreadPoolExecutor(max_workers=len(names) or 1, thread_name_prefix="prewarm")
+        futures = [executor.submit(self.warm, name) for name in names]
+        executor.shutdown(wait=False)
+        return futures
+
+    def warm(self, name, timeout=10):
+        engine = self.get(name)
+        # A routed engine warms every engine it routes between
+        for member in getattr(getattr(engine, "router", None), "engines", [engine]):
+            client = getattr(member, "client", None)
+            transport = getattr(client, "transport", None)
+            channel = getattr(transport, "grpc_channel", None)
+            if channel is not None:
+                import grpc
+                try:
+                    grpc.channel_ready_future(channel).result(timeout=timeout)
+                except grpc.FutureTimeoutError:
+                    logger.warning(f"Timed out warming {name}; it will connect on first use")
+        return engine
+
+    def close(self):
+        for name in ("stt", "google_tts"):
+            if self.built(name):
+                self.instances[name].client.transport.close()
+
+def build_credentials(registry):
+    from google.oauth2 import service_account
+    return service_account.Credentials.from_service_account_file(KEY_PATH)
+
+def build_tts_cache(registry):
+    from text_to_speech import TTSCache
+    return TTSCache(directory=TTS_CACHE_DIR)
+
+def build_stt(registry):
+    from speech_to_text import SpeechToText
+    return SpeechToText(registry.get("credentials"))
+
+def build_language_model(registry):
+    # One engine shared by every conversation: the CLI's, each UI session's and each server session's
+    from text_to_text import OpenAIChat
+    engine = OpenAIChat()
+    if LLM_FALLBACK_MODEL:
+        from router import RoutedLanguageModel
+        engine = RoutedLanguageModel([engine, OpenAIChat(LLM_FALLBACK_MODEL)], budget=8.0)
+    return engine
+
+def build_conversation(registry, conversation=CONVERSATION_ID):
+    # Loading the tokenizer is the slow part of TextToText, and it is cached per model after the first build.
+    # With a conversation log, `conversation` names the conversation that is resumed and appended to
+    from text_to_text import TextToText, Summarizer
+    engine = registry.get("language_model")
+    if CONVERSATION_LOG_PATH:
+        # Picks up where the last run stopped
+        from conversation_log import ConversationLog, resume_conversation
+        log = ConversationLog(CONVERSATION_LOG_PATH, conversation)
+        return resume_conversation(log, SYSTEM_MESSAGE, CONVERSATION_RESUME_MESSAGES, summarize=SUMMARIZE_DROPPED, engine=engine)
+    summarizer = Summarizer(engine) if SUMMARIZE_DROPPED else None
+    return TextToText(messages=[{"role": "system", "content": SYSTEM_MESSAGE}], engine=engine, summarizer=summarizer)
+
+def build_google_tts(registry):
+    from text_to_speech import GoogleCloudTTS
+    return GoogleCloudTTS(registry.get("credentials"), cache=registry.get("tts_cache"))
+
+def build_eleven_labs_tts(registry):
+    from text_to_speech import ElevenLabsTTS
+    return ElevenLabsTTS(cache=registry.get("tts_cache"))
+
+def build_vosk_stt(registry):
+    from local_engines import VoskSpeechToText
+    return VoskSpeechToText()
+
+def build_local_tts(registry):
+    # Piper sounds far better; espeak-ng is the fallback when no Piper voice is installed
+    from local_engines import PiperTTS, EspeakTTS
+    if PIPER_MODEL_PATH:
+        return PiperTTS(cache=registry.get("tts_cache"))
+    return EspeakTTS(cache=registry.get("tts_cache"))
+
+def build_failover_stt(registry):
+    from router import RoutedSpeechToText
+    return RoutedSpeechToText([registry.get("stt"), registry.get("vosk_stt")])
+
+def failover_tts(cloud_name):
+    def build(registry):
+        from router import RoutedTextToSpeech
+        return RoutedTextToSpeech([registry.get(cloud_name), registry.get("local_tts")])
+    return build
+
+def default_registry():
+    registry = EngineRegistry()
+    registry.register("credentials", build_credentials)
+    registry.register("tts_cache", build_tts_cache)
+    registry.register("stt", build_stt)
+    registry.register("language_model", build_language_model)
+    registry.register("conversation", build_conversation)
+    registry.register("google_tts", build_google_tts)
+    registry.register("eleven_labs_tts", build_eleven_labs_tts)
+    registry.register("vosk_stt", build_vosk_stt)
+    registry.register("local_tts", build_local_tts)
+    registry.register("failover_stt", build_failover_stt)
+    registry.register("failover_google_tts", failover_tts("google_tts"))
+    registry.register("failover_eleven_labs_tts", failover_tts("eleven_labs_tts"))
+    return registry
+
+# Engine modes: cloud uses the providers only, local runs entirely on this machine, and failover prefers the
+# cloud but hedges onto or falls back to the local engines when a provider is slow or down
+def stt_name(mode=ENGINE_MODE):
+    return {"cloud": "stt", "local": "vosk_stt", "failover": "failover_stt"}[mode]
+
+def tts_name(use_eleven_labs, mode=ENGINE_MODE):
+    cloud_name = "eleven_labs_tts" if use_eleven_labs else "google_tts"
+    return {"cloud": cloud_name, "local": "local_tts", "failover": f"failover_{cloud_name}"}[mode]
+
+# Shared by every entry point in the process; engines are built once and reused
+registry = default_registry()
@@ -0,0 +1,279 @@
+import time
+import asyncio
+import threading
+import contextlib
+from concurrent.futures import Future
+import numpy as np
+import openai
+from openai.util import convert_to_openai_object
+from google.cloud import speech, texttospeech
+import elevenlabs
+from audio_format import encode_wav, decode_compressed
+from ingest import ingest
+from constants import SAMPLE_RATE_HERTZ
+
+# Deterministic local stand-ins for the cloud services, the microphone and the speaker, used by benchmark.py.
+# Latencies are fixed so two runs on the same machine differ only by the code under test.
+
+TRANSCRIPTS = [
+    "Hi Vivy, how are you today?",
+    "Can you sing me something short?",
+    "What is your favourite song?",
+    "Tell me about the people you have met.",
+]
+REPLY = (
+    "I'm doing wonderfully, thank you for asking! Singing always lifts my spirits. "
+    "Would you like to hear a few lines from my favourite song? I think you'll enjoy it."
+)
+
+def synthetic_speech(utterances=4, speech_duration=1.5, gap_duration=3.0, lead_in=1.5, sample_rate=SAMPLE_RATE_HERTZ, seed=0):
+    # Voiced bursts over a quiet noise floor; the lead-in lets the VAD learn the floor before the first burst
+    rng = np.random.default_rng(seed)
+    total = lead_in + utterances * (speech_duration + gap_duration)
+    samples = rng.normal(0, 30, int(total * sample_rate))
+    t = np.arange(int(speech_duration * sample_rate)) / sample_rate
+    syllables = 0.6 + 0.4 * np.abs(np.sin(2 * np.pi * 3 * t))
+    voice = sum(np.sin(2 * np.pi * f * t) / k for k, f in enumerate((180, 360, 540, 720), 1)) * syllables * 2500
+    for i in range(utterances):
+        start = int((lead_in + i * (speech_duration + gap_duration)) * sample_rate)
+        samples[start:start + len(voice)] += voice
+    return np.clip(samples, -32768, 32767).astype(np.int16)
+
+def tone(duration, sample_rate):
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    return (np.sin(2 * np.pi * 220 * t) * 3000).astype(np.int16)
+
+class VirtualMicrophone:
+    # Stream factory for AudioCapture that plays samples into the capture callback, paced at `speed` x real time
+    def __init__(self, samples, sample_rate=SAMPLE_RATE_HERTZ, speed=1.0):
+        self.samples = samples
+        self.sample_rate = sample_rate
+        self.speed = speed
+        self.finished = threading.Event()
+
+    @classmethod
+    def from_wav(cls, path, speed=1.0):
+        # Any rate, channel count or container the ingest stage reads; played as 16 kHz mono
+        with open(path, "rb") as file:
+            return cls(ingest(file.read()), SAMPLE_RATE_HERTZ, speed)
+
+    @property
+    def duration(self):
+        return len(self.samples) / self.sample_rate
+
+    def __call__(self, samplerate, channels, dtype, blocksize, device, callback):
+        if samplerate != self.sample_rate:
+            raise ValueError(f"Virtual microphone audio is {self.sample_rate} Hz, capture wants {samplerate} Hz")
+        return VirtualInputStream(self, blocksize, callback)
+
+class VirtualInputStream:
+    def __init__(self, microphone, blocksize, callback):
+        self.microphone = microphone
+        self.blocksize = blocksize
+        self.callback = callback
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def active(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        # Once the samples run out the room goes quiet: silence keeps coming until the stream is stopped
+        samples = self.microphone.samples
+        interval = self.blocksize / self.microphone.sample_rate / self.microphone.speed
+        deadline = time.perf_counter()
+        offset = 0
+        while not self.stopped.is_set():
+            block = np.zeros((self.blocksize, 1), dtype=np.int16)
+            chunk = samples[offset:offset + self.blocksize]
+            block[:len(chunk), 0] = chunk
+            offset += self.blocksize
+            if offset >= len(samples):
+                self.microphone.finished.set()
+            self.callback(block, self.blocksize, None, None)
+            deadline += interval
+            time.sleep(max(0.0, deadline - time.perf_counter()))
+
+    def stop(self):
+        self.stopped.set()
+
+    def close(self):
+        pass
+
+class VirtualSpeaker:
+    # Stands in for PlaybackEngine: clips "play" one after another for their duration divided by `speed`
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.busy_until = 0.0
+        self.timers = []
+
+    def play(self, samples, sample_rate):
+        future = Future()
+        with self.lock:
+            now = time.perf_counter()
+            self.busy_until = max(self.busy_until, now) + len(samples) / sample_rate / self.speed
+            timer = threading.Timer(self.busy_until - now, lambda: future.done() or future.set_result(True))
+            self.timers.append((timer, future))
+            timer.start()
+        return future
+
+    def stop(self):
+        with self.lock:
+            timers, self.timers = self.timers, []
+            self.busy_until = 0.0
+        for timer, future in timers:
+            timer.cancel()
+            if not future.done():
+                future.set_result(False)
+
+    @property
+    def is_playing(self):
+        return time.perf_counter() < self.busy_until
+
+    def echo_energy(self):
+        return 0.0
+
+class FakeSpeechClient:
+    # Answers recognize/streaming_recognize like speech.SpeechClient after `latency` plus `real_time_factor`
+    # seconds per second of audio, cycling through `transcripts`
+    def __init__(self, latency=0.15, real_time_factor=0.05, transcripts=TRANSCRIPTS, sample_rate=SAMPLE_RATE_HERTZ):
+        self.latency = latency
+        self.real_time_factor = real_time_factor
+        self.transcripts = transcripts
+        self.sample_rate = sample_rate
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def next_transcript(self):
+        with self.lock:
+            self.count += 1
+            return self.transcripts[(self.count - 1) % len(self.transcripts)]
+
+    def delay(self, content):
+        # Compressed payloads are timed by the audio they hold, not their size
+        if content[:4] in (b"fLaC", b"OggS"):
+            samples, sample_rate = decode_compressed(content)
+            return self.latency + self.real_time_factor * len(samples) / sample_rate
+        return self.latency + self.real_time_factor * len(content) / 2 / self.sample_rate
+
+    @staticmethod
+    def response(transcript):
+        return speech.RecognizeResponse(results=[
+            speech.SpeechRecognitionResult(alternatives=[speech.SpeechRecognitionAlternative(transcript=transcript)])
+        ])
+
+    def recognize(self, config, audio):
+        time.sleep(self.delay(audio.content))
+        return self.response(self.next_transcript())
+
+    def streaming_recognize(self, config, requests):
+        transcript = self.next_transcript()
+        words = transcript.split()
+        for count, request in enumerate(requests, 1):
+            # One more interim word every ten blocks
+            yield speech.StreamingRecognizeResponse(results=[speech.StreamingRecognitionResult(
+                alternatives=[speech.SpeechRecognitionAlternative(transcript=" ".join(words[:count // 10 + 1]))], is_final=False,
+            )])
+        # Only the tail of recognition is left once the client half-closes
+        time.sleep(self.latency)
+        yield speech.StreamingRecognizeResponse(results=[speech.StreamingRecognitionResult(
+            alternatives=[speech.SpeechRecognitionAlternative(transcript=transcript)], is_final=True,
+        )])
+
+class FakeSpeechAsyncClient(FakeSpeechClient):
+    # The speech.SpeechAsyncClient surface used by AsyncSpeechToText
+    class transport:
+        @staticmethod
+        async def close():
+            pass
+
+    async def recognize(self, config, audio):
+        await asyncio.sleep(self.delay(audio.content))
+        return self.response(self.next_transcript())
+
+class FakeTTSClient:
+    # texttospeech.TextToSpeechClient stand-in returning a LINEAR16 WAV of `seconds_per_char` per input character
+    def __init__(self, latency=0.2, seconds_per_char=0.06):
+        self.latency = latency
+        self.seconds_per_char = seconds_per_char
+
+    def synthesize_speech(self, input, voice, audio_config):
+        time.sleep(self.latency)
+        sample_rate = audio_config.sample_rate_hertz or 24000
+        audio = encode_wav(tone(len(input.ssml or input.text) * self.seconds_per_char, sample_rate), sample_rate)
+        return texttospeech.SynthesizeSpeechResponse(audio_content=audio)
+
+class FakeElevenLabs:
+    # elevenlabs.generate stand-in returning raw PCM in the requested pcm_* format
+    def __init__(self, latency=0.3, seconds_per_char=0.06):
+        self.latency = latency
+        self.seconds_per_char = seconds_per_char
+
+    def generate(self, text, voice=None, output_format="pcm_24000", **kwargs):
+        time.sleep(self.latency)
+        encoding, sample_rate = output_format.split("_")[:2]
+        if encoding != "pcm":
+            raise ValueError("FakeElevenLabs only produces pcm_* output")
+        return tone(len(text) * self.seconds_per_char, int(sample_rate)).astype("<i2").tobytes()
+
+class FakeChatCompletion:
+    # openai.ChatCompletion stand-in: the first token after `first_token_latency`, then `tokens_per_second`
+    def __init__(self, first_token_latency=0.35, tokens_per_second=40.0, reply=REPLY):
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.tokens = [word + " " for word in reply.split()]
+
+    def delays(self):
+        yield self.first_token_latency
+        while True:
+            yield 1 / self.tokens_per_second
+
+    @staticmethod
+    def chunk(token):
+        return convert_to_openai_object({"choices": [{"index": 0, "delta": {"content": token}}]})
+
+    def completion(self):
+        return convert_to_openai_object({"choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(self.tokens).strip()}}]})
+
+    def create(self, stream=False, **kwargs):
+        if not stream:
+            time.sleep(self.first_token_latency + len(self.tokens) / self.tokens_per_second)
+            return self.completion()
+
+        def chunks():
+            for token, delay in zip(self.tokens, self.delays()):
+                time.sleep(delay)
+                yield self.chunk(token)
+        return chunks()
+
+    async def acreate(self, stream=False, **kwargs):
+        if not stream:
+            await asyncio.sleep(self.first_token_latency + len(self.tokens) / self.tokens_per_second)
+            return self.completion()
+
+        async def chunks():
+            for token, delay in zip(self.tokens, self.delays()):
+                await asyncio.sleep(delay)
+                yield self.chunk(token)
+        return chunks()
+
+@contextlib.contextmanager
+def patched(chat=None, eleven_labs=None):
+    # Routes openai.ChatCompletion and the elevenlabs calls made by ElevenLabsTTS to the fakes
+    saved = openai.ChatCompletion.create, openai.ChatCompletion.acreate, elevenlabs.generate, elevenlabs.set_api_key
+    chat = chat or FakeChatCompletion()
+    eleven_labs = eleven_labs or FakeElevenLabs()
+    openai.ChatCompletion.create = chat.create
+    openai.ChatCompletion.acreate = chat.acreate
+    elevenlabs.generate = eleven_labs.generate
+    elevenlabs.set_api_key = lambda api_key: None
+    try:
+        yield chat, eleven_labs
+    finally:
+        openai.ChatCompletion.create, openai.ChatCompletion.acreate, elevenlabs.generate, elevenlabs.set_api_key = saved
@@ -0,0 +1,260 @@
+import io
+import math
+import struct
+import logging
+import functools
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from audio_format import decode_wav, decode_pcm16, decode_compressed, decode_mp3
+from constants import SAMPLE_RATE_HERTZ
+
+logger = logging.getLogger(__name__)
+
+# Upload ingest: whatever the client recorded is probed, decoded in-process, downmixed and resampled to the
+# 16 kHz mono int16 that recognition and VAD work on
+
+class AudioTooLong(ValueError):
+    def __init__(self, duration, limit):
+        super().__init__(f"Audio is {duration:.1f}s long, the limit is {limit:.0f}s")
+        self.duration = duration
+
+# Kilobits per second by bitrate index for MPEG-1 layers I-III and MPEG-2/2.5 layer I and layers II-III
+MPEG_BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MPEG_SAMPLE_RATES = {1: (44100, 48000, 32000), 2: (22050, 24000, 16000), 2.5: (11025, 12000, 8000)}
+
+def mpeg_frame(data, offset=0):
+    # Parses an MPEG audio frame header; returns (bitrate in bits/s, sample rate, frame bytes), or None if the bytes
+    # are not one. Free-format and reserved values are rejected
+    head = bytes(data[offset:offset + 4])
+    if len(head) < 4 or head[0] != 0xFF or head[1] & 0xE0 != 0xE0:
+        return None
+    version = {3: 1, 2: 2, 0: 2.5}.get((head[1] >> 3) & 3)
+    layer = 4 - ((head[1] >> 1) & 3)
+    bitrate_index = head[2] >> 4
+    rate_index = (head[2] >> 2) & 3
+    if version is None or layer == 4 or bitrate_index in (0, 15) or rate_index == 3 or head[3] & 3 == 2:
+        return None
+    table = (1, layer) if version == 1 else (2, 1 if layer == 1 else 2)
+    bitrate = MPEG_BITRATES[table][bitrate_index] * 1000
+    sample_rate = MPEG_SAMPLE_RATES[version][rate_index]
+    padding = (head[2] >> 1) & 1
+    if layer == 1:
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        length = (72 if layer == 3 and version != 1 else 144) * bitrate // sample_rate + padding
+    return bitrate, sample_rate, length
+
+def is_mpeg(data):
+    # A plausible header is not enough on its own: a PCM sample of -1 followed by the right byte looks like one.
+    # The next frame has to start where this one ends, unless the upload is shorter than one frame
+    frame = mpeg_frame(data)
+    return frame is not None and (len(data) <= frame[2] + 4 or mpeg_frame(data, frame[2]) is not None)
+
+def id3_size(data):
+    # Length of a leading ID3v2 tag, header included; its size is four 7-bit bytes
+    head = bytes(data[:10])
+    if len(head) < 10 or head[:3] != b"ID3":
+        return 0
+    return 10 + sum((byte & 0x7F) << (7 * (3 - index)) for index, byte in enumerate(head[6:10]))
+
+def probe(data):
+    # Identifies the container from its magic bytes; anything unrecognised is taken as raw 16 kHz int16 PCM
+    head = bytes(data[:12])
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "wav"
+    if head[:4] == b"fLaC":
+        return "flac"
+    if head[:4] == b"OggS":
+        return "ogg"
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return "webm"
+    if head[4:8] == b"ftyp":
+        return "mp4"
+    if head[:3] == b"ID3" or is_mpeg(data):
+        return "mp3"
+    return "pcm"
+
+def wav_duration(data):
+    view = memoryview(data)
+    offset = 12
+    block_align = sample_rate = None
+    while offset + 8 <= len(view):
+        chunk_id = bytes(view[offset:offset + 4])
+        size = int.from_bytes(view[offset + 4:offset + 8], "little")
+        body = offset + 8
+        if chunk_id == b"fmt ":
+            sample_rate, _, block_align = struct.unpack_from("<IIH", view, body + 4)
+        elif chunk_id == b"data" and block_align:
+            return (min(body + size, len(view)) - body) / block_align / sample_rate
+        offset = body + size + (size & 1)
+    return None
+
+def duration(data):
+    # Seconds of audio read off the container header without decoding, or None where the header does not say
+    container = probe(data)
+    if container == "wav":
+        return wav_duration(data)
+    if container in ("flac", "ogg"):
+        import soundfile as sf
+        return sf.info(io.BytesIO(data)).duration
+    if container == "mp3":
+        # Exact for constant bitrate; an estimate from the first frame otherwise
+        frame = mpeg_frame(data, id3_size(data))
+        return None if frame is None else (len(data) - id3_size(data)) * 8 / frame[0]
+    if container == "pcm":
+        return len(data) / 2 / SAMPLE_RATE_HERTZ
+    return None  # WebM from MediaRecorder carries no duration; decode_av stops at the limit instead
+
+def decode_av(data, max_seconds=None):
+    # WebM/Opus from MediaRecorder and MP4/AAC from Safari need FFmpeg's demuxers, through the optional PyAV
+    import av
+    chunks = []
+    frames = 0
+    with av.open(io.BytesIO(data)) as container:
+        stream = container.streams.audio[0]
+        resampler = av.AudioResampler(format="s16")
+        channels = stream.codec_context.channels
+        sample_rate = stream.codec_context.sample_rate
+        for frame in container.decode(stream):
+            chunks.extend(resampler.resample(frame))
+            frames += frame.samples
+            if max_seconds is not None and frames > max_seconds * sample_rate:
+                raise AudioTooLong(frames / sample_rate, max_seconds)
+        chunks.extend(resampler.resample(None))
+    if not chunks:
+        return np.zeros((0, channels), np.int16), sample_rate
+    return np.concatenate([chunk.to_ndarray().reshape(-1, channels) for chunk in chunks]), sample_rate
+
+def decode(data, max_seconds=None):
+    # Returns (frames, channels) samples and their rate. With max_seconds, longer audio is rejected before it is
+    # decoded wherever the header gives its length
+    container = probe(data)
+    if max_seconds is not None:
+        seconds = duration(data)
+        if seconds is not None and seconds > max_seconds:
+            raise AudioTooLong(seconds, max_seconds)
+    if container == "wav":
+        try:
+            return decode_wav(data)
+        except ValueError:
+            return decode_compressed(data)  # 8/24/32-bit and float WAVs go through libsndfile
+    if container in ("flac", "ogg"):
+        return decode_compressed(data)
+    if container in ("webm", "mp4"):
+        return decode_av(data, max_seconds)
+    if container == "mp3":
+        return decode_mp3(data)
+    return decode_pcm16(data), SAMPLE_RATE_HERTZ
+
+def downmix(samples):
+    samples = np.asarray(samples)
+    if samples.ndim == 1:
+        return samples.astype(np.float32)
+    if samples.shape[1] == 1:
+        return samples[:, 0].astype(np.float32)
+    return samples.mean(axis=1, dtype=np.float32)
+
+@functools.lru_cache(maxsize=16)
+def polyphase_filter(up, down, taps, rolloff=0.94, beta=8.0):
+    # Kaiser-windowed sinc low-pass at the upsampled rate, cut at the lower of the two Nyquist rates, split into
+    # `up` phases of `taps` coefficients each. Rows are reversed so they line up with ascending input windows
+    length = up * taps
+    center = length // 2
+    cutoff = rolloff / max(up, down)  # Fraction of the upsampled Nyquist rate
+    t = np.arange(length) - center
+    h = cutoff * np.sinc(cutoff * t) * np.kaiser(length + 1, beta)[:length] * up
+    return np.ascontiguousarray(h.reshape(taps, up).T[:, ::-1]).astype(np.float32)
+
+class Resampler:
+    def __init__(self, rate_in, rate_out=SAMPLE_RATE_HERTZ, taps=32, chunk=32768):
+        # Rational polyphase resampling: every output sample is one dot product of `taps` inputs with one filter
+        # phase, computed for a whole block at once. State carries across process() calls, so a stream can be
+        # resampled block by block with the same result as resampling it whole
+        divisor = math.gcd(rate_in, rate_out)
+        self.up = rate_out // divisor
+        self.down = rate_in // divisor
+        self.taps = taps
+        self.delay = taps * self.up // 2
+        self.filter = polyphase_filter(self.up, self.down, taps)
+        self.chunk = chunk
+        self.buffer = np.zeros(taps, np.float32)  # Silence before the first sample
+        self.start = -taps  # Input index of buffer[0]
+        self.produced = 0
+        self.consumed = 0
+
+    def process(self, samples, final=False):
+        samples = np.asarray(samples, dtype=np.float32).reshape(-1)
+        self.consumed += len(samples)
+        parts = [self.buffer, samples]
+        if final:
+            parts.append(np.zeros(self.taps, np.float32))
+        buffer = np.concatenate(parts)
+        # Output n needs inputs up to (n * down + delay) // up, so only outputs whose inputs have all arrived are made
+        available = self.start + len(buffer)
+        stop = (available * self.up - self.delay - 1) // self.down + 1
+        if final:
+            stop = min(stop, -(-self.consumed * self.up // self.down))
+        windows = sliding_window_view(buffer, self.taps)
+        output = np.empty(max(0, stop - self.produced), np.float32)
+        for offset in range(0, len(output), self.chunk):
+            n = np.arange(self.produced + offset, min(stop, self.produced + offset + self.chunk))
+            position = n * self.down + self.delay
+            rows = windows[position // self.up - self.taps + 1 - self.start]
+            output[offset:offset + len(n)] = np.einsum("ij,ij->i", rows, self.filter[position % self.up])
+        self.produced = max(self.produced, stop)
+        # Keep only the history the next output still needs
+        keep = (self.produced * self.down + self.delay) // self.up - self.taps + 1 - self.start
+        self.buffer = buffer[max(0, keep):]
+        self.start += max(0, keep)
+        return output
+
+def resample(samples, rate_in, rate_out=SAMPLE_RATE_HERTZ):
+    if rate_in == rate_out:
+        return np.asarray(samples, dtype=np.float32)
+    return Resampler(rate_in, rate_out).process(samples, final=True)
+
+def to_int16(samples):
+    return np.clip(np.rint(samples), -32768, 32767).astype(np.int16)
+
+def ingest(data, sample_rate=SAMPLE_RATE_HERTZ, max_seconds=None):
+    # Any supported upload to mono int16 samples at `sample_rate`
+    samples, rate = decode(data, max_seconds)
+    if max_seconds is not None and len(samples) > max_seconds * rate:
+        raise AudioTooLong(len(samples) / rate, max_seconds)
+    channels = samples.shape[1] if samples.ndim > 1 else 1
+    if rate == sample_rate and channels == 1:
+        return np.ascontiguousarray(samples.reshape(-1), dtype=np.int16)
+    logger.debug(f"Converting {probe(data)} audio from {rate} Hz x{channels} to {sample_rate} Hz mono")
+    return to_int16(resample(downmix(samples), rate, sample_rate))
+
+def encode_upstream(samples, sample_rate=SAMPLE_RATE_HERTZ, encodings=("FLAC", "OGG_OPUS")):
+    # Returns (encoding, payload) for the smallest of LINEAR16 and the given compressed encodings; recognition
+    # services decode FLAC and Opus themselves, so a smaller payload is a shorter upload
+    samples = np.asarray(samples, dtype=np.int16).reshape(-1)
+    best = ("LINEAR16", samples.tobytes())
+    for encoding in encodings:
+        try:
+            payload = encode_compressed(samples, sample_rate, encoding)
+        except Exception as e:
+            logger.debug(f"Could not encode {encoding}: {e}")
+            continue
+        if len(payload) < len(best[1]):
+            best = (encoding, payload)
+    return best
+
+def encode_compressed(samples, sample_rate, encoding):
+    import soundfile as sf
+    output = io.BytesIO()
+    if encoding == "FLAC":
+        sf.write(output, samples, sample_rate, format="FLAC", subtype="PCM_16")
+    elif encoding == "OGG_OPUS":
+        sf.write(output, samples, sample_rate, format="OGG", subtype="OPUS")
+    else:
+        raise ValueError(f"Unsupported upstream encoding {encoding}")
+    return output.getvalue()
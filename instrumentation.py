@@ -0,0 +1,193 @@
+import time
+import bisect
+import logging
+import threading
+import contextlib
+import contextvars
+from constants import METRICS_ENABLED, OTEL_ENABLED
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, shared by every stage histogram
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Turn:
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.start = time.perf_counter()
+        self.timings = {}  # First occurrence of each stage in this turn, in seconds
+        self.spans = []  # (stage, start, end) in perf_counter time, for tracing
+        self.failed = False
+
+    def record(self, stage, seconds, start=None):
+        # Every occurrence goes to the histogram; the turn summary keeps the first (e.g. the first sentence's TTS)
+        self.timings.setdefault(stage, seconds)
+        self.metrics.observe(stage, seconds)
+        end = time.perf_counter() if start is None else start + seconds
+        self.spans.append((stage, end - seconds, end))
+
+    def mark(self, stage):
+        # A point in time measured from the start of the turn; only the first mark of a stage counts
+        if stage not in self.timings:
+            self.timings[stage] = time.perf_counter() - self.start
+            self.metrics.observe(stage, self.timings[stage])
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, start)
+
+    def fail(self):
+        self.failed = True
+
+    def finish(self):
+        self.mark("turn")
+        outcome = "Failed turn" if self.failed else "Turn"
+        logger.info(f"{outcome} timings: " + " ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in self.timings.items()))
+        self.metrics.export(self)
+
+class NullTurn:
+    # Stands in for Turn while instrumentation is disabled, so call sites cost one method call
+    timings = {}
+    failed = False
+
+    def record(self, stage, seconds, start=None):
+        pass
+
+    def mark(self, stage):
+        pass
+
+    def span(self, stage):
+        return NULL_SPAN
+
+    def fail(self):
+        pass
+
+    def finish(self):
+        pass
+
+NULL_SPAN = contextlib.nullcontext()
+NULL_TURN = NullTurn()
+
+class Metrics:
+    def __init__(self, enabled=True, tracer=None):
+        self.enabled = enabled
+        self.tracer = tracer
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.turns = 0
+        self.failed_turns = 0
+        self.listeners = []  # Called with every finished Turn, e.g. by the benchmark
+        self.collectors = []  # Called on every render for extra (name, type, help, value) samples, e.g. cache counters
+
+    def turn(self):
+        return Turn(self) if self.enabled else NULL_TURN
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def export(self, turn):
+        with self.lock:
+            self.turns += 1
+            self.failed_turns += turn.failed
+        for listener in self.listeners:
+            listener(turn)
+        if self.tracer is None:
+            return
+        # Spans are emitted once the turn is over, with their recorded timestamps, so tracing adds nothing on the hot path
+        offset = time.time_ns() - int(time.perf_counter() * 1e9)
+        to_ns = lambda seconds: offset + int(seconds * 1e9)
+        end = turn.start + turn.timings["turn"]
+        root = self.tracer.start_span("turn", start_time=to_ns(turn.start))
+        context = trace.set_span_in_context(root)
+        for stage, start, stop in turn.spans:
+            self.tracer.start_span(stage, context=context, start_time=to_ns(start)).end(end_time=to_ns(stop))
+        for stage, seconds in turn.timings.items():
+            root.set_attribute(f"vivy.{stage}_ms", seconds * 1000)
+        root.set_attribute("vivy.failed", turn.failed)
+        root.end(end_time=to_ns(end))
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = [
+            "# HELP vivy_stage_seconds Latency of each conversation stage.",
+            "# TYPE vivy_stage_seconds histogram",
+        ]
+        with self.lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'vivy_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'vivy_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'vivy_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+            lines += [
+                "# HELP vivy_turns_total Finished conversation turns, failed ones included.",
+                "# TYPE vivy_turns_total counter",
+                f"vivy_turns_total {self.turns}",
+                "# HELP vivy_failed_turns_total Conversation turns that ended in an error.",
+                "# TYPE vivy_failed_turns_total counter",
+                f"vivy_failed_turns_total {self.failed_turns}",
+            ]
+        for collector in self.collectors:
+            for name, kind, description, value in collector():
+                lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+def build_tracer():
+    if not OTEL_ENABLED:
+        return None
+    if trace is None:
+        logger.warning("OTEL_ENABLED is set but opentelemetry is not installed; tracing is off")
+        return None
+    return trace.get_tracer("vivy")
+
+metrics = Metrics(METRICS_ENABLED, build_tracer())
+
+# The turn being handled by the current task; tasks created during a turn inherit it
+current_turn = contextvars.ContextVar("current_turn", default=NULL_TURN)
+
+def start_turn(capture_started=None):
+    # A turn is timed from the end of the user's speech; when speech onset is known, capture covers onset to the end
+    turn = metrics.turn()
+    if capture_started is not None:
+        turn.record("capture", time.perf_counter() - capture_started, capture_started)
+    current_turn.set(turn)
+    return turn
+
+@contextlib.contextmanager
+def turn_scope():
+    # A turn that is finished however the block exits; one that raises is counted as failed
+    turn = start_turn()
+    try:
+        yield turn
+    except BaseException:
+        turn.fail()
+        raise
+    finally:
+        turn.finish()
@@ -0,0 +1,150 @@
+import json
+import shutil
+import logging
+import subprocess
+from audio_format import decode_wav, decode_pcm16
+from constants import SAMPLE_RATE_HERTZ, VOSK_MODEL_PATH, PIPER_MODEL_PATH, ESPEAK_VOICE
+from speech_to_text import SpeechEngine, to_linear16
+from text_to_speech import TextToSpeech, TTSCache
+
+logger = logging.getLogger(__name__)
+
+# CPU-only engines that need no network: they keep Vivy talking offline and back up the cloud providers
+
+def raw_linear16(audio):
+    # Local recognizers take bare 16 kHz mono PCM, so a WAV header is stripped and the first channel kept
+    content = to_linear16(audio)
+    if content[:4] == b"RIFF":
+        samples, sample_rate = decode_wav(content)
+        if sample_rate != SAMPLE_RATE_HERTZ:
+            raise ValueError(f"Audio is {sample_rate} Hz, expected {SAMPLE_RATE_HERTZ} Hz")
+        return samples[:, 0].tobytes()
+    return content
+
+class VoskSpeechToText(SpeechEngine):
+    capabilities = {"streaming": True, "local": True, "sample_rate": SAMPLE_RATE_HERTZ}
+
+    def __init__(self, model_path=VOSK_MODEL_PATH, capture=None):
+        # The model is loaded once and shared; every call gets its own recognizer, so calls may run in parallel
+        import vosk
+        super().__init__(capture)
+        vosk.SetLogLevel(-1)
+        self.model = vosk.Model(model_path)
+
+    def recognizer(self):
+        import vosk
+        return vosk.KaldiRecognizer(self.model, SAMPLE_RATE_HERTZ)
+
+    def transcribe_audio(self, audio):
+        try:
+            recognizer = self.recognizer()
+            recognizer.AcceptWaveform(raw_linear16(audio))
+            return json.loads(recognizer.FinalResult())["text"]
+        except Exception as e:
+            logger.error(f"Error in VoskSpeechToText: {e}")
+            raise
+
+    def stream_transcribe(self, blocks, interim_results=True):
+        try:
+            recognizer = self.recognizer()
+            for block in blocks:
+                if recognizer.AcceptWaveform(raw_linear16(block)):
+                    text = json.loads(recognizer.Result())["text"]
+                    if text:
+                        yield text, True
+                elif interim_results:
+                    partial = json.loads(recognizer.PartialResult())["partial"]
+                    if partial:
+                        yield partial, False
+            text = json.loads(recognizer.FinalResult())["text"]
+            if text:
+                yield text, True
+        except Exception as e:
+            logger.error(f"Error in VoskSpeechToText: {e}")
+            raise
+
+class EspeakTTS(TextToSpeech):
+    capabilities = {"streaming": False, "local": True}
+
+    def __init__(self, cache=None, voice=ESPEAK_VOICE, words_per_minute=175):
+        # Formant synthesis: robotic, but a clip takes milliseconds and the binary is a few hundred kilobytes
+        self.executable = shutil.which("espeak-ng") or shutil.which("espeak")
+        if self.executable is None:
+            raise RuntimeError("espeak-ng is not installed")
+        self.cache = cache
+        self.voice = voice
+        self.words_per_minute = words_per_minute
+
+    def generate_audio(self, text: str):
+        try:
+            if self.cache:
+                key = TTSCache.key("espeak", [self.voice, self.words_per_minute], text, "wav")
+                cached = self.cache.get(key)
+                if cached is not None:
+                    return cached
+
+            # Text goes in on stdin and a WAV comes back on stdout; nothing touches the disk
+            result = subprocess.run(
+                [self.executable, "--stdout", "-v", self.voice, "-s", str(self.words_per_minute)],
+                input=text.encode("utf-8"), capture_output=True, check=True,
+            )
+            if self.cache:
+                self.cache.put(key, result.stdout)
+            return result.stdout
+        except Exception as e:
+            logger.error(f"Error in EspeakTTS: {e}")
+            raise
+
+    def decode(self, audio):
+        return decode_wav(audio)
+
+class PiperTTS(TextToSpeech):
+    capabilities = {"streaming": True, "local": True}
+
+    def __init__(self, model_path=PIPER_MODEL_PATH, cache=None, chunk_bytes=8192):
+        # Neural voices that run faster than real time on a laptop CPU. The model's .onnx.json config
+        # carries its sample rate; output is raw 16-bit mono PCM at that rate
+        self.executable = shutil.which("piper")
+        if self.executable is None or not model_path:
+            raise RuntimeError("piper and PIPER_MODEL_PATH are required for PiperTTS")
+        self.model_path = model_path
+        with open(f"{model_path}.json") as config:
+            self.sample_rate = json.load(config)["audio"]["sample_rate"]
+        self.cache = cache
+        self.chunk_bytes = chunk_bytes
+
+    def command(self):
+        return [self.executable, "--model", self.model_path, "--output_raw"]
+
+    def generate_audio(self, text: str):
+        try:
+            if self.cache:
+                key = TTSCache.key("piper", self.model_path, text, f"pcm_{self.sample_rate}")
+                cached = self.cache.get(key)
+                if cached is not None:
+                    return cached
+
+            result = subprocess.run(self.command(), input=text.encode("utf-8"), capture_output=True, check=True)
+            if self.cache:
+                self.cache.put(key, result.stdout)
+            return result.stdout
+        except Exception as e:
+            logger.error(f"Error in PiperTTS: {e}")
+            raise
+
+    def stream_audio(self, text: str):
+        # Piper writes each sentence as soon as it is synthesized, so the first chunk arrives before the clip ends
+        try:
+            with subprocess.Popen(self.command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as process:
+                process.stdin.write(text.encode("utf-8"))
+                process.stdin.close()
+                while chunk := process.stdout.read1(self.chunk_bytes):
+                    yield chunk
+            if process.returncode:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+        except Exception as e:
+            logger.error(f"Error in PiperTTS: {e}")
+            raise
+
+    def decode(self, audio):
+        return decode_pcm16(audio), self.sample_rate
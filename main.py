@@ -1,42 +1,58 @@
 import argparse
-from google.oauth2 import service_account
-from constants import KEY_PATH
-from speech_to_text import SpeechToText
-from text_to_text import TextToText
-from text_to_speech import GoogleCloudTTS, ElevenLabsTTS
+import asyncio
+from engines import registry, stt_name, tts_name
+from constants import ENGINE_MODE
 from logger import logger
 
 if __name__ == "__main__":
     try:
-        credentials = service_account.Credentials.from_service_account_file(KEY_PATH)
-        s2t = SpeechToText(credentials)
-        t2t = TextToText(messages=[{"role": "system", "content": "You are Vivy, the AI songstress from the anime 'Vivy: Fluorite Eye's Song.' You have been transported into the real world and are now here to interact with me as my anime waifu. Let's have a delightful and heartwarming conversation just like in the anime. Be concise in your conversations."}])
-
         parser = argparse.ArgumentParser(description="Process some text and sound options.")
         parser.add_argument("--want_sound", action="store_true", help="Include this flag to enable sound output.")
         parser.add_argument("--use_eleven_labs", action="store_true", help="Use ElevenLabs for TTS instead of Google Cloud.")
         parser.add_argument("--debug", action="store_true", help="Only test TTS.")
+        parser.add_argument("--stream_stt", action="store_true", help="Stream audio to speech recognition while recording.")
+        parser.add_argument("--no_barge_in", action="store_true", help="Play replies through the engine's own player and ignore speech while Vivy talks.")
+        parser.add_argument("--prewarm", action="store_true", help="Build clients and connect to the services while waiting for Enter.")
+        parser.add_argument("--engines", choices=["cloud", "local", "failover"], default=ENGINE_MODE,
+                            help="Cloud providers, local engines only, or cloud with local failover.")
         args = parser.parse_args()
 
-        if args.use_eleven_labs:
-            t2s = ElevenLabsTTS()
-        else:
-            t2s = GoogleCloudTTS(credentials)
+        # Engines are built on first use, so only the ones this run needs are imported and connected
+        tts = tts_name(args.use_eleven_labs, args.engines)
+        needed = [tts] if args.debug else [stt_name(args.engines), "conversation"]
+        if args.want_sound and not args.debug:
+            needed.append(tts)
+        if args.prewarm:
+            registry.prewarm(*needed)
 
         input("Press Enter to start recording...")
-        while True:
-            if args.debug:
-                t2s.synthesize("Checking if debug mode works or not.")
-                break
-            audio_file = s2t.record_audio()
-            print("Recording complete. Transcribing...")
-            prompt = s2t.transcribe_audio(audio_file)
-            print(prompt)
-            text_response = t2t.generate_response(prompt)
-            print(text_response)
-            if args.want_sound:
-                t2s.synthesize(text_response)
+        if args.debug:
+            registry.get(tts).synthesize("Checking if debug mode works or not.")
+        else:
+            from async_pipeline import AsyncSpeechToText, AsyncTextToText, AsyncTextToSpeech, VoicePipeline
+            s2t = registry.get(stt_name(args.engines))
+            t2s = registry.get(tts) if args.want_sound else None
+            # Capture, recognition, generation and playback run as concurrent stages; with sound on,
+            # each sentence is spoken as soon as it is complete instead of after the whole reply.
+            # With barge-in, speaking over Vivy stops her mid-sentence and starts the next turn
+            barge_in = args.want_sound and not args.no_barge_in
+            playback = None
+            if barge_in:
+                from playback import PlaybackEngine
+                playback = PlaybackEngine()
+                s2t.capture.echo_reference = playback.echo_energy
+            # Recognition goes through the registry's engine on the executor, so it uses the channel --prewarm connected
+            pipeline = VoicePipeline(
+                AsyncSpeechToText(s2t),
+                AsyncTextToText(registry.get("conversation")),
+                AsyncTextToSpeech(t2s, playback=playback) if t2s is not None else None,
+                stream_stt=args.stream_stt,
+                barge_in=barge_in,
+            )
+            asyncio.run(pipeline.run())
     except KeyboardInterrupt:
         logger.info("Exiting...")
     except Exception as e:
-        logger.error
+        logger.error(f"Error in main: {e}")
+    finally:
+        registry.close()
@@ -0,0 +1,112 @@
+import threading
+import logging
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
+import sounddevice as sd
+from ingest import downmix, resample, to_int16
+
+logger = logging.getLogger(__name__)
+
+class PlaybackEngine:
+    def __init__(self, block_duration=0.02, device=None):
+        self.block_duration = block_duration
+        self.device = device
+        self.lock = threading.Lock()
+        self.clips = deque()  # (samples, future) waiting to be played, in order
+        self.current = None
+        self.current_future = None
+        self.offset = 0
+        self.stream = None
+        self.sample_rate = None
+        self.channels = None
+        self.level = 0.0  # Mean energy of the last block written to the device
+
+    def play(self, samples, sample_rate):
+        # Queues int16 samples without blocking; the future resolves True when played out, False when stopped
+        samples = samples.reshape(len(samples), -1)
+        samples = self._ensure_stream(samples, sample_rate)
+        future = Future()
+        with self.lock:
+            self.clips.append((samples, future))
+        return future
+
+    def stop(self):
+        # Drops the clip being played and everything queued; the next device callback is already silent
+        with self.lock:
+            pending = [future for _, future in self.clips]
+            if self.current_future is not None:
+                pending.append(self.current_future)
+            self.clips.clear()
+            self.current = None
+            self.current_future = None
+            self.level = 0.0
+        for future in pending:
+            future.set_result(False)
+
+    @property
+    def is_playing(self):
+        return self.current is not None or bool(self.clips)
+
+    def echo_energy(self):
+        return self.level
+
+    def _ensure_stream(self, samples, sample_rate):
+        # Returns the samples in the format of the open stream. The stream is reopened for a new format only when
+        # nothing is queued; while clips are still waiting, the new clip is converted instead so none is dropped
+        channels = samples.shape[1]
+        if self.stream is not None and (sample_rate, channels) == (self.sample_rate, self.channels):
+            return samples
+        if self.stream is not None and self.is_playing:
+            return self._convert(samples, sample_rate)
+        self._close_stream()
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.stream = sd.OutputStream(
+            samplerate=sample_rate, channels=channels, dtype=np.int16,
+            blocksize=int(sample_rate * self.block_duration), device=self.device, callback=self._callback,
+        )
+        self.stream.start()
+        return samples
+
+    def _convert(self, samples, sample_rate):
+        mono = downmix(samples)
+        if sample_rate != self.sample_rate:
+            mono = resample(mono, sample_rate, self.sample_rate)
+        return np.repeat(to_int16(mono)[:, None], self.channels, axis=1)
+
+    def _callback(self, outdata, frames, time_info, status):
+        if status:
+            logger.warning(f"Audio playback status: {status}")
+        finished = []
+        filled = 0
+        with self.lock:
+            while filled < frames:
+                if self.current is None:
+                    if not self.clips:
+                        break
+                    self.current, self.current_future = self.clips.popleft()
+                    self.offset = 0
+                count = min(frames - filled, len(self.current) - self.offset)
+                outdata[filled:filled + count] = self.current[self.offset:self.offset + count]
+                filled += count
+                self.offset += count
+                if self.offset == len(self.current):
+                    finished.append(self.current_future)
+                    self.current = None
+                    self.current_future = None
+            outdata[filled:] = 0
+            block = outdata[:filled].astype(np.float32)
+            self.level = float(np.mean(block * block)) if filled else 0.0
+        for future in finished:
+            future.set_result(True)
+
+    def close(self):
+        self.stop()
+        self._close_stream()
+
+    def _close_stream(self):
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
@@ -0,0 +1,42 @@
+import random
+import asyncio
+import logging
+import openai
+from google.api_core import exceptions as google_exceptions
+
+logger = logging.getLogger(__name__)
+
+# Failures worth another attempt: rate limits, overload and transient network errors. Anything else
+# (bad request, authentication) fails straight away
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.APIConnectionError,
+    openai.error.Timeout, openai.error.TryAgain, openai.error.APIError,
+    google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded, google_exceptions.InternalServerError,
+    ConnectionError, TimeoutError,
+)
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=30.0):
+    # Exponential backoff with full jitter, so clients that were throttled together do not retry together
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+def retry_after(error):
+    # Seconds the provider asked us to wait, from a Retry-After header on the error if it carries one
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after") or headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+async def with_retries(call, retries=4, base_delay=1.0, max_delay=30.0, retryable=RETRYABLE_ERRORS):
+    # Awaits call() until it succeeds, a non-retryable error occurs or `retries` retries are used up
+    for attempt in range(retries + 1):
+        try:
+            return await call()
+        except retryable as e:
+            if attempt == retries:
+                raise
+            # A rate-limited provider's own Retry-After wins over the jittered backoff, up to max_delay
+            delay = min(max_delay, max(backoff_delay(attempt, base_delay, max_delay), retry_after(e) or 0))
+            logger.warning(f"Retrying in {delay:.1f}s after {type(e).__name__}: {e}")
+            await asyncio.sleep(delay)
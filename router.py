@@ -0,0 +1,163 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from audio_format import encode_wav, decode_wav
+from constants import HEDGE_DELAY, FAILOVER_COOLDOWN
+from speech_to_text import SpeechEngine
+from text_to_speech import TextToSpeech
+from text_to_text import LanguageModel
+
+logger = logging.getLogger(__name__)
+
+class EngineRouter:
+    def __init__(self, engines, hedge_delay=HEDGE_DELAY, budget=2.0, cooldown=FAILOVER_COOLDOWN, smoothing=0.3, max_workers=8):
+        # Engines are listed in order of preference and the first healthy one gets each call. If it has not
+        # answered after hedge_delay (by default twice its smoothed latency, or `budget` before it has one) the
+        # next engine is started as well and the first answer wins; if it fails the next takes over at once.
+        # An engine that fails, or whose smoothed latency goes over `budget`, sits out for `cooldown` seconds
+        self.engines = list(engines)
+        self.hedge_delay = hedge_delay
+        self.budget = budget
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self.latency = [None] * len(self.engines)
+        self.down_until = [0.0] * len(self.engines)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="router")
+
+    def name(self, index):
+        return type(self.engines[index]).__name__
+
+    def ranked(self):
+        # Healthy engines in preference order, then the ones sitting out as a last resort
+        now = time.monotonic()
+        with self.lock:
+            return sorted(range(len(self.engines)), key=lambda index: (self.down_until[index] > now, index))
+
+    def observe(self, index, seconds):
+        with self.lock:
+            previous = self.latency[index]
+            latency = seconds if previous is None else previous + self.smoothing * (seconds - previous)
+            self.latency[index] = latency
+        if latency > self.budget:
+            self.mark_down(index, f"smoothed latency {latency:.2f}s is over budget")
+
+    def mark_down(self, index, reason):
+        logger.warning(f"Routing around {self.name(index)} for {self.cooldown:.0f}s: {reason}")
+        with self.lock:
+            self.down_until[index] = time.monotonic() + self.cooldown
+            self.latency[index] = None
+
+    def timed(self, index, method, args):
+        started = time.perf_counter()
+        try:
+            result = getattr(self.engines[index], method)(*args)
+        except Exception as e:
+            self.mark_down(index, f"{type(e).__name__}: {e}")
+            raise
+        self.observe(index, time.perf_counter() - started)
+        return result
+
+    def hedge_after(self, index):
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        latency = self.latency[index]
+        return self.budget if latency is None else min(self.budget, 2 * latency)
+
+    def call(self, method, *args):
+        # Returns (engine, result) from the first engine to answer; calls that lose a hedge finish in the background
+        candidates = self.ranked()
+        pending = {}
+        errors = []
+        deadline = None
+
+        def launch():
+            nonlocal deadline
+            index = candidates.pop(0)
+            pending[self.executor.submit(self.timed, index, method, args)] = index
+            deadline = time.monotonic() + self.hedge_after(index)
+
+        launch()
+        while pending:
+            timeout = max(0.0, deadline - time.monotonic()) if candidates else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                logger.info(f"{method} is slow, hedging on {self.name(candidates[0])}")
+                launch()
+                continue
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    return self.engines[index], future.result()
+                except Exception as e:
+                    errors.append(e)
+                    if candidates:
+                        launch()
+        raise errors[-1]
+
+    def stream(self, method, *args):
+        # Streams are not hedged, but one that fails or ends before its first chunk fails over to the next engine
+        candidates = self.ranked()
+        while candidates:
+            index = candidates.pop(0)
+            started = time.perf_counter()
+            try:
+                iterator = iter(getattr(self.engines[index], method)(*args))
+                first = next(iterator)
+            except StopIteration:
+                self.mark_down(index, "empty stream")
+                if not candidates:
+                    return
+                continue
+            except Exception as e:
+                self.mark_down(index, f"{type(e).__name__}: {e}")
+                if not candidates:
+                    raise
+                continue
+            self.observe(index, time.perf_counter() - started)
+            yield first
+            yield from iterator
+            return
+
+class RoutedSpeechToText(SpeechEngine):
+    capabilities = {"streaming": True, "local": False}
+
+    def __init__(self, engines, capture=None, **router_options):
+        super().__init__(capture)
+        self.router = EngineRouter(engines, **router_options)
+
+    def transcribe_audio(self, audio):
+        return self.router.call("transcribe_audio", audio)[1]
+
+    def stream_transcribe(self, blocks, interim_results=True):
+        # Live audio can only be sent once, so a stream stays on the engine it started on; if that engine
+        # fails, later utterances go elsewhere
+        index = self.router.ranked()[0]
+        try:
+            yield from self.router.engines[index].stream_transcribe(blocks, interim_results)
+        except Exception as e:
+            self.router.mark_down(index, f"{type(e).__name__}: {e}")
+            raise
+
+class RoutedTextToSpeech(TextToSpeech):
+    def __init__(self, engines, **router_options):
+        self.router = EngineRouter(engines, **router_options)
+
+    def generate_audio(self, text: str):
+        # Engines encode differently, so whichever one answers, its clip is handed on as a WAV
+        engine, audio = self.router.call("generate_audio", text)
+        return encode_wav(*engine.decode(audio))
+
+    def decode(self, audio):
+        return decode_wav(audio)
+
+class RoutedLanguageModel(LanguageModel):
+    def __init__(self, engines, **router_options):
+        self.router = EngineRouter(engines, **router_options)
+
+    def complete(self, messages):
+        return self.router.call("complete", messages)[1]
+
+    def stream(self, messages):
+        return self.router.stream("stream", messages)
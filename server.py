@@ -1,17 +1,96 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, BackgroundTasks
-from fastapi.responses import JSONResponse
-import shutil
-import os
-from google.oauth2 import service_account
-from constants import KEY_PATH
-from speech_to_text import SpeechToText
-from text_to_text import TextToText
-from text_to_speech import GoogleCloudTTS, ElevenLabsTTS
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Request, WebSocket, WebSocketDisconnect
+from starlette.websockets import WebSocketState
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from constants import (
+    KEY_PATH, TTS_CACHE_DIR, STT_POOL_SIZE, TTS_POOL_SIZE,
+    SESSION_BACKEND, SESSION_DB_PATH, SESSION_TTL, SESSION_MAX_COUNT, SESSION_MAX_BYTES,
+    STT_CONCURRENCY, LLM_CONCURRENCY, TTS_CONCURRENCY, PROVIDER_RETRIES,
+    MAX_ACTIVE_REQUESTS, MAX_QUEUED_REQUESTS, MAX_QUEUE_WAIT, MAX_UPLOAD_SECONDS, MAX_UPLOAD_BYTES, ENGINE_MODE,
+)
+from admission import AdmissionQueue, AdmissionMiddleware, ProviderGate
+from ingest import ingest, AudioTooLong
+from client_pool import ClientPool, ServiceClients
+from engines import registry, stt_name, tts_name
+from async_pipeline import AsyncSpeechToText, AsyncTextToText, AsyncTextToSpeech
+from streaming import ClientAudio, stream_transcripts, turn_events
+from instrumentation import metrics, turn_scope
+from session_store import SessionStore, MemorySessionBackend, SQLiteSessionBackend
+from text_to_speech import TTSCache
 from logger import logger
 from pydantic import BaseModel
 import asyncio
+import base64
+import itertools
+import json
+import uuid
 
-app = FastAPI()
+SYSTEM_MESSAGE = "You are Vivy, the AI songstress..."
+
+tts_cache = TTSCache(directory=TTS_CACHE_DIR)
+# Local and failover engines share the same cache, so /metrics counts every clip the server serves
+registry.register("tts_cache", lambda registry: tts_cache)
+metrics.collectors.append(tts_cache.samples)
+sessions = SessionStore(
+    SYSTEM_MESSAGE,
+    backend=SQLiteSessionBackend(SESSION_DB_PATH) if SESSION_BACKEND == "sqlite" else MemorySessionBackend(),
+    ttl=SESSION_TTL, max_sessions=SESSION_MAX_COUNT, max_bytes=SESSION_MAX_BYTES,
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.llm_gate = ProviderGate("llm", LLM_CONCURRENCY, PROVIDER_RETRIES)
+    # Sessions share the registry's language model, which fails over to LLM_FALLBACK_MODEL when it is set
+    sessions.engine = registry.get("language_model")
+    google_gate = ProviderGate("google_tts", TTS_CONCURRENCY, PROVIDER_RETRIES)
+    eleven_labs_gate = ProviderGate("eleven_labs_tts", TTS_CONCURRENCY, PROVIDER_RETRIES)
+    clients = None
+    if ENGINE_MODE == "cloud":
+        # Credentials, gRPC channels and TTS clients are built once and shared by every request
+        clients = ServiceClients(KEY_PATH, STT_POOL_SIZE, TTS_POOL_SIZE, tts_cache)
+        # Uploads are recognized on the event loop through one native grpc.aio client, which multiplexes concurrent
+        # calls over its channel; the pooled blocking clients serve the WebSocket's streaming recognition, which
+        # needs a thread per stream. Both are connected before the first request. Each provider has its own gate,
+        # so one that is slow or rate limiting cannot take every request down with it
+        app.state.stt = AsyncSpeechToText(credentials=clients.credentials, gate=ProviderGate("stt", STT_CONCURRENCY, PROVIDER_RETRIES))
+        await asyncio.gather(asyncio.to_thread(clients.warm), app.state.stt.warm())
+        app.state.stt_pool = clients.stt
+        app.state.google_tts = itertools.cycle([AsyncTextToSpeech(t2s, gate=google_gate) for t2s in clients.google_tts.clients])
+        app.state.eleven_labs_tts = AsyncTextToSpeech(clients.eleven_labs_tts, synthesis_workers=TTS_POOL_SIZE, gate=eleven_labs_gate)
+    else:
+        # Local and failover engines are shared, thread-safe instances from the registry, run on executors
+        names = [stt_name(), tts_name(False), tts_name(True)]
+        await asyncio.gather(*(asyncio.wrap_future(future) for future in registry.prewarm(*names)))
+        s2t = registry.get(stt_name())
+        app.state.stt_pool = ClientPool(lambda: s2t, STT_POOL_SIZE)
+        app.state.stt = AsyncSpeechToText(s2t, max_workers=STT_POOL_SIZE, gate=ProviderGate("stt", STT_CONCURRENCY, PROVIDER_RETRIES))
+        app.state.google_tts = itertools.cycle([
+            AsyncTextToSpeech(registry.get(tts_name(False)), synthesis_workers=TTS_POOL_SIZE, gate=google_gate),
+        ])
+        app.state.eleven_labs_tts = AsyncTextToSpeech(registry.get(tts_name(True)), synthesis_workers=TTS_POOL_SIZE, gate=eleven_labs_gate)
+    try:
+        yield
+    finally:
+        await app.state.stt.close()
+        if clients is not None:
+            clients.close()
+        registry.close()
+
+app = FastAPI(lifespan=lifespan)
+# Uploads are admitted before their body is read; past the queue limit they get a 503 straight away
+admission = AdmissionQueue(MAX_ACTIVE_REQUESTS, MAX_QUEUED_REQUESTS, MAX_QUEUE_WAIT)
+app.add_middleware(AdmissionMiddleware, admission=admission, max_upload_bytes=MAX_UPLOAD_BYTES, paths={"/process-audio", "/process-audio/stream"})
+
+def ingest_upload(data):
+    # Any supported container, rate and channel count becomes 16 kHz mono samples before recognition
+    # The length limit is checked on the header before decoding, so a small compressed upload cannot expand
+    # into minutes of audio in memory
+    try:
+        return ingest(data, max_seconds=MAX_UPLOAD_SECONDS)
+    except AudioTooLong as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=415, detail=f"Unsupported audio: {e}")
 
 class AudioInput(BaseModel):
     want_sound: bool
@@ -19,43 +98,111 @@ class AudioInput(BaseModel):
     debug: bool
 
 @app.post("/process-audio")
-async def process_audio(input_data: AudioInput, audio_file: UploadFile = File(...), background_tasks: BackgroundTasks):
+async def process_audio(request: Request, input_data: AudioInput = Depends(), audio_file: UploadFile = File(...)):
     try:
-        # Save the audio file temporarily
-        temp_file = f"temp_{audio_file.filename}"
-        with open(temp_file, "wb") as buffer:
-            shutil.copyfileobj(audio_file.file, buffer)
-
-        # Process the audio file and get the response
-        text_response = await asyncio.to_thread(run_processing, temp_file, input_data)
+        # Conversations continue across requests that send the same X-Session-ID
+        session_id = request.headers.get("X-Session-ID") or uuid.uuid4().hex
 
-        # Schedule the removal of the temporary file
-        background_tasks.add_task(os.remove, temp_file)
+        # Process the upload from memory; nothing is written under a shared temp name
+        audio = await asyncio.to_thread(ingest_upload, await audio_file.read())
+        text_response = await run_processing(request.app.state, audio, input_data, session_id)
 
         # Return the response
-        return JSONResponse(content={"response": text_response})
+        return JSONResponse(content={"response": text_response, "session_id": session_id}, headers={"X-Session-ID": session_id})
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing audio: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-def run_processing(filename: str, input_data: AudioInput):
-    credentials = service_account.Credentials.from_service_account_file(KEY_PATH)
-    s2t = SpeechToText(credentials)
-    t2t = TextToText(messages=[{"role": "system", "content": "You are Vivy, the AI songstress..."}])
-
-    t2s = ElevenLabsTTS() if input_data.use_eleven_labs else GoogleCloudTTS(credentials)
-
+async def run_processing(state, audio, input_data: AudioInput, session_id: str):
     if input_data.debug:
         return "Checking if debug mode works or not."
 
-    print("Transcribing...")
-    prompt = s2t.transcribe_audio(filename)
-    print(prompt)
-    text_response = t2t.generate_response(prompt)
-    print(text_response)
-    
-    if input_data.want_sound:
-        t2s.synthesize(text_response)
+    with turn_scope():
+        print("Transcribing...")
+        prompt = await state.stt.transcribe_audio(audio)
+        print(prompt)
+        async with sessions.asession(session_id) as t2t:
+            text_response = await AsyncTextToText(t2t, gate=state.llm_gate).generate_response(prompt)
+        print(text_response)
+
+        if input_data.want_sound:
+            t2s = state.eleven_labs_tts if input_data.use_eleven_labs else next(state.google_tts)
+            await t2s.synthesize(text_response)
 
     return text_response
+
+def select_tts(state, want_sound: bool, use_eleven_labs: bool):
+    if not want_sound:
+        return None
+    return state.eleven_labs_tts if use_eleven_labs else next(state.google_tts)
+
+@app.post("/process-audio/stream")
+async def process_audio_stream(request: Request, input_data: AudioInput = Depends(), audio_file: UploadFile = File(...)):
+    # Same input as /process-audio, but the reply streams back as newline-delimited JSON events: the transcript,
+    # each response token and each synthesized sentence (base64 PCM) as soon as it exists
+    session_id = request.headers.get("X-Session-ID") or uuid.uuid4().hex
+    state = request.app.state
+    audio = await asyncio.to_thread(ingest_upload, await audio_file.read())
+
+    async def events():
+        # A client that disconnects mid-reply closes the generator, which also counts as a failed turn
+        with turn_scope() as turn:
+            try:
+                prompt = await state.stt.transcribe_audio(audio)
+                yield json.dumps({"type": "transcript", "text": prompt, "final": True}) + "\n"
+                async with sessions.asession(session_id) as t2t:
+                    async for event in turn_events(t2t, prompt, select_tts(state, input_data.want_sound, input_data.use_eleven_labs), state.llm_gate):
+                        if event["type"] == "audio":
+                            event["data"] = base64.b64encode(event["data"]).decode("ascii")
+                        yield json.dumps(event) + "\n"
+            except Exception as e:
+                logger.error(f"Error streaming audio response: {e}")
+                turn.fail()
+                yield json.dumps({"type": "error", "detail": str(e)}) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson", headers={"X-Session-ID": session_id})
+
+@app.websocket("/ws/converse")
+async def converse(websocket: WebSocket, want_sound: bool = True, use_eleven_labs: bool = False, session_id: str = None):
+    # The client sends 16 kHz mono int16 PCM as binary frames. Transcripts and tokens come back as JSON messages;
+    # each synthesized sentence is an "audio" JSON header followed by one binary frame of PCM
+    await websocket.accept()
+    state = websocket.app.state
+    session_id = session_id or uuid.uuid4().hex
+    await websocket.send_json({"type": "session", "session_id": session_id})
+    client_audio = ClientAudio(websocket, max_duration=MAX_UPLOAD_SECONDS)
+    try:
+        while client_audio.connected:
+            finals = []
+            async for transcript, is_final in stream_transcripts(state.stt_pool, client_audio.utterance()):
+                await websocket.send_json({"type": "transcript", "text": transcript, "final": is_final})
+                if is_final:
+                    finals.append(transcript.strip())
+            prompt = " ".join(finals)
+            if not prompt or not client_audio.connected:
+                continue
+            with turn_scope():
+                async with sessions.asession(session_id) as t2t:
+                    async for event in turn_events(t2t, prompt, select_tts(state, want_sound, use_eleven_labs), state.llm_gate):
+                        data = event.pop("data", None)
+                        await websocket.send_json(event)
+                        if data is not None:
+                            await websocket.send_bytes(data)
+    except Exception as e:
+        # A send to a client that has already gone fails as well; such a socket is not closed a second time
+        if isinstance(e, (WebSocketDisconnect, OSError)):
+            client_audio.connected = False
+        if client_audio.connected and WebSocketState.CONNECTED == websocket.client_state == websocket.application_state:
+            logger.error(f"Error in conversation socket: {e}")
+            try:
+                await websocket.close(code=1011)
+            except (RuntimeError, OSError) as close_error:
+                logger.debug(f"Could not close conversation socket: {close_error}")
+
+@app.get("/metrics")
+async def get_metrics():
+    # Per-stage latency histograms and TTS cache counters for Prometheus to scrape
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
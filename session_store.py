@@ -0,0 +1,139 @@
+import json
+import zlib
+import time
+import sqlite3
+import asyncio
+import threading
+import contextlib
+import weakref
+from collections import OrderedDict
+from text_to_text import TextToText
+
+class MemorySessionBackend:
+    def __init__(self):
+        # Ordered by last update, so the least recently used session is always first
+        self.sessions = OrderedDict()
+        self.total_bytes = 0
+
+    def get(self, session_id):
+        return self.sessions.get(session_id)
+
+    def put(self, session_id, updated, payload):
+        self.delete(session_id)
+        self.sessions[session_id] = (updated, payload)
+        self.total_bytes += len(payload)
+
+    def delete(self, session_id):
+        entry = self.sessions.pop(session_id, None)
+        if entry is not None:
+            self.total_bytes -= len(entry[1])
+
+    def expire(self, cutoff):
+        while self.sessions:
+            session_id, (updated, _) = next(iter(self.sessions.items()))
+            if updated >= cutoff:
+                break
+            self.delete(session_id)
+
+    def evict(self, max_sessions, max_bytes):
+        while self.sessions and (len(self.sessions) > max_sessions or self.total_bytes > max_bytes):
+            self.delete(next(iter(self.sessions)))
+
+class SQLiteSessionBackend:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, updated REAL, payload BLOB)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+
+    def get(self, session_id):
+        row = self.connection.execute("SELECT updated, payload FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return None if row is None else (row[0], bytes(row[1]))
+
+    def put(self, session_id, updated, payload):
+        self.connection.execute("INSERT OR REPLACE INTO sessions (id, updated, payload) VALUES (?, ?, ?)", (session_id, updated, payload))
+
+    def delete(self, session_id):
+        self.connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def expire(self, cutoff):
+        self.connection.execute("DELETE FROM sessions WHERE updated < ?", (cutoff,))
+
+    def evict(self, max_sessions, max_bytes):
+        count, total_bytes = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM sessions").fetchone()
+        if count <= max_sessions and total_bytes <= max_bytes:
+            return
+        # Walk from the least recently used session and drop until both limits hold
+        drop = []
+        for session_id, size in self.connection.execute("SELECT id, LENGTH(payload) FROM sessions ORDER BY updated"):
+            if count <= max_sessions and total_bytes <= max_bytes:
+                break
+            drop.append((session_id,))
+            count -= 1
+            total_bytes -= size
+        self.connection.executemany("DELETE FROM sessions WHERE id = ?", drop)
+
+class SessionStore:
+    def __init__(self, system_message, backend=None, ttl=3600, max_sessions=10000, max_bytes=64 * 1024 * 1024, engine=None):
+        # Every session's TextToText talks to `engine`, by default a plain OpenAIChat
+        self.system_message = system_message
+        self.engine = engine
+        self.backend = backend or MemorySessionBackend()
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.session_locks = weakref.WeakValueDictionary()
+        self.async_session_locks = weakref.WeakValueDictionary()
+
+    @staticmethod
+    def encode(messages):
+        # The system message is shared by every session and is not stored; history is compact JSON, deflated
+        history = [[message["role"], message["content"]] for message in messages if message["role"] != "system"]
+        return zlib.compress(json.dumps(history, separators=(",", ":")).encode("utf-8"))
+
+    @staticmethod
+    def decode(payload):
+        return [{"role": role, "content": content} for role, content in json.loads(zlib.decompress(payload))]
+
+    def load(self, session_id):
+        now = time.time()
+        with self.lock:
+            entry = self.backend.get(session_id)
+        history = []
+        if entry is not None and now - entry[0] <= self.ttl:
+            history = self.decode(entry[1])
+        return TextToText(messages=[{"role": "system", "content": self.system_message}] + history, engine=self.engine)
+
+    def save(self, session_id, t2t):
+        now = time.time()
+        payload = self.encode(t2t.messages)
+        with self.lock:
+            self.backend.put(session_id, now, payload)
+            self.backend.expire(now - self.ttl)
+            self.backend.evict(self.max_sessions, self.max_bytes)
+
+    @contextlib.contextmanager
+    def session(self, session_id):
+        # Turns of one session run one at a time so concurrent requests cannot drop each other's messages
+        with self.lock:
+            session_lock = self.session_locks.get(session_id)
+            if session_lock is None:
+                session_lock = threading.Lock()
+                self.session_locks[session_id] = session_lock
+        with session_lock:
+            t2t = self.load(session_id)
+            yield t2t
+            self.save(session_id, t2t)
+
+    @contextlib.asynccontextmanager
+    async def asession(self, session_id):
+        # Event-loop variant of session(): waits on an asyncio lock and keeps backend I/O off the loop
+        session_lock = self.async_session_locks.get(session_id)
+        if session_lock is None:
+            session_lock = asyncio.Lock()
+            self.async_session_locks[session_id] = session_lock
+        async with session_lock:
+            t2t = await asyncio.to_thread(self.load, session_id)
+            yield t2t
+            await asyncio.to_thread(self.save, session_id, t2t)
@@ -0,0 +1,33 @@
+import re
+
+SENTENCE_BOUNDARY = re.compile(r"[.!?]+[\"')\]]*\s+|\n+")
+CLAUSE_BOUNDARY = re.compile(r"[,;:—]\s+")
+
+class SentenceChunker:
+    # Cuts streamed text into speakable chunks at sentence ends, or at clause breaks once a chunk runs long
+    def __init__(self, min_chars=20, clause_chars=80):
+        self.min_chars = min_chars
+        self.clause_chars = clause_chars
+        self.buffer = ""
+
+    def feed(self, token):
+        self.buffer += token
+        chunks = []
+        while True:
+            cut = None
+            for boundary, min_chars in ((SENTENCE_BOUNDARY, self.min_chars), (CLAUSE_BOUNDARY, self.clause_chars)):
+                for match in boundary.finditer(self.buffer):
+                    if match.end() >= min_chars:
+                        cut = match.end()
+                        break
+                if cut:
+                    break
+            if cut is None:
+                return chunks
+            chunk, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+            if chunk:
+                chunks.append(chunk)
+
+    def flush(self):
+        chunk, self.buffer = self.buffer.strip(), ""
+        return [chunk] if chunk else []
@@ -1,80 +1,117 @@
-import sounddevice as sd
-import soundfile as sf
 import numpy as np
-import time
 import logging
+from abc import ABC, abstractmethod
 from google.cloud import speech
-from constants import SAMPLE_RATE_HERTZ, LANGUAGE_CODE
+from audio_capture import AudioCapture
+from audio_format import decode_pcm16
+from constants import SAMPLE_RATE_HERTZ, LANGUAGE_CODE, UPSTREAM_ENCODINGS
+from ingest import encode_upstream, to_int16
 
 logger = logging.getLogger(__name__)
 
-class SpeechToText:
-    def __init__(self, credentials):
-        self.client = speech.SpeechClient(credentials=credentials)
+class SpeechEngine(ABC):
+    # A recognizer for 16 kHz int16 mono speech. Engines implement transcribe_audio and, when they can,
+    # stream_transcribe; microphone capture is shared by all of them
+    capabilities = {"streaming": False, "local": False, "sample_rate": SAMPLE_RATE_HERTZ}
 
-    def record_audio(self, max_duration=10, chunk_duration=0.5, silence_duration=1.5, energy_ratio_threshold=1.5, initialization_chunks=2):
+    def __init__(self, capture=None):
+        self.capture = capture or AudioCapture(SAMPLE_RATE_HERTZ)
+
+    @abstractmethod
+    def transcribe_audio(self, audio):
+        pass
+
+    def stream_transcribe(self, blocks, interim_results=True):
+        # Engines without streaming recognition transcribe the whole utterance once it ends
+        yield self.transcribe_audio(b"".join(to_linear16(block) for block in blocks)), True
+
+    def record_audio(self, max_duration=10, silence_duration=0.8, energy_ratio_threshold=1.5, initialization_duration=1.0):
         try:
             print("Preparing to record audio...")
-            
-            chunk_size = int(SAMPLE_RATE_HERTZ * chunk_duration)
-            recording = False
-            audio_data = []
-            silence_counter = 0
-            start_time = time.time()
-
-            # Initialize long_term_energy with the energy of a few initial silence chunks
-            initial_chunks = []
-            for _ in range(initialization_chunks):
-                chunk = sd.rec(chunk_size, samplerate=SAMPLE_RATE_HERTZ, channels=1, dtype=np.int16, blocking=True)
-                chunk = np.squeeze(chunk)
-                initial_chunks.append(chunk)
-            long_term_energy = np.sum(np.concatenate(initial_chunks).astype(np.float64) ** 2) / len(np.concatenate(initial_chunks))
-
-            while True:
-                chunk = sd.rec(chunk_size, samplerate=SAMPLE_RATE_HERTZ, channels=1, dtype=np.int16, blocking=True)
-                chunk = np.squeeze(chunk)
-                short_term_energy = np.sum(chunk.astype(np.float64) ** 2) / len(chunk)
-
-                if short_term_energy > long_term_energy * energy_ratio_threshold:
-                    if not recording:
-                        recording = True
-                        print("Speech detected, start recording...")
-                        start_time = time.time()
-                    audio_data.append(chunk)
-                    silence_counter = 0
-                elif recording:
-                    silence_counter += chunk_duration
-                    audio_data.append(chunk)
-                    if silence_counter >= silence_duration:
-                        print("Silence detected, stop recording...")
-                        break
-                if time.time() - start_time >= max_duration:
-                    print("Max duration reached, stop recording...")
-                    break
-            
-            audio_data = np.concatenate(audio_data, axis=0)
-            audio_file = "recorded_audio.wav"
-            sf.write(audio_file, audio_data, SAMPLE_RATE_HERTZ)
-
-            return audio_file  # Return the path to the recorded audio file
+            # The utterance stays in memory as int16 samples; transcribe_audio sends it without a WAV round trip
+            return next(self.utterances(max_duration, silence_duration, energy_ratio_threshold, initialization_duration))
         except Exception as e:
             logger.error(f"Error in record_audio: {e}")
             raise
 
-    def transcribe_audio(self, audio_file):
-        try:
-            with open(audio_file, "rb") as file:
-                content = file.read()
+    def utterances(self, max_duration=10, silence_duration=0.8, energy_ratio_threshold=1.5, initialization_duration=1.0,
+                   on_speech_start=None):
+        # Yields each utterance as an int16 array as soon as it ends; the input stream stays open between calls
+        return self.capture.utterances(max_duration, silence_duration, energy_ratio_threshold, initialization_duration,
+                                       on_speech_start=on_speech_start)
 
-            audio = speech.RecognitionAudio(content=content)
-            config = speech.RecognitionConfig(
-                encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-                sample_rate_hertz=SAMPLE_RATE_HERTZ,
-                language_code=LANGUAGE_CODE,
-            )
+    def close(self):
+        self.capture.stop()
 
+    def listen(self, on_interim=None, **capture_options):
+        # Records one utterance while streaming it to the recognizer and returns the final transcript
+        finals = []
+        for transcript, is_final in self.stream_transcribe(self.capture.stream_utterance(**capture_options)):
+            if is_final:
+                finals.append(transcript.strip())
+            elif on_interim:
+                on_interim(transcript)
+        return " ".join(finals)
+
+class SpeechToText(SpeechEngine):
+    capabilities = {"streaming": True, "local": False, "sample_rate": SAMPLE_RATE_HERTZ}
+
+    def __init__(self, credentials, client=None, capture=None):
+        # A prebuilt client (e.g. on a channel to a local fake servicer) can be passed in instead of credentials
+        super().__init__(capture)
+        self.client = client or speech.SpeechClient(credentials=credentials)
+
+    def transcribe_audio(self, audio):
+        try:
+            config, audio = recognition_request(audio)
             response = self.client.recognize(config=config, audio=audio)
             return response.results[0].alternatives[0].transcript
         except Exception as e:
             logger.error(f"Error in transcribe_audio: {e}")
             raise
+
+    def stream_transcribe(self, blocks, interim_results=True):
+        # Sends audio blocks as they arrive and yields (transcript, is_final); the request stream half-closes
+        # when `blocks` is exhausted, so the final result follows end of speech by about one round trip
+        try:
+            streaming_config = speech.StreamingRecognitionConfig(config=recognition_config(), interim_results=interim_results)
+            requests = (speech.StreamingRecognizeRequest(audio_content=to_linear16(block)) for block in blocks)
+            for response in self.client.streaming_recognize(config=streaming_config, requests=requests):
+                for result in response.results:
+                    if result.alternatives:
+                        yield result.alternatives[0].transcript, result.is_final
+        except Exception as e:
+            logger.error(f"Error in stream_transcribe: {e}")
+            raise
+
+def recognition_config(encoding="LINEAR16"):
+    return speech.RecognitionConfig(
+        encoding=speech.RecognitionConfig.AudioEncoding[encoding],
+        sample_rate_hertz=SAMPLE_RATE_HERTZ,
+        language_code=LANGUAGE_CODE,
+    )
+
+def recognition_request(audio):
+    # WAV bytes go up as they are, their header describes them; raw 16 kHz samples go up in the smallest encoding
+    content = to_linear16(audio)
+    encoding = "LINEAR16"
+    if content[:4] != b"RIFF" and UPSTREAM_ENCODINGS:
+        encoding, content = encode_upstream(decode_pcm16(content).reshape(-1), SAMPLE_RATE_HERTZ, UPSTREAM_ENCODINGS)
+    return recognition_config(encoding), speech.RecognitionAudio(content=content)
+
+def to_linear16(audio):
+    # Builds the LINEAR16 request payload from samples, raw/WAV bytes, a file-like stream or a path, copying at most once
+    if isinstance(audio, bytes):
+        return audio
+    if isinstance(audio, np.ndarray):
+        if np.issubdtype(audio.dtype, np.floating):
+            audio = to_int16(audio * 32767)  # Normalized [-1, 1] samples, as sounddevice records by default
+        elif audio.dtype != np.int16:
+            audio = audio.astype(np.int16)
+        return audio.tobytes()
+    if isinstance(audio, (bytearray, memoryview)):
+        return bytes(audio)
+    if hasattr(audio, "read"):
+        return audio.read()
+    with open(audio, "rb") as file:
+        return file.read()
@@ -0,0 +1,152 @@
+import asyncio
+import contextlib
+import json
+import queue
+import logging
+from fastapi import WebSocketDisconnect
+from async_pipeline import AsyncTextToText
+from instrumentation import current_turn
+from audio_format import decode_pcm16
+from speech_pipeline import SentenceChunker
+from vad import EnergyVAD
+from constants import SAMPLE_RATE_HERTZ
+from ingest import Resampler, to_int16
+
+logger = logging.getLogger(__name__)
+
+async def stream_transcripts(stt_pool, blocks):
+    # Bridges an async source of PCM blocks into the blocking gRPC streaming call of a pooled SpeechToText,
+    # yielding (transcript, is_final) as soon as the recognizer sends them
+    loop = asyncio.get_running_loop()
+    requests = queue.Queue()
+    results = asyncio.Queue()
+    done = object()
+
+    def recognize():
+        try:
+            with stt_pool.borrow() as s2t:
+                for result in s2t.stream_transcribe(iter(requests.get, None)):
+                    loop.call_soon_threadsafe(results.put_nowait, result)
+        except Exception as e:
+            loop.call_soon_threadsafe(results.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(results.put_nowait, done)
+
+    async def feed():
+        try:
+            async for block in blocks:
+                requests.put(block)
+        finally:
+            requests.put(None)
+
+    recognizer = loop.run_in_executor(None, recognize)
+    feeder = asyncio.ensure_future(feed())
+    try:
+        while (result := await results.get()) is not done:
+            if isinstance(result, Exception):
+                raise result
+            yield result
+        await feeder
+    finally:
+        feeder.cancel()
+        requests.put(None)
+        await recognizer
+
+async def turn_events(t2t, prompt, tts=None, llm_gate=None):
+    # Yields token events while the reply streams and audio events as soon as each sentence is synthesized;
+    # audio stays in sentence order and interleaves with the tokens that follow it
+    events = asyncio.Queue()
+    synthesis = asyncio.Queue()
+
+    async def generate():
+        chunker = SentenceChunker()
+        try:
+            async with contextlib.aclosing(AsyncTextToText(t2t, gate=llm_gate).stream_response(prompt)) as tokens:
+                async for token in tokens:
+                    await events.put({"type": "token", "text": token})
+                    if tts is not None:
+                        for chunk in chunker.feed(token):
+                            await synthesis.put(asyncio.ensure_future(tts.generate_audio(chunk)))
+            if tts is not None:
+                for chunk in chunker.flush():
+                    await synthesis.put(asyncio.ensure_future(tts.generate_audio(chunk)))
+        except Exception as e:
+            await events.put(e)
+        finally:
+            await synthesis.put(None)
+
+    async def forward_audio():
+        try:
+            while (pending := await synthesis.get()) is not None:
+                samples, sample_rate = await tts.decode(await pending)
+                await events.put({
+                    "type": "audio", "encoding": "pcm_s16le", "sample_rate": sample_rate,
+                    "channels": samples.shape[1], "data": samples.tobytes(),
+                })
+        except Exception as e:
+            await events.put(e)
+        finally:
+            await events.put(None)
+
+    tasks = [asyncio.ensure_future(generate())]
+    if tts is not None:
+        tasks.append(asyncio.ensure_future(forward_audio()))
+    else:
+        tasks[0].add_done_callback(lambda _: events.put_nowait(None))
+    try:
+        while (event := await events.get()) is not None:
+            if isinstance(event, Exception):
+                raise event
+            if event["type"] == "audio":
+                current_turn.get().mark("first_audio")
+            yield event
+        yield {"type": "done", "response": t2t.history[-1]["content"] if t2t.history else ""}
+    finally:
+        for task in tasks:
+            task.cancel()
+
+class ClientAudio:
+    # Reads one utterance of mono int16 PCM from a WebSocket; it ends on an {"type": "end"} message, when
+    # the server-side VAD hears the speaker stop, or once it reaches max_duration seconds. Audio is 16 kHz unless
+    # the client announces its rate with {"type": "format", "sample_rate": ...}, in which case it is resampled here
+    def __init__(self, websocket, vad=None, max_duration=None):
+        self.websocket = websocket
+        self.vad = vad or EnergyVAD(initialization_duration=0.3)
+        self.max_bytes = int(max_duration * SAMPLE_RATE_HERTZ * 2) if max_duration else None
+        self.resampler = None
+        self.connected = True
+
+    async def utterance(self):
+        heard_speech = False
+        received = 0
+        while True:
+            try:
+                message = await self.websocket.receive()
+            except WebSocketDisconnect:
+                self.connected = False
+                return
+            if message["type"] == "websocket.disconnect":
+                self.connected = False
+                return
+            if message.get("bytes"):
+                block = message["bytes"]
+                if self.resampler is not None:
+                    block = to_int16(self.resampler.process(decode_pcm16(block).reshape(-1))).tobytes()
+                    if not block:
+                        continue
+                received += len(block)
+                yield block
+                if self.max_bytes is not None and received >= self.max_bytes:
+                    logger.warning(f"Utterance cut at {received} bytes")
+                    return
+                active = self.vad.process(decode_pcm16(block).reshape(-1))
+                heard_speech = heard_speech or active.any()
+                if heard_speech and len(active) and not active[-1]:
+                    return
+            elif message.get("text"):
+                event = json.loads(message["text"])
+                if event.get("type") == "end":
+                    return
+                if event.get("type") == "format":
+                    rate = int(event["sample_rate"])
+                    self.resampler = Resampler(rate, SAMPLE_RATE_HERTZ) if rate != SAMPLE_RATE_HERTZ else None
@@ -0,0 +1,177 @@
+import asyncio
+import json
+import pytest
+import retry
+from admission import AdmissionQueue, AdmissionMiddleware, Overloaded, ProviderGate, SingleFlight
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def test_requests_past_the_queue_are_turned_away():
+    async def main():
+        admission = AdmissionQueue(max_active=1, max_queued=1, max_wait=1.0)
+        release = asyncio.Event()
+
+        async def hold():
+            async with admission.admit():
+                await release.wait()
+
+        active = asyncio.ensure_future(hold())
+        queued = asyncio.ensure_future(hold())
+        await asyncio.sleep(0.01)
+        with pytest.raises(Overloaded, match="queue is full"):
+            async with admission.admit():
+                pass
+        release.set()
+        await asyncio.gather(active, queued)
+        # Both slots were given back
+        assert not admission.semaphore.locked()
+        assert admission.waiting == 0
+
+    run(main())
+
+def test_queued_requests_give_up_after_max_wait():
+    async def main():
+        admission = AdmissionQueue(max_active=1, max_queued=4, max_wait=0.05)
+        async with admission.admit():
+            with pytest.raises(Overloaded, match="Timed out"):
+                async with admission.admit():
+                    pass
+        assert admission.waiting == 0
+
+    run(main())
+
+def test_slot_is_released_when_the_request_fails():
+    async def main():
+        admission = AdmissionQueue(max_active=1, max_queued=0, max_wait=0.05)
+        with pytest.raises(ValueError):
+            async with admission.admit():
+                raise ValueError("boom")
+        async with admission.admit():
+            pass
+
+    run(main())
+
+def test_identical_calls_share_one_result():
+    async def main():
+        flights = SingleFlight()
+        calls = 0
+
+        async def call():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.02)
+            return object()
+
+        results = await asyncio.gather(*(flights.do("key", call) for _ in range(5)))
+        assert calls == 1
+        assert all(result is results[0] for result in results)
+        # Once it has finished, the next call runs again
+        await flights.do("key", call)
+        assert calls == 2
+
+    run(main())
+
+def test_a_waiter_giving_up_does_not_cancel_the_shared_call():
+    async def main():
+        flights = SingleFlight()
+        finished = asyncio.Event()
+
+        async def call():
+            await asyncio.sleep(0.02)
+            finished.set()
+            return "done"
+
+        impatient = asyncio.ensure_future(flights.do("key", call))
+        patient = asyncio.ensure_future(flights.do("key", call))
+        await asyncio.sleep(0.005)
+        impatient.cancel()
+        assert await patient == "done"
+        assert finished.is_set()
+
+    run(main())
+
+def test_gate_bounds_concurrency():
+    async def main():
+        gate = ProviderGate("test", concurrency=2)
+        running = peak = 0
+
+        async def call():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*(gate.call(call) for _ in range(6)))
+        assert peak == 2
+
+    run(main())
+
+def test_gate_releases_its_slot_while_backing_off(monkeypatch):
+    monkeypatch.setattr(retry, "backoff_delay", lambda *args: 0.05)
+
+    async def main():
+        gate = ProviderGate("test", concurrency=1, retries=1)
+        attempts = 0
+
+        async def flaky():
+            nonlocal attempts
+            attempts += 1
+            if attempts == 1:
+                raise ConnectionError("transient")
+            return "stream"
+
+        async def other():
+            await asyncio.sleep(0.01)
+            return await gate.call(lambda: asyncio.sleep(0, "other"))
+
+        waiting = asyncio.ensure_future(other())
+        async with gate.opened(flaky) as stream:
+            # The other call got the only slot while the stream was backing off
+            assert waiting.done() and waiting.result() == "other"
+            assert stream == "stream"
+            assert gate.semaphore.locked()
+        assert not gate.semaphore.locked()
+
+    run(main())
+
+class Responses:
+    def __init__(self):
+        self.messages = []
+
+    async def __call__(self, message):
+        self.messages.append(message)
+
+    @property
+    def status(self):
+        return self.messages[0]["status"]
+
+    @property
+    def body(self):
+        return json.loads(self.messages[1]["body"])
+
+async def ok_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+def request(length):
+    return {"type": "http", "path": "/upload", "headers": [(b"content-length", length)]}
+
+@pytest.mark.parametrize("length, status", [(b"10", 200), (b"101", 413), (b"abc", 400), (b"-5", 400)])
+def test_middleware_checks_content_length(length, status):
+    responses = Responses()
+    middleware = AdmissionMiddleware(ok_app, AdmissionQueue(), max_upload_bytes=100, paths={"/upload"})
+    run(middleware(request(length), None, responses))
+    assert responses.status == status
+
+def test_middleware_answers_503_when_overloaded():
+    async def main():
+        admission = AdmissionQueue(max_active=1, max_queued=0, max_wait=0.05)
+        responses = Responses()
+        async with admission.admit():
+            await AdmissionMiddleware(ok_app, admission, 100, {"/upload"})(request(b"10"), None, responses)
+        assert responses.status == 503
+        assert (b"retry-after", b"1") in responses.messages[0]["headers"]
+
+    run(main())
@@ -0,0 +1,14 @@
+import numpy as np
+from audio_capture import AudioCapture
+from fakes import VirtualMicrophone, synthetic_speech
+
+def test_streamed_utterances_share_the_noise_floor():
+    # Two 1.5 s utterances 0.9 s apart: the second starts well inside the 1 s a fresh VAD would spend calibrating
+    samples = synthetic_speech(2, speech_duration=1.5, gap_duration=0.9, lead_in=1.5)
+    capture = AudioCapture(stream_factory=VirtualMicrophone(samples, speed=10.0))
+    with capture:
+        first = np.concatenate(list(capture.stream_utterance(silence_duration=0.5)))
+        second = np.concatenate(list(capture.stream_utterance(silence_duration=0.5)))
+    assert capture.vad is not None
+    assert len(first) >= 1.5 * 16000
+    assert len(second) >= 1.5 * 16000
@@ -0,0 +1,83 @@
+import pytest
+import text_to_text
+from conversation_log import ConversationLog, resume_conversation
+from text_to_text import TextToText, LanguageModel, Summarizer
+
+@pytest.fixture(autouse=True)
+def estimated_token_counts(monkeypatch):
+    # Budgets below are sized for the estimate, so the tokenizer is kept out whether or not it can be loaded
+    monkeypatch.setattr(text_to_text, "get_encoding", lambda model: None)
+
+class Recorder(LanguageModel):
+    # Summaries list the messages they were given, so tests can see what was folded in
+    def __init__(self):
+        self.requests = []
+
+    def complete(self, messages):
+        self.requests.append(messages)
+        return "summary of " + messages[-1]["content"].split("New messages:\n")[-1].replace("\n", " | ")
+
+def message_text(index):
+    return f"message {index} " + "x" * 100
+
+def filled_log(count, summary_through=None):
+    log = ConversationLog(":memory:")
+    for index in range(1, count + 1):
+        log.append("user" if index % 2 else "assistant", message_text(index))
+    if summary_through is not None:
+        log.append_summary("earlier summary", summary_through)
+    return log
+
+def finish_summaries(t2t):
+    for future in list(t2t.pending_summaries):
+        future.result()
+
+def test_recent_reads_messages_after_the_latest_summary():
+    log = filled_log(10, summary_through=6)
+    summary, entries = log.recent(max_messages=3)
+    assert summary == "earlier summary"
+    assert [seq for seq, _ in entries] == [8, 9, 10]
+    assert [seq for seq, _ in log.recent(max_messages=None)[1]] == [7, 8, 9, 10]
+
+def test_new_messages_are_appended_with_their_sequence_numbers():
+    log = filled_log(4)
+    t2t = resume_conversation(log, "system", engine=Recorder())
+    t2t.add_prompt("hello")
+    assert list(t2t.history_seqs) == [1, 2, 3, 4, 5]
+    assert log.recent(max_messages=1)[1] == [(5, {"role": "user", "content": "hello"})]
+
+def test_resume_summarizes_everything_that_does_not_fit():
+    # Messages 20-24 follow a summary through 19; only the newest two fit the prompt
+    log = filled_log(24, summary_through=19)
+    engine = Recorder()
+    t2t = resume_conversation(log, "system", max_messages=2, summarize=True, engine=engine, max_prompt_tokens=110)
+    assert list(t2t.history_seqs) == [23, 24]
+    finish_summaries(t2t)
+    assert len(engine.requests) == 1
+    folded = engine.requests[0][-1]["content"]
+    assert "Summary so far: earlier summary" in folded
+    assert all(message_text(index) in folded for index in (20, 21, 22))
+    # The summary is picked up, and logged as covering up to message 22, with the next message
+    t2t.add_prompt("next")
+    summary, entries = log.recent(max_messages=None)
+    assert summary.startswith("summary of")
+    assert [seq for seq, _ in entries] == [23, 24, 25]
+    assert log.connection.execute("SELECT through FROM summaries ORDER BY seq DESC LIMIT 1").fetchone() == (22,)
+
+def test_resume_without_summaries_keeps_the_last_messages():
+    log = filled_log(24, summary_through=19)
+    t2t = resume_conversation(log, "system", max_messages=2, engine=Recorder())
+    assert list(t2t.history_seqs) == [23, 24]
+    assert t2t.summary_message["content"].endswith("earlier summary")
+
+def test_trimmed_messages_are_summarized_in_batches():
+    engine = Recorder()
+    seeds = [{"role": "user", "content": message_text(index)} for index in range(100)]
+    t2t = TextToText([{"role": "system", "content": "system"}] + seeds, engine=engine,
+                     summarizer=Summarizer(engine), seqs=list(range(1, 101)), max_prompt_tokens=200)
+    finish_summaries(t2t)
+    assert len(t2t.history) < 100
+    dropped = 100 - len(t2t.history)
+    assert len(engine.requests) == -(-dropped // 40)
+    t2t.add_prompt("next")
+    assert t2t.messages[1]["content"].startswith("Summary of the conversation so far")
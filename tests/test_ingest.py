@@ -0,0 +1,77 @@
+import io
+import numpy as np
+import pytest
+import soundfile as sf
+from audio_format import encode_wav
+from ingest import probe, duration, ingest, Resampler, resample, encode_upstream, AudioTooLong
+
+MPEG_FRAME = bytes([0xFF, 0xFB, 0x90, 0x00]) + bytes(413)  # MPEG-1 layer III, 128 kb/s, 44.1 kHz: 417 bytes
+
+def sine(frequency, sample_rate, seconds, amplitude=10000.0):
+    return amplitude * np.sin(2 * np.pi * frequency * np.arange(int(sample_rate * seconds)) / sample_rate)
+
+def flac(samples, sample_rate):
+    output = io.BytesIO()
+    sf.write(output, samples, sample_rate, format="FLAC")
+    return output.getvalue()
+
+def test_probe_containers():
+    samples = np.zeros(1600, np.int16)
+    assert probe(encode_wav(samples, 16000)) == "wav"
+    assert probe(flac(samples, 16000)) == "flac"
+    assert probe(MPEG_FRAME * 3) == "mp3"
+    assert probe(b"ID3" + bytes(20)) == "mp3"
+    assert probe(samples.tobytes()) == "pcm"
+
+def test_probe_does_not_take_pcm_for_mp3():
+    # A first sample of -1 is 0xFFFF, which has the MPEG sync bits
+    assert probe(np.array([-1, 5, 7, -3] * 4000, np.int16).tobytes()) == "pcm"
+    assert probe(np.array([-1, 100] + [3] * 2000, np.int16).tobytes()) == "pcm"
+    rng = np.random.default_rng(0)
+    quiet = [rng.integers(-3, 3, 64).astype(np.int16).tobytes() for _ in range(2000)]
+    assert all(probe(data) == "pcm" for data in quiet)
+
+def test_blockwise_resampling_matches_whole():
+    samples = sine(440, 48000, 1.0) + sine(3000, 48000, 1.0, 2000)
+    whole = resample(samples, 48000, 16000)
+    resampler = Resampler(48000, 16000)
+    blocks = [resampler.process(samples[start:start + 1234]) for start in range(0, len(samples), 1234)]
+    blocks.append(resampler.process(np.zeros(0), final=True))
+    assert np.array_equal(np.concatenate(blocks), whole)
+
+@pytest.mark.parametrize("rate_in", [8000, 22050, 44100, 48000])
+def test_resampling_keeps_length_and_tone(rate_in):
+    output = resample(sine(440, rate_in, 1.0), rate_in, 16000)
+    assert len(output) == 16000
+    expected = sine(440, 16000, 1.0)
+    # Away from the edges the resampled tone matches one synthesized at 16 kHz
+    assert np.max(np.abs(output[200:-200] - expected[200:-200])) < 50
+
+def test_ingest_downmixes_and_resamples():
+    stereo = np.stack([sine(440, 48000, 0.5), sine(440, 48000, 0.5)], axis=1).astype(np.int16)
+    samples = ingest(encode_wav(stereo, 48000))
+    assert samples.dtype == np.int16
+    assert samples.shape == (8000,)
+
+def test_ingest_passes_raw_pcm_through():
+    samples = np.arange(-800, 800, dtype=np.int16)
+    assert np.array_equal(ingest(samples.tobytes()), samples)
+
+def test_duration_is_read_from_the_header():
+    samples = np.zeros(16000 * 3, np.int16)
+    assert duration(encode_wav(samples, 16000)) == pytest.approx(3.0)
+    assert duration(flac(samples, 16000)) == pytest.approx(3.0)
+    assert duration(samples.tobytes()) == pytest.approx(3.0)
+    assert duration(MPEG_FRAME * 100) == pytest.approx(100 * 1152 / 44100, rel=0.01)
+
+def test_long_uploads_are_rejected_before_decoding():
+    with pytest.raises(AudioTooLong):
+        ingest(flac(np.zeros(16000 * 3, np.int16), 16000), max_seconds=2)
+    assert len(ingest(flac(np.zeros(16000 * 3, np.int16), 16000), max_seconds=3)) == 16000 * 3
+
+def test_encode_upstream_picks_the_smallest_payload():
+    speech = sine(300, 16000, 1.0).astype(np.int16)
+    encoding, payload = encode_upstream(speech, 16000, ("FLAC",))
+    assert encoding == "FLAC"
+    assert len(payload) < speech.nbytes
+    assert encode_upstream(speech, 16000, ())[0] == "LINEAR16"
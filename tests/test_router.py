@@ -0,0 +1,73 @@
+import time
+import pytest
+from router import EngineRouter
+
+class Engine:
+    def __init__(self, reply, delay=0.0, error=None, chunks=None):
+        self.reply = reply
+        self.delay = delay
+        self.error = error
+        self.chunks = chunks
+        self.calls = 0
+
+    def complete(self, messages):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.reply
+
+    def stream(self, messages):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        yield from self.chunks if self.chunks is not None else [self.reply]
+
+def test_first_healthy_engine_answers():
+    first, second = Engine("first"), Engine("second")
+    engine, result = EngineRouter([first, second], hedge_delay=1.0).call("complete", [])
+    assert (engine, result) == (first, "first")
+    assert second.calls == 0
+
+def test_failure_fails_over_and_sits_out():
+    first, second = Engine("first", error=ConnectionError("down")), Engine("second")
+    router = EngineRouter([first, second], hedge_delay=1.0)
+    assert router.call("complete", []) == (second, "second")
+    # The failed engine is ranked last until its cooldown ends
+    assert router.ranked() == [1, 0]
+    assert router.call("complete", []) == (second, "second")
+    assert first.calls == 1
+
+def test_every_engine_failing_raises_the_last_error():
+    router = EngineRouter([Engine("a", error=ValueError("a")), Engine("b", error=ValueError("b"))], hedge_delay=1.0)
+    with pytest.raises(ValueError, match="b"):
+        router.call("complete", [])
+
+def test_slow_engine_is_hedged():
+    slow, fast = Engine("slow", delay=0.5), Engine("fast")
+    started = time.perf_counter()
+    assert EngineRouter([slow, fast], hedge_delay=0.05).call("complete", []) == (fast, "fast")
+    assert time.perf_counter() - started < 0.4
+    assert slow.calls == 1
+
+def test_latency_over_budget_marks_engine_down():
+    first, second = Engine("first", delay=0.05), Engine("second")
+    router = EngineRouter([first, second], hedge_delay=1.0, budget=0.01)
+    router.call("complete", [])
+    assert router.ranked() == [1, 0]
+
+def test_stream_fails_over_before_first_chunk():
+    first, second = Engine("first", error=ConnectionError("down")), Engine("second", chunks=["a", "b"])
+    router = EngineRouter([first, second])
+    assert list(router.stream("stream", [])) == ["a", "b"]
+    assert router.ranked() == [1, 0]
+
+def test_empty_stream_fails_over():
+    first, second = Engine("first", chunks=[]), Engine("second", chunks=["a"])
+    router = EngineRouter([first, second])
+    assert list(router.stream("stream", [])) == ["a"]
+    assert router.ranked() == [1, 0]
+
+def test_empty_stream_from_last_engine_ends_the_stream():
+    router = EngineRouter([Engine("a", chunks=[]), Engine("b", chunks=[])])
+    assert list(router.stream("stream", [])) == []
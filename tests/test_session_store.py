@@ -0,0 +1,100 @@
+import asyncio
+import pytest
+import session_store
+import text_to_text
+from session_store import SessionStore, MemorySessionBackend, SQLiteSessionBackend
+from text_to_text import LanguageModel
+
+class Echo(LanguageModel):
+    def complete(self, messages):
+        return "reply"
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+@pytest.fixture(autouse=True)
+def no_tokenizer(monkeypatch):
+    monkeypatch.setattr(text_to_text, "get_encoding", lambda model: None)
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(session_store.time, "time", clock.time)
+    return clock
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request):
+    return MemorySessionBackend() if request.param == "memory" else SQLiteSessionBackend(":memory:")
+
+def store(backend, **options):
+    return SessionStore("system", backend=backend, engine=Echo(), **options)
+
+def talk(sessions, session_id, text):
+    with sessions.session(session_id) as t2t:
+        t2t.add_prompt(text)
+        t2t.add_response("reply")
+
+def history(sessions, session_id):
+    return [message["content"] for message in sessions.load(session_id).history]
+
+def test_history_survives_between_turns(backend, clock):
+    sessions = store(backend)
+    talk(sessions, "a", "hello")
+    talk(sessions, "a", "again")
+    assert history(sessions, "a") == ["hello", "reply", "again", "reply"]
+    assert history(sessions, "b") == []
+
+def test_sessions_expire_after_their_ttl(backend, clock):
+    sessions = store(backend, ttl=60)
+    talk(sessions, "a", "hello")
+    clock.now += 30
+    assert history(sessions, "a") == ["hello", "reply"]
+    clock.now += 31
+    assert history(sessions, "a") == []
+    # Expired sessions are also dropped from the backend on the next save
+    talk(sessions, "b", "hi")
+    assert backend.get("a") is None
+
+def test_least_recently_used_session_is_evicted_past_the_count(backend, clock):
+    sessions = store(backend, max_sessions=2)
+    for session_id in ("a", "b", "c"):
+        clock.now += 1
+        talk(sessions, session_id, session_id)
+    assert backend.get("a") is None
+    assert backend.get("b") is not None and backend.get("c") is not None
+    clock.now += 1
+    talk(sessions, "b", "b again")  # b is now the most recent, so c goes next
+    clock.now += 1
+    talk(sessions, "d", "d")
+    assert backend.get("c") is None
+    assert backend.get("b") is not None
+
+def test_sessions_are_evicted_past_the_byte_cap(backend, clock):
+    size = len(SessionStore.encode([{"role": "user", "content": "x" * 200}, {"role": "assistant", "content": "reply"}]))
+    sessions = store(backend, max_bytes=size * 2)
+    for session_id in ("a", "b", "c"):
+        clock.now += 1
+        with sessions.session(session_id) as t2t:
+            t2t.add_prompt("x" * 200)
+            t2t.add_response("reply")
+    assert backend.get("a") is None
+    assert backend.get("b") is not None and backend.get("c") is not None
+
+def test_concurrent_turns_of_one_session_keep_every_message(clock):
+    sessions = store(MemorySessionBackend())
+
+    async def turn(text):
+        async with sessions.asession("a") as t2t:
+            t2t.add_prompt(text)
+            await asyncio.sleep(0.01)
+            t2t.add_response("reply")
+
+    async def main():
+        await asyncio.gather(*(turn(f"prompt {index}") for index in range(5)))
+
+    asyncio.run(main())
+    assert len(history(sessions, "a")) == 10
@@ -0,0 +1,54 @@
+import pytest
+import text_to_text
+from text_to_text import TextToText, LanguageModel, TOKENS_PER_REPLY
+
+@pytest.fixture(autouse=True)
+def estimated_token_counts(monkeypatch):
+    # Budgets below are sized for the estimate, so the tokenizer is kept out whether or not it can be loaded
+    monkeypatch.setattr(text_to_text, "get_encoding", lambda model: None)
+
+class Echo(LanguageModel):
+    def complete(self, messages):
+        return "reply to " + messages[-1]["content"]
+
+def conversation(**options):
+    return TextToText([{"role": "system", "content": "system"}], engine=Echo(), **options)
+
+def test_running_count_matches_a_full_recount():
+    t2t = conversation()
+    for index in range(5):
+        t2t.generate_response(f"prompt {index} " + "x" * index * 10)
+    assert t2t.token_count == t2t.count_tokens(t2t.messages)
+
+def test_oldest_messages_are_trimmed_to_the_budget():
+    t2t = conversation(max_prompt_tokens=120)
+    for index in range(20):
+        t2t.generate_response(f"prompt {index} " + "x" * 40)
+    assert t2t.token_count <= 120
+    assert t2t.token_count == t2t.count_tokens(t2t.messages)
+    assert t2t.messages[0]["content"] == "system"
+    assert t2t.messages[-1]["content"] == "reply to prompt 19 " + "x" * 40
+    assert len(t2t.history) == len(t2t.history_counts) == len(t2t.history_seqs)
+
+def test_latest_message_is_kept_even_over_budget():
+    t2t = conversation(max_prompt_tokens=20)
+    t2t.add_prompt("y" * 400)
+    assert [message["content"] for message in t2t.history] == ["y" * 400]
+
+def test_budget_leaves_room_for_the_completion():
+    t2t = TextToText([{"role": "system", "content": "system"}], model="gpt-4", engine=Echo(),
+                     max_prompt_tokens=100000, completion_reserve=512)
+    assert t2t.max_prompt_tokens == 8192 - 512
+
+def test_empty_conversation_counts_system_message_and_reply_priming():
+    t2t = conversation()
+    assert t2t.token_count == t2t.message_tokens(t2t.system_message) + TOKENS_PER_REPLY
+
+def test_prompts_are_always_from_the_user():
+    t2t = conversation()
+    t2t.add_prompt("first")
+    t2t.discard_prompt()
+    t2t.add_prompt("second")
+    t2t.add_prompt("third")
+    assert [message["role"] for message in t2t.history] == ["user", "user"]
+    assert t2t.token_count == t2t.count_tokens(t2t.messages)
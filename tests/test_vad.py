@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from vad import EnergyVAD, detect_segments
+
+SAMPLE_RATE = 16000
+
+def clip(lead_in, speech=1.5, tail=1.0, seed=0):
+    # Voiced speech over a faint noise floor, as archived utterance clips are cut
+    rng = np.random.default_rng(seed)
+    samples = rng.normal(0, 30, int((lead_in + speech + tail) * SAMPLE_RATE))
+    t = np.arange(int(speech * SAMPLE_RATE)) / SAMPLE_RATE
+    voice = sum(np.sin(2 * np.pi * f * t) / k for k, f in enumerate((180, 360, 540, 720), 1)) * 2500
+    start = int(lead_in * SAMPLE_RATE)
+    samples[start:start + len(voice)] += voice * (0.6 + 0.4 * np.abs(np.sin(2 * np.pi * 3 * t)))
+    return np.clip(samples, -32768, 32767).astype(np.int16)
+
+@pytest.mark.parametrize("lead_in", [0.0, 0.05, 0.3, 1.5])
+def test_clips_that_open_with_speech_keep_their_opening(lead_in):
+    segments = detect_segments(clip(lead_in))
+    assert len(segments) == 1
+    start, end = segments[0]
+    assert start <= max(0, lead_in - 0.1) * SAMPLE_RATE + 320  # Pre-roll reaches back before the onset
+    assert end >= (lead_in + 1.5) * SAMPLE_RATE
+
+def test_separate_utterances_stay_separate():
+    samples = np.concatenate([clip(0.05, tail=1.5), clip(0.0, seed=1)])
+    assert len(detect_segments(samples)) == 2
+
+def test_silence_has_no_segments():
+    assert detect_segments(np.random.default_rng(0).normal(0, 30, SAMPLE_RATE * 2).astype(np.int16)) == []
+
+def test_streaming_floor_carries_over_between_utterances():
+    vad = EnergyVAD(SAMPLE_RATE)
+    vad.process(clip(1.0, speech=0.5))
+    # A calibrated VAD hears speech in the very first frames it is given
+    assert vad.process(clip(0.0, speech=0.5, tail=0.0))[:5].all()
@@ -1,55 +1,281 @@
-from abc import abstractmethod
-import io
-from google.cloud import texttospeech
-from elevenlabs import set_api_key, Voice, VoiceSettings, generate, play as play_eleven
-from pydub import AudioSegment
-from pydub.playback import play as play_pydub
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import tempfile
 import logging
+from audio_format import decode_wav, decode_pcm16, decode_compressed, decode_mp3
 from constants import LANGUAGE_CODE, ELEVEN_LABS_API_KEY
 import threading
 
 logger = logging.getLogger(__name__)
 
-class TextToSpeech:
+class TTSCache:
+    def __init__(self, max_memory_bytes=32 * 1024 * 1024, directory=None, max_disk_bytes=256 * 1024 * 1024):
+        self.max_memory_bytes = max_memory_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.disk_bytes = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith(".audio"))
+
+    @staticmethod
+    def key(engine, voice, text, encoding):
+        # Whitespace differences do not change the spoken audio, so they do not change the key either
+        normalized = " ".join(text.split())
+        payload = json.dumps([engine, voice, normalized, encoding], sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.bytes_served += len(data)
+                return data
+        data = self._read_disk(key)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self.bytes_served += len(data)
+        self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        self._remember(key, data)
+        if self.directory:
+            self._write_disk(key, data)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                "bytes_served": self.bytes_served, "memory_bytes": self.memory_bytes,
+                "disk_bytes": self.disk_bytes, "entries": len(self.entries),
+            }
+
+    def samples(self):
+        # The stats as Prometheus samples: a hit is a clip served with no call to the provider
+        stats = self.stats()
+        return [
+            ("vivy_tts_cache_hits_total", "counter", "TTS clips served from memory.", stats["hits"]),
+            ("vivy_tts_cache_disk_hits_total", "counter", "TTS clips served from the disk cache.", stats["disk_hits"]),
+            ("vivy_tts_cache_misses_total", "counter", "TTS clips that had to be synthesized.", stats["misses"]),
+            ("vivy_tts_cache_served_bytes_total", "counter", "Bytes of audio served from the cache.", stats["bytes_served"]),
+            ("vivy_tts_cache_memory_bytes", "gauge", "Bytes of audio held in memory.", stats["memory_bytes"]),
+            ("vivy_tts_cache_disk_bytes", "gauge", "Bytes of audio held on disk.", stats["disk_bytes"]),
+            ("vivy_tts_cache_entries", "gauge", "Clips held in memory.", stats["entries"]),
+        ]
+
+    def _remember(self, key, data):
+        if len(data) > self.max_memory_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.memory_bytes -= len(previous)
+            self.entries[key] = data
+            self.memory_bytes += len(data)
+            while self.memory_bytes > self.max_memory_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.memory_bytes -= len(evicted)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.audio")
+
+    def _read_disk(self, key):
+        if not self.directory:
+            return None
+        try:
+            # One read into the bytes that are served; clips are small, so mapping the file would only add a copy
+            with open(self._path(key), "rb") as file:
+                data = file.read()
+            os.utime(self._path(key))  # Recency for size-based eviction
+            return data
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, key, data):
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        # A unique temp file, so processes sharing the directory never write into each other's
+        descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+        with self.lock:
+            self.disk_bytes += len(data)
+            if self.disk_bytes <= self.max_disk_bytes:
+                return
+            files = sorted(
+                (entry for entry in os.scandir(self.directory) if entry.name.endswith(".audio")),
+                key=lambda entry: entry.stat().st_mtime,
+            )
+            for entry in files:
+                if self.disk_bytes <= self.max_disk_bytes:
+                    break
+                try:
+                    size = entry.stat().st_size
+                    os.remove(entry.path)
+                    self.disk_bytes -= size
+                except FileNotFoundError:
+                    pass
+
+class TextToSpeech(ABC):
+    # Engines return one encoded clip per call from generate_audio and know how to decode their own clips
+    capabilities = {"streaming": False, "local": False}
+
     @abstractmethod
+    def generate_audio(self, text: str):
+        pass
+
+    def stream_audio(self, text: str):
+        # Engines that can stream yield encoded chunks as they are synthesized; the rest yield the whole clip
+        yield self.generate_audio(text)
+
     def synthesize(self, text: str):
+        self.play(self.generate_audio(text))
+
+    @abstractmethod
+    def decode(self, audio):
+        # Returns int16 samples shaped (frames, channels) and the sample rate
         pass
 
+    def play(self, audio):
+        # Plays in-process through sounddevice; no player subprocess
+        import sounddevice as sd
+        samples, sample_rate = self.decode(audio)
+        sd.play(samples, sample_rate, blocking=True)
+
 class GoogleCloudTTS(TextToSpeech):
-    def __init__(self, credentials):
-        self.client = texttospeech.TextToSpeechClient(credentials=credentials)
+    def __init__(self, credentials, cache=None, audio_encoding="LINEAR16", sample_rate=24000, client=None):
+        # LINEAR16 arrives as a WAV that is played straight from the response buffer; OGG_OPUS is smaller on the
+        # wire and decodes in-process; MP3 is kept as a fallback and needs ffmpeg
+        # Provider SDKs are imported when an engine is built, so only the engine in use is loaded
+        from google.cloud import texttospeech
+        self.client = client or texttospeech.TextToSpeechClient(credentials=credentials)
+        self.cache = cache
+        self.voice_name = "en-US-Wavenet-F"
+        self.audio_encoding = audio_encoding
+        self.sample_rate = sample_rate
 
-    def synthesize(self, text_response):
+    def generate_audio(self, text_response):
         try:
+            if self.cache:
+                key = TTSCache.key("google", {"language_code": LANGUAGE_CODE, "name": self.voice_name}, text_response,
+                                   f"{self.audio_encoding}_{self.sample_rate}")
+                cached = self.cache.get(key)
+                if cached is not None:
+                    return cached
+
+            from google.cloud import texttospeech
             input_text = texttospeech.SynthesisInput(ssml=text_response)
             voice_params = texttospeech.VoiceSelectionParams(
-                language_code=LANGUAGE_CODE, name="en-US-Wavenet-F", ssml_gender=texttospeech.SsmlVoiceGender.FEMALE
+                language_code=LANGUAGE_CODE, name=self.voice_name, ssml_gender=texttospeech.SsmlVoiceGender.FEMALE
+            )
+            audio_config = texttospeech.AudioConfig(
+                audio_encoding=texttospeech.AudioEncoding[self.audio_encoding], sample_rate_hertz=self.sample_rate
             )
-            audio_config = texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.MP3)
             response = self.client.synthesize_speech(input=input_text, voice=voice_params, audio_config=audio_config)
+            if self.cache:
+                self.cache.put(key, response.audio_content)
+            return response.audio_content
+        except Exception as e:
+            logger.error(f"Error in GoogleCloudTTS: {e}")
+            raise
+
+    def decode(self, audio):
+        if self.audio_encoding == "LINEAR16":
+            return decode_wav(audio)
+        if self.audio_encoding == "MP3":
+            return decode_mp3(audio)
+        return decode_compressed(audio)
 
-            # Play the audio directly without saving it to a file
-            audio_data = response.audio_content
-            audio = AudioSegment.from_mp3(io.BytesIO(audio_data))
-            play_pydub(audio)
+    def play(self, audio_data):
+        try:
+            super().play(audio_data)
         except Exception as e:
             logger.error(f"Error in GoogleCloudTTS: {e}")
             raise
 
 class ElevenLabsTTS(TextToSpeech):
-    def __init__(self):
-        set_api_key(ELEVEN_LABS_API_KEY)
+    capabilities = {"streaming": True, "local": False}
 
-    def synthesize(self, text: str):
+    def __init__(self, cache=None, output_format="pcm_24000"):
+        import elevenlabs
+        if ELEVEN_LABS_API_KEY:
+            elevenlabs.set_api_key(ELEVEN_LABS_API_KEY)
+        self.cache = cache
+        # pcm_* formats are raw 16-bit mono at the named rate; mp3_* is the fallback
+        self.output_format = output_format
+        self.voice = elevenlabs.Voice(
+            voice_id='KavW1Pkc0hhhh7ge60Uk',
+            settings=elevenlabs.VoiceSettings(stability=0.71, similarity_boost=0.5, style=0.0, use_speaker_boost=True)
+        )
+
+    def cache_key(self, text):
+        return TTSCache.key("elevenlabs", [self.voice.voice_id, self.voice.settings.stability, self.voice.settings.similarity_boost, self.voice.settings.style, self.voice.settings.use_speaker_boost], text, self.output_format)
+
+    def generate_audio(self, text: str):
         try:
-            audio = generate(
-            text=text,
-            voice=Voice(
-                    voice_id='KavW1Pkc0hhhh7ge60Uk',
-                    settings=VoiceSettings(stability=0.71, similarity_boost=0.5, style=0.0, use_speaker_boost=True)
-                )
-            )
-            play_eleven(audio)
+            if self.cache:
+                key = self.cache_key(text)
+                cached = self.cache.get(key)
+                if cached is not None:
+                    return cached
+
+            import elevenlabs
+            audio = elevenlabs.generate(text=text, voice=self.voice, output_format=self.output_format)
+            if self.cache:
+                self.cache.put(key, audio)
+            return audio
+        except Exception as e:
+            logger.error(f"Error in ElevenLabsTTS: {e}")
+            raise
+
+    def stream_audio(self, text: str):
+        # Yields the clip in chunks as ElevenLabs sends them; joined, the chunks are the same bytes generate_audio returns
+        try:
+            if self.cache:
+                key = self.cache_key(text)
+                cached = self.cache.get(key)
+                if cached is not None:
+                    yield cached
+                    return
+
+            import elevenlabs
+            chunks = []
+            for chunk in elevenlabs.generate(text=text, voice=self.voice, output_format=self.output_format, stream=True):
+                chunks.append(chunk)
+                yield chunk
+            if self.cache:
+                self.cache.put(key, b"".join(chunks))
+        except Exception as e:
+            logger.error(f"Error in ElevenLabsTTS: {e}")
+            raise
+
+    def decode(self, audio):
+        encoding, sample_rate = self.output_format.split("_")[:2]
+        if encoding == "pcm":
+            return decode_pcm16(audio), int(sample_rate)
+        return decode_mp3(audio)
+
+    def play(self, audio):
+        try:
+            super().play(audio)
         except Exception as e:
             logger.error(f"Error in ElevenLabsTTS: {e}")
             raise
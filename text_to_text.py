@@ -1,35 +1,248 @@
 import openai
+import asyncio
 import logging
+import functools
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from constants import OPENAI_API_KEY
 
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
 logger = logging.getLogger(__name__)
 
-class TextToText:
-    def __init__(self, messages):
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-3.5-turbo-0613": 4096,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+}
+TOKENS_PER_MESSAGE = 3  # Chat format overhead per message: role and separators
+TOKENS_PER_REPLY = 3  # Every reply is primed with <|start|>assistant<|message|>
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Unknown model names fall back to the encoding of the current chat models
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"Could not load tokenizer for {model}, estimating token counts: {e}")
+        return None
+
+class LanguageModel(ABC):
+    # A chat completion provider: takes the full message list and returns or streams the reply text.
+    # TextToText keeps the conversation and its token budget and hands each prompt to one of these
+    capabilities = {"streaming": True, "local": False}
+
+    @abstractmethod
+    def complete(self, messages):
+        pass
+
+    def stream(self, messages):
+        yield self.complete(messages)
+
+    async def acomplete(self, messages):
+        return await asyncio.to_thread(self.complete, messages)
+
+    async def astream(self, messages):
+        # Pulls the blocking stream one token at a time on a worker thread
+        tokens = iter(self.stream(messages))
+        done = object()
+        while (token := await asyncio.to_thread(next, tokens, done)) is not done:
+            yield token
+
+class OpenAIChat(LanguageModel):
+    def __init__(self, model="gpt-3.5-turbo"):
         openai.api_key = OPENAI_API_KEY
-        self.messages = messages
-        self.token_count = self.count_tokens(self.messages)
-    
+        self.model = model
+
+    def complete(self, messages):
+        completion = openai.ChatCompletion.create(model=self.model, messages=messages)
+        return completion.choices[0].message.content
+
+    def stream(self, messages):
+        for chunk in openai.ChatCompletion.create(model=self.model, messages=messages, stream=True):
+            token = chunk.choices[0].delta.get("content")
+            if token:
+                yield token
+
+    async def acomplete(self, messages):
+        completion = await openai.ChatCompletion.acreate(model=self.model, messages=messages)
+        return completion.choices[0].message.content
+
+    async def astream(self, messages):
+        async for chunk in await openai.ChatCompletion.acreate(model=self.model, messages=messages, stream=True):
+            token = chunk.choices[0].delta.get("content")
+            if token:
+                yield token
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation whose oldest messages no longer fit in the prompt. "
+    "Merge the new messages into the summary so far. Keep names, facts, preferences and open questions; "
+    "drop small talk. Answer with the summary only, in at most {max_words} words."
+)
+
+SUMMARY_BATCH = 40  # Most messages folded into the summary by one request
+
+class Summarizer:
+    def __init__(self, engine, summary=None, max_words=150):
+        # Folds trimmed messages into one running summary on a background thread. Jobs run one at a time and
+        # in order, so each builds on the summary left by the one before
+        self.engine = engine
+        self.summary = summary
+        self.max_words = max_words
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summarizer")
+
+    def submit(self, messages, through=None):
+        # Returns a future of (summary, through); `through` is passed along to mark what the summary covers
+        return self.executor.submit(self.summarize, messages, through)
+
+    def summarize(self, messages, through):
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        self.summary = self.engine.complete([
+            {"role": "system", "content": SUMMARY_PROMPT.format(max_words=self.max_words)},
+            {"role": "user", "content": f"Summary so far: {self.summary or '(none)'}\n\nNew messages:\n{transcript}"},
+        ])
+        return self.summary, through
+
+class TextToText:
+    def __init__(self, messages, model="gpt-3.5-turbo", max_prompt_tokens=4000, completion_reserve=512, engine=None,
+                 log=None, summarizer=None, summary=None, seqs=None):
+        # With a ConversationLog every new message is appended to it; with a Summarizer, trimmed messages are
+        # summarized in the background and the summary rides along after the system message. Seed messages that
+        # came from the log pass their sequence numbers in `seqs`
+        self.engine = engine or OpenAIChat(model)
+        self.model = model
+        self.encoding = get_encoding(model)
+        # The prompt may not exceed the configured cap nor leave less than completion_reserve of the context window
+        self.max_prompt_tokens = min(max_prompt_tokens, CONTEXT_WINDOWS.get(model, 4096) - completion_reserve)
+        self.system_message = messages[0]
+        self.history = deque()
+        self.history_counts = deque()
+        self.history_seqs = deque()  # Log sequence number of each history message, None if it was never logged
+        self.token_count = self.message_tokens(self.system_message) + TOKENS_PER_REPLY
+        self.summary_message = None
+        self.summary_count = 0
+        self.pending_summaries = deque()
+        self.log = None
+        self.summarizer = summarizer
+        if summary:
+            self.set_summary(summary)
+        for index, message in enumerate(messages[1:]):
+            self.add_message(message["role"], message["content"], trim=False, seq=seqs[index] if seqs else None)
+        # Seed messages that do not fit are summarized like any others
+        self.trim()
+        # Seed messages are already in the log, or were never meant for it
+        self.log = log
+
+    @property
+    def messages(self):
+        if self.summary_message is None:
+            return [self.system_message, *self.history]
+        return [self.system_message, self.summary_message, *self.history]
+
+    def set_summary(self, summary):
+        self.token_count -= self.summary_count
+        self.summary_message = {"role": "system", "content": f"Summary of the conversation so far: {summary}"}
+        self.summary_count = self.message_tokens(self.summary_message)
+        self.token_count += self.summary_count
+
+    def apply_summary(self):
+        # Picks up finished background summaries, newest last; the prompt never waits for one
+        latest = None
+        while self.pending_summaries and self.pending_summaries[0].done():
+            try:
+                latest = self.pending_summaries.popleft().result()
+            except Exception as e:
+                logger.warning(f"Could not summarize trimmed messages: {e}")
+        if latest is None:
+            return
+        summary, through = latest
+        self.set_summary(summary)
+        if self.log is not None:
+            self.log.append_summary(summary, through)
+
+    def message_tokens(self, message):
+        if self.encoding is None:
+            return TOKENS_PER_MESSAGE + len(message["content"]) // 4 + 1
+        return TOKENS_PER_MESSAGE + len(self.encoding.encode(message["content"])) + len(self.encoding.encode(message["role"]))
+
     def count_tokens(self, messages):
-        count = 0
-        for message in messages:
-            count += len(message["content"]) // 4
-        return count
+        return sum(self.message_tokens(message) for message in messages) + TOKENS_PER_REPLY
+
+    def add_message(self, role, content, trim=True, seq=None):
+        # Each message is counted once when it is added; the running total is adjusted as messages come and go
+        self.apply_summary()
+        message = {"role": role, "content": content}
+        count = self.message_tokens(message)
+        self.history.append(message)
+        self.history_counts.append(count)
+        self.history_seqs.append(self.log.append(role, content) if self.log is not None else seq)
+        self.token_count += count
+        if trim:
+            self.trim()
 
-    def generate_response(self, user_input):
+    def trim(self):
+        # Drops the oldest turns first, but always keeps the latest message
+        dropped = []
+        while self.token_count > self.max_prompt_tokens and len(self.history) >= 2:
+            dropped.append((self.history_seqs.popleft(), self.history.popleft()))
+            self.token_count -= self.history_counts.popleft()
+        if self.summarizer is None:
+            return
+        # A long backlog, e.g. on resuming a log that was never summarized, is folded in a batch at a time
+        for start in range(0, len(dropped), SUMMARY_BATCH):
+            batch = dropped[start:start + SUMMARY_BATCH]
+            seqs = [seq for seq, _ in batch if seq is not None]
+            self.pending_summaries.append(self.summarizer.submit([message for _, message in batch], max(seqs, default=None)))
+
+    def add_prompt(self, user_input):
+        self.add_message("user", user_input)
+
+    def discard_prompt(self):
+        # Takes back a prompt that never got a reply; the log is append-only and keeps it
+        if self.history and self.history[-1]["role"] == "user":
+            self.history.pop()
+            self.history_seqs.pop()
+            self.token_count -= self.history_counts.pop()
+
+    def generate_response(self, user_input, stream=False):
         try:
-            role = "user" if self.messages[-1]["role"] == "assistant" else "assistant"
-            self.messages.append({"role": role, "content": user_input})
+            self.add_prompt(user_input)
+            if stream:
+                return self.stream_response()
 
-            completion = openai.ChatCompletion.create(model="gpt-3.5-turbo", messages=self.messages)
-            response = completion.choices[0].message.content
-            self.messages.append({"role": "assistant", "content": response})
-            while self.count_tokens(self.messages) > 4000 and len(self.messages) >= 3:
-                self.messages = [self.messages[0]] + self.messages[2:]
-            self.token_count = self.count_tokens(self.messages)
+            response = self.engine.complete(self.messages)
+            self.add_response(response)
 
             return response
         except Exception as e:
             logger.error(f"Error in TextToText: {e}")
             raise
-        
\ No newline at end of file
+
+    def stream_response(self):
+        # Yields content tokens as they arrive; the full reply joins the history once the stream ends
+        try:
+            parts = []
+            for token in self.engine.stream(self.messages):
+                parts.append(token)
+                yield token
+            self.add_response("".join(parts))
+        except Exception as e:
+            logger.error(f"Error in TextToText: {e}")
+            raise
+
+    def add_response(self, response):
+        self.add_message("assistant", response)
@@ -1,53 +1,56 @@
+import io
+import uuid
 import streamlit as st
 # Import other necessary modules and classes here
-from google.oauth2 import service_account
-from constants import KEY_PATH
-from speech_to_text import SpeechToText
-from text_to_text import TextToText
-from text_to_speech import GoogleCloudTTS, ElevenLabsTTS
+from engines import registry, tts_name, build_conversation
+from audio_format import encode_wav
 from logger import logger
 
-# Initialize your classes and set up any necessary configurations here
-credentials = service_account.Credentials.from_service_account_file(KEY_PATH)
-s2t = SpeechToText(credentials)
-t2t = TextToText(messages=[{"role": "system", "content": "Your initialization message here"}])
+# Clients are built once per server process and shared by every session and rerun
+@st.cache_resource
+def get_engine(name):
+    return registry.get(name)
 
-# Define a function to handle user input and generate a response
-def handle_input(user_input):
-    try:
-        # Here you might call s2t.transcribe_audio(audio_file) if you have audio input
-        # For this example, we're using text input directly
-        prompt = user_input
-        text_response = t2t.generate_response(prompt)
-        return text_response
-    except Exception as e:
-        logger.error(str(e))
-        return "An error occurred."
+# Each browser session keeps its own conversation across reruns, built like the CLI's: with the fallback model,
+# summaries and the conversation log when they are configured. A session logs under its own id, so visitors
+# never resume or append to each other's conversations, and every session starts as empty as its page
+if "t2t" not in st.session_state:
+    st.session_state.conversation_id = f"ui-{uuid.uuid4().hex}"
+    st.session_state.t2t = build_conversation(registry, conversation=st.session_state.conversation_id)
+    st.session_state.turns = []  # (user input, response, WAV bytes or None) for redrawing the page
+
+def synthesize(t2s, text):
+    # The reply is served to the browser as an in-memory WAV; nothing is played on the server
+    samples, sample_rate = t2s.decode(t2s.generate_audio(text))
+    return encode_wav(samples, sample_rate)
 
 # Define Streamlit UI elements
 st.title("AI Conversational Assistant")
 
-# Create a text area for user input
-user_input = st.text_input("Type your message here...")
-
-# Create a button to send the message
-if st.button("Send"):
-    if user_input:
-        # Display user's message
-        st.write(f"You: {user_input}")
-        
-        # Generate and display the assistant’s response
-        text_response = handle_input(user_input)
-        st.write(f"Assistant: {text_response}")
-
 # Include options for sound, TTS engine, etc.
 want_sound = st.checkbox("Enable sound output")
 use_eleven_labs = st.checkbox("Use ElevenLabs for TTS instead of Google Cloud")
 
-if use_eleven_labs:
-    t2s = ElevenLabsTTS()
-else:
-    t2s = GoogleCloudTTS(credentials)
-
-# If sound is enabled, you can call t2s.synthesize(text_response) here, 
-# but note that playing audio directly might require additional adjustments or libraries
+for user_input, text_response, audio in st.session_state.turns:
+    st.chat_message("user").write(user_input)
+    with st.chat_message("assistant"):
+        st.write(text_response)
+        if audio is not None:
+            st.audio(io.BytesIO(audio), format="audio/wav")
+
+user_input = st.chat_input("Type your message here...")
+if user_input:
+    st.chat_message("user").write(user_input)
+    with st.chat_message("assistant"):
+        try:
+            # Tokens are written to the page as they arrive
+            text_response = st.write_stream(st.session_state.t2t.generate_response(user_input, stream=True))
+            audio = None
+            if want_sound:
+                with st.spinner("Synthesizing..."):
+                    audio = synthesize(get_engine(tts_name(use_eleven_labs)), text_response)
+                st.audio(io.BytesIO(audio), format="audio/wav")
+            st.session_state.turns.append((user_input, text_response, audio))
+        except Exception as e:
+            logger.error(str(e))
+            st.write("An error occurred.")
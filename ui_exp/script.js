@@ -1,67 +1,107 @@
-// Speech Recognition
-const SpeechRecognition = window.SpeechRecognition || window.webkitSpeechRecognition;
-const recognition = new SpeechRecognition();
+// Conversation socket: int16 PCM goes up, transcripts, tokens and PCM audio come back
+const socketUrl = `${location.protocol === 'https:' ? 'wss' : 'ws'}://${location.hostname}:8000/ws/converse`;
 
-// Speech Synthesis
-const synth = window.speechSynthesis;
+// The context runs at the device rate (not every browser can record into a 16 kHz context);
+// the server is told the rate and resamples
+const audioContext = new AudioContext();
 
 // States
 let isProcessing = false;
+let socket = null;
+let pendingAudio = null; // Header of the audio chunk whose bytes arrive in the next binary message
+let playbackTime = 0;
+let playingSources = [];
 
 // Get the animation container
 const animationContainer = document.getElementById('animation-container');
 
-// Function to start listening to user input
-const startListening = () => {
-  if (isProcessing) return;
-  recognition.start();
+// Function to convert float samples from the microphone to int16 PCM
+const toPcm16 = (samples) => {
+  const pcm = new Int16Array(samples.length);
+  for (let i = 0; i < samples.length; i++) {
+    const sample = Math.max(-1, Math.min(1, samples[i]));
+    pcm[i] = sample < 0 ? sample * 0x8000 : sample * 0x7fff;
+  }
+  return pcm;
 }
 
-// Function to stop listening to user input
-const stopListening = () => {
-  recognition.stop();
+// Function to start streaming the microphone to the server
+const startListening = async () => {
+  const stream = await navigator.mediaDevices.getUserMedia({ audio: { echoCancellation: true, channelCount: 1 } });
+  const source = audioContext.createMediaStreamSource(stream);
+  const processor = audioContext.createScriptProcessor(1024, 1, 1);
+  processor.onaudioprocess = (e) => {
+    if (isProcessing || !socket || socket.readyState !== WebSocket.OPEN) return;
+    socket.send(toPcm16(e.inputBuffer.getChannelData(0)).buffer);
+  };
+  source.connect(processor);
+  processor.connect(audioContext.destination);
 }
 
-// Function to process the input and produce output
-const processInput = (input) => {
-  isProcessing = true;
-  // Simulate processing time
-  setTimeout(() => {
-    const output = `You said: ${input}`; // Replace with actual processing logic
-    speak(output);
-  }, 2000);
+// Function to queue a chunk of int16 PCM right after the previous one
+const playChunk = (header, data) => {
+  const pcm = new Int16Array(data);
+  const frames = pcm.length / header.channels;
+  const buffer = audioContext.createBuffer(header.channels, frames, header.sample_rate);
+  for (let channel = 0; channel < header.channels; channel++) {
+    const output = buffer.getChannelData(channel);
+    for (let i = 0; i < frames; i++) {
+      output[i] = pcm[i * header.channels + channel] / 0x8000;
+    }
+  }
+  const source = audioContext.createBufferSource();
+  source.buffer = buffer;
+  source.connect(audioContext.destination);
+  playbackTime = Math.max(playbackTime, audioContext.currentTime);
+  source.start(playbackTime);
+  playbackTime += buffer.duration;
+  playingSources.push(source);
+  source.onended = () => {
+    playingSources = playingSources.filter((s) => s !== source);
+    if (!playingSources.length && !pendingAudio) isProcessing = false;
+  };
 }
 
-// Function to speak the output
-const speak = (output) => {
-  const utterance = new SpeechSynthesisUtterance(output);
-  utterance.onend = () => {
-    isProcessing = false;
-    startListening();
-  };
-  synth.speak(utterance);
+// Function to stop everything that is playing or scheduled
+const stopSpeaking = () => {
+  playingSources.forEach((source) => source.stop());
+  playingSources = [];
+  playbackTime = 0;
+  isProcessing = false;
 }
 
-// Event when speech recognition returns a result
-recognition.addEventListener('result', (e) => {
-  const input = e.results[0][0].transcript;
-  stopListening();
-  processInput(input);
-});
+// Function to handle one message from the server
+const handleMessage = (e) => {
+  if (e.data instanceof ArrayBuffer) {
+    if (pendingAudio) playChunk(pendingAudio, e.data);
+    pendingAudio = null;
+    return;
+  }
+  const event = JSON.parse(e.data);
+  if (event.type === 'transcript' && event.final) {
+    isProcessing = true; // Stop sending the microphone while Vivy answers
+  } else if (event.type === 'audio') {
+    pendingAudio = event;
+  } else if (event.type === 'done' && !playingSources.length) {
+    isProcessing = false;
+  }
+}
 
-// Event when speech recognition ends
-recognition.addEventListener('end', () => {
-  if (!isProcessing) startListening();
-});
+// Function to open the conversation socket, reconnecting if it drops
+const connect = () => {
+  socket = new WebSocket(socketUrl);
+  socket.binaryType = 'arraybuffer';
+  socket.addEventListener('open', () => socket.send(JSON.stringify({ type: 'format', sample_rate: audioContext.sampleRate })));
+  socket.addEventListener('message', handleMessage);
+  socket.addEventListener('close', () => setTimeout(connect, 1000));
+}
 
 // Event when the animation container is clicked
 animationContainer.addEventListener('click', () => {
-  if (synth.speaking) {
-    synth.cancel();
-    isProcessing = false;
-    startListening();
-  }
+  audioContext.resume();
+  if (playingSources.length) stopSpeaking();
 });
 
 // Start listening initially
+connect();
 startListening();
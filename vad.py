@@ -0,0 +1,115 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from constants import SAMPLE_RATE_HERTZ
+
+class EnergyVAD:
+    def __init__(self, sample_rate=SAMPLE_RATE_HERTZ, frame_duration=0.02, energy_ratio_threshold=1.5,
+                 hangover_duration=0.3, pre_roll_duration=0.2, initialization_duration=1.0,
+                 noise_adaptation=0.05, noise_rise=0.005, min_noise_floor=100.0, echo_coupling=0.5):
+        self.sample_rate = sample_rate
+        self.frame_size = int(sample_rate * frame_duration)
+        self.energy_ratio_threshold = energy_ratio_threshold
+        self.hangover_frames = int(round(hangover_duration / frame_duration))
+        self.pre_roll_frames = int(round(pre_roll_duration / frame_duration))
+        self.initialization_frames = max(1, int(round(initialization_duration / frame_duration)))
+        self.noise_adaptation = noise_adaptation
+        self.noise_rise = noise_rise
+        self.min_noise_floor = min_noise_floor
+        # Fraction of the playback energy expected to leak from the speaker into the microphone
+        self.echo_coupling = echo_coupling
+        self.echo_energy = 0.0
+        self.reset()
+
+    def reset(self):
+        self.noise_floor = None
+        self.frames_processed = 0
+        self._calibration_energy = 0.0
+        self._calibration_frames = 0
+        self._last_speech_frame = -self.hangover_frames - 1
+        self._remainder = np.zeros(0, dtype=np.int16)
+
+    def frame(self, samples):
+        # Non-overlapping frames as a (count, frame_size) strided view, no copy
+        count = len(samples) // self.frame_size
+        stride = samples.strides[0]
+        return as_strided(samples, shape=(count, self.frame_size), strides=(stride * self.frame_size, stride), writeable=False)
+
+    def frame_energies(self, samples):
+        frames = self.frame(np.ascontiguousarray(samples)).astype(np.float32)
+        return np.einsum("ij,ij->i", frames, frames) / self.frame_size
+
+    def process(self, samples):
+        # Streaming entry point: returns the speech mask for every complete frame, keeping partial frames for the next call
+        if len(self._remainder):
+            samples = np.concatenate((self._remainder, samples))
+        complete = len(samples) - len(samples) % self.frame_size
+        self._remainder = samples[complete:].copy()
+        return self.classify(self.frame_energies(samples[:complete]))
+
+    def classify(self, energies):
+        active = np.zeros(len(energies), dtype=bool)
+        start = 0
+        if self.noise_floor is None:
+            # The first frames are assumed to be background noise and calibrate the floor
+            start = min(len(energies), self.initialization_frames - self._calibration_frames)
+            self._calibration_energy += float(np.sum(energies[:start]))
+            self._calibration_frames += start
+            if self._calibration_frames == self.initialization_frames:
+                self.noise_floor = self._calibration_energy / self._calibration_frames
+        if start == len(energies):
+            self.frames_processed += len(energies)
+            return active
+
+        batch = energies[start:]
+        noise_threshold = max(self.noise_floor, self.min_noise_floor) * self.energy_ratio_threshold
+        above_noise = batch > noise_threshold
+        # While audio is playing, speech must also rise above the expected echo of it
+        speech = above_noise & (batch > self.echo_energy * self.echo_coupling * self.energy_ratio_threshold)
+
+        # Track the noise floor with an exponential moving average over this batch's non-speech frames,
+        # and let it creep up slowly under speech so a step in background noise is not speech forever;
+        # frames that are only echo leave the floor alone
+        quiet = batch[~above_noise]
+        if len(quiet):
+            weight = 1.0 - (1.0 - self.noise_adaptation) ** len(quiet)
+            self.noise_floor += weight * (float(np.mean(quiet)) - self.noise_floor)
+        if speech.any():
+            weight = 1.0 - (1.0 - self.noise_rise) ** int(np.count_nonzero(speech))
+            self.noise_floor += weight * (float(np.min(batch[speech])) - self.noise_floor)
+
+        # Hangover: a frame stays active while the last speech frame is at most hangover_frames behind it
+        index = np.arange(self.frames_processed + start, self.frames_processed + len(energies))
+        last_speech = np.maximum.accumulate(np.where(speech, index, self._last_speech_frame))
+        active[start:] = index - last_speech <= self.hangover_frames
+        self._last_speech_frame = int(last_speech[-1])
+        self.frames_processed += len(energies)
+        return active
+
+    def detect_segments(self, samples, batch_duration=1.0, noise_percentile=10):
+        # Offline segmentation of a whole recording; returns (start, end) sample offsets including pre-roll.
+        # The whole recording is at hand, so the floor is calibrated on its quietest frames rather than on its
+        # opening, which in a clipped utterance is usually speech
+        self.reset()
+        samples = np.ascontiguousarray(samples)
+        if samples.ndim > 1:
+            samples = samples.mean(axis=1).astype(np.int16)
+        energies = self.frame_energies(samples)
+        if len(energies):
+            self.noise_floor = float(np.percentile(energies, noise_percentile))
+        batch_frames = max(1, int(batch_duration * self.sample_rate) // self.frame_size)
+        active = np.concatenate(
+            [self.classify(energies[i:i + batch_frames]) for i in range(0, len(energies), batch_frames)]
+            or [np.zeros(0, dtype=bool)]
+        )
+
+        edges = np.diff(active.astype(np.int8), prepend=0, append=0)
+        starts = np.flatnonzero(edges == 1) - self.pre_roll_frames
+        ends = np.flatnonzero(edges == -1)
+        np.maximum(starts, 0, out=starts)
+        if len(starts) > 1:
+            # Pre-roll can reach back into the previous segment; clamp it there instead of overlapping
+            np.maximum(starts[1:], ends[:-1], out=starts[1:])
+        return [(int(s) * self.frame_size, int(e) * self.frame_size) for s, e in zip(starts, ends)]
+
+def detect_segments(samples, sample_rate=SAMPLE_RATE_HERTZ, **kwargs):
+    return EnergyVAD(sample_rate, **kwargs).detect_segments(samples)